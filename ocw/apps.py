@@ -1,29 +1,72 @@
 from django.apps import AppConfig
 import os
+import copy
 import logging
+from datetime import datetime
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR
 from pytz import utc
+from webui.settings import PCWConfig
 
 logger = logging.getLogger(__name__)
 __scheduler = None
+__job_starts = dict()
+__job_metrics = dict()
 
 
 def getScheduler():
     global __scheduler
     if __scheduler is None:
         logger.debug("Create new BackgrounScheduler")
+        # every job family gets its own executor, so a long cleanup can not delay the instance sync
         executors = {
                 'default': ThreadPoolExecutor(1),
+                'update': ThreadPoolExecutor(PCWConfig.get_feature_property('scheduler', 'update-workers')),
+                'cleanup': ThreadPoolExecutor(PCWConfig.get_feature_property('scheduler', 'cleanup-workers')),
+                'clusters': ThreadPoolExecutor(PCWConfig.get_feature_property('scheduler', 'clusters-workers')),
+                'delete': ThreadPoolExecutor(PCWConfig.get_feature_property('scheduler', 'delete-workers')),
             }
         job_defaults = {
                 'coalesce': False,
                 'max_instances': 1
             }
         __scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults, timezone=utc)
+        __scheduler.add_listener(job_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
     return __scheduler
 
 
+def add_measured_job(func, executor, **kwargs):
+    ''' Add a job to the scheduler which reports its runtime and queue delay to job_metrics() '''
+    getScheduler().add_job(run_measured, args=[kwargs['id'], func], executor=executor, **kwargs)
+
+
+def run_measured(job_id, func):
+    __job_starts[job_id] = datetime.now(utc)
+    return func()
+
+
+def job_listener(event):
+    start = __job_starts.pop(event.job_id, None)
+    if start is None:
+        return
+    runtime = (datetime.now(utc) - start).total_seconds()
+    queue_delay = (start - event.scheduled_run_time).total_seconds()
+    metrics = __job_metrics.setdefault(event.job_id, {'runs': 0, 'failures': 0, 'max_queue_delay': 0.0})
+    metrics['runs'] += 1
+    if event.exception:
+        metrics['failures'] += 1
+    metrics['last_start'] = start.isoformat()
+    metrics['last_runtime'] = runtime
+    metrics['last_queue_delay'] = queue_delay
+    metrics['max_queue_delay'] = max(metrics['max_queue_delay'], queue_delay)
+    logger.info("Job %s finished after %.1fs (queue delay %.1fs)", event.job_id, runtime, queue_delay)
+
+
+def job_metrics():
+    return copy.deepcopy(__job_metrics)
+
+
 class OcwConfig(AppConfig):
     name = 'ocw'
     ready_called = False
@@ -4,15 +4,89 @@ from dateutil.parser import parse
 import boto3
 from botocore.exceptions import ClientError
 import re
-from datetime import date, datetime, timedelta, timezone
+from datetime import date, datetime, timedelta
 from ocw.lib.emailnotify import send_mail
 import traceback
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+
+
+class VpcPlan:
+    ''' The uploader VPCs of one region with their dependencies, see EC2.plan_vpc_deletion '''
+
+    def __init__(self, region, vpcs):
+        self.region = region
+        self.vpcs = vpcs
+        # ids of the VPCs with instances
+        self.locked = set()
+        # (VPC id, describe_* item) pairs per key of EC2.vpc_deletions
+        self.resources = {kind: list() for kind in EC2.vpc_deletions}
+        self.api_calls = 0
+        self.calls_saved = 0
 
 
 class EC2(Provider):
     __instances = dict()
+    __instances_lock = threading.Lock()
     default_region = 'eu-central-1'
+    # max. number of values accepted by a single describe_* filter
+    filter_values_limit = 200
+    # AWS keeps reporting terminated instances for about an hour, list_instances skips them
+    listed_instance_states = ['pending', 'running', 'shutting-down', 'stopping', 'stopped']
+    # MaxResults of describe_instances
+    describe_instances_page_size = 1000
+    # max. number of instance ids accepted by a single TerminateInstances call
+    terminate_instances_limit = 1000
+    # MaxResults of the paginated describe_snapshots, describe_volumes and describe_images calls of the cleanup
+    describe_page_size = 500
+    # server side prefilters of the cleanup, the exact rules are checked on every page
+    deletable_snapshot_descriptions = ['OpenQA upload image', 'Created by CreateImage(*) for ami-* from vol-*']
+    deletable_volume_states = ['available', 'error']
+    # outcomes of delete_instances
+    TERMINATED = 'terminated'
+    NOT_FOUND = 'not found'
+    DRY_RUN = 'skipped due to dry run mode'
+    # MaxResults of list_clusters
+    list_clusters_page_size = 100
+    # seconds for which listed and described clusters are reused, e.g. by rmclusters after all_clusters
+    cluster_cache_seconds = 300
+    # seconds between the checks of the nodegroups of the clusters deleted by delete_all_clusters
+    nodegroup_poll_seconds = 20
+    # outcomes of delete_all_clusters, besides DRY_RUN
+    DELETED = 'deleted'
+    TIMED_OUT = 'nodegroups not deleted in time'
+    # describe operation, result key, VPC filter and MaxResults of the dependencies of the uploader VPCs, most of
+    # these operations accept up to 1000 results per page but DescribeRouteTables only 100
+    vpc_dependencies = {
+        'internet gateways': ('describe_internet_gateways', 'InternetGateways', 'attachment.vpc-id',
+                              describe_page_size),
+        'vpc endpoints': ('describe_vpc_endpoints', 'VpcEndpoints', 'vpc-id', describe_page_size),
+        'vpc peering connections': ('describe_vpc_peering_connections', 'VpcPeeringConnections',
+                                    'requester-vpc-info.vpc-id', describe_page_size),
+        'route tables': ('describe_route_tables', 'RouteTables', 'vpc-id', 100),
+        'network interfaces': ('describe_network_interfaces', 'NetworkInterfaces', 'vpc-id', describe_page_size),
+        'subnets': ('describe_subnets', 'Subnets', 'vpc-id', describe_page_size),
+        'security groups': ('describe_security_groups', 'SecurityGroups', 'vpc-id', describe_page_size),
+        'network acls': ('describe_network_acls', 'NetworkAcls', 'vpc-id', describe_page_size),
+    }
+    # delete operation, id parameter and id key of the VPCs and their dependencies
+    vpc_deletions = {
+        'internet gateways': ('delete_internet_gateway', 'InternetGatewayId', 'InternetGatewayId'),
+        'vpc endpoints': ('delete_vpc_endpoints', 'VpcEndpointIds', 'VpcEndpointId'),
+        'vpc peering connections': ('delete_vpc_peering_connection', 'VpcPeeringConnectionId',
+                                    'VpcPeeringConnectionId'),
+        'route tables': ('delete_route_table', 'RouteTableId', 'RouteTableId'),
+        'network interfaces': ('delete_network_interface', 'NetworkInterfaceId', 'NetworkInterfaceId'),
+        'subnets': ('delete_subnet', 'SubnetId', 'SubnetId'),
+        'security groups': ('delete_security_group', 'GroupId', 'GroupId'),
+        'network acls': ('delete_network_acl', 'NetworkAclId', 'NetworkAclId'),
+        'vpcs': ('delete_vpc', 'VpcId', 'VpcId'),
+    }
+    # resources of one level only depend on resources of earlier levels
+    vpc_deletion_levels = [['internet gateways', 'vpc endpoints', 'vpc peering connections', 'route tables'],
+                           ['network interfaces'], ['subnets', 'security groups'], ['network acls'], ['vpcs']]
 
     def __init__(self, namespace: str):
         super().__init__(namespace)
@@ -27,15 +101,20 @@ class EC2(Provider):
             self.cluster_regions = self.get_all_regions()
 
     def __new__(cls, vault_namespace):
-        if vault_namespace not in EC2.__instances:
-            EC2.__instances[vault_namespace] = self = object.__new__(cls)
-            self.__ec2_client = dict()
-            self.__eks_client = dict()
-            self.__ec2_resource = dict()
-            self.__secret = None
-            self.__key = None
-
-        return EC2.__instances[vault_namespace]
+        # EC2(namespace) is called from several executors at once, the instance is only published when complete
+        with EC2.__instances_lock:
+            if vault_namespace not in EC2.__instances:
+                self = object.__new__(cls)
+                self.__ec2_client = dict()
+                self.__eks_client = dict()
+                self.__ec2_resource = dict()
+                self.__clients_lock = threading.Lock()
+                self.__cluster_cache = dict()
+                self.__cluster_cache_lock = threading.Lock()
+                self.__secret = None
+                self.__key = None
+                EC2.__instances[vault_namespace] = self
+            return EC2.__instances[vault_namespace]
 
     def check_credentials(self):
 
@@ -51,43 +130,81 @@ class EC2(Provider):
                 time.sleep(1)
         self.get_all_regions()
 
+    # boto3's default session is not thread-safe, so creating clients and resources is serialized
     def ec2_resource(self, region):
-        if region not in self.__ec2_resource:
-            self.__ec2_resource[region] = boto3.resource('ec2', aws_access_key_id=self.__key,
-                                                         aws_secret_access_key=self.__secret,
-                                                         region_name=region)
-        return self.__ec2_resource[region]
+        with self.__clients_lock:
+            if region not in self.__ec2_resource:
+                self.__ec2_resource[region] = boto3.resource('ec2', aws_access_key_id=self.__key,
+                                                             aws_secret_access_key=self.__secret,
+                                                             region_name=region)
+            return self.__ec2_resource[region]
 
     def ec2_client(self, region):
-        if region not in self.__ec2_client:
-            self.__ec2_client[region] = boto3.client('ec2', aws_access_key_id=self.__key,
-                                                     aws_secret_access_key=self.__secret,
-                                                     region_name=region)
-        return self.__ec2_client[region]
+        with self.__clients_lock:
+            if region not in self.__ec2_client:
+                self.__ec2_client[region] = boto3.client('ec2', aws_access_key_id=self.__key,
+                                                         aws_secret_access_key=self.__secret,
+                                                         region_name=region)
+            return self.__ec2_client[region]
 
     def eks_client(self, region):
-        if region not in self.__eks_client:
-            self.__eks_client[region] = boto3.client('eks', aws_access_key_id=self.__key,
-                                                     aws_secret_access_key=self.__secret,
-                                                     region_name=region)
-        return self.__eks_client[region]
+        with self.__clients_lock:
+            if region not in self.__eks_client:
+                self.__eks_client[region] = boto3.client('eks', aws_access_key_id=self.__key,
+                                                         aws_secret_access_key=self.__secret,
+                                                         region_name=region)
+            return self.__eks_client[region]
 
     def all_clusters(self):
+        '''
+        Returns the names of the clusters without pcw_ignore tag per region. The clusters of all cluster_regions are
+        listed and described in parallel with at most clusters/parallel-tasks concurrent calls.
+        '''
+        max_workers = PCWConfig.get_feature_property('clusters', 'parallel-tasks', self._namespace)
+        for region in self.cluster_regions:
+            self.eks_client(region)
+        descriptions = {region: list() for region in self.cluster_regions}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            listings = {executor.submit(self.list_cluster_names, region): region for region in self.cluster_regions}
+            for future in as_completed(listings):
+                region = listings[future]
+                descriptions[region] = [(cl, executor.submit(self.describe_cluster, region, cl))
+                                        for cl in future.result()]
         clusters = dict()
         for region in self.cluster_regions:
-            response = self.eks_client(region).list_clusters()
-            if 'clusters' in response and len(response['clusters']) > 0:
-                clusters[region] = []
-                for cl in response['clusters']:
-                    cluster_description = self.eks_client(region).describe_cluster(name=cl)
-                    if 'cluster' not in cluster_description or 'tags' not in cluster_description['cluster']:
-                        self.log_err("Unexpected cluster description: {}", cluster_description)
-                    elif 'pcw_ignore' not in cluster_description['cluster']['tags']:
-                        clusters[region].append(cl)
-                if len(clusters[region]) == 0:
-                    del clusters[region]
+            for cl, future in descriptions[region]:
+                cluster_description = future.result()
+                if 'cluster' not in cluster_description or 'tags' not in cluster_description['cluster']:
+                    self.log_err("Unexpected cluster description: {}", cluster_description)
+                elif 'pcw_ignore' not in cluster_description['cluster']['tags']:
+                    clusters.setdefault(region, []).append(cl)
         return clusters
 
+    def _cluster_cached(self, key, compute):
+        ''' Returns the result of compute() for key, a result younger than cluster_cache_seconds is reused '''
+        now = time.monotonic()
+        with self.__cluster_cache_lock:
+            entry = self.__cluster_cache.get(key)
+            if entry and now - entry[0] < EC2.cluster_cache_seconds:
+                return entry[1]
+        value = compute()
+        with self.__cluster_cache_lock:
+            self.__cluster_cache[key] = (now, value)
+        return value
+
+    def forget_clusters(self):
+        with self.__cluster_cache_lock:
+            self.__cluster_cache.clear()
+
+    def list_cluster_names(self, region):
+        return self._cluster_cached(('list_clusters', region), lambda: [
+            cl for page in self.eks_client(region).get_paginator('list_clusters').paginate(
+                PaginationConfig={'PageSize': EC2.list_clusters_page_size}) for cl in page['clusters']])
+
+    def describe_cluster(self, region, cluster):
+        return self._cluster_cached(('describe_cluster', region, cluster),
+                                    lambda: self.eks_client(region).describe_cluster(name=cluster))
+
     @staticmethod
     def needs_to_delete_snapshot(snapshot, cleanup_ec2_max_snapshot_age_days) -> bool:
         delete_older_than = date.today() - timedelta(days=cleanup_ec2_max_snapshot_age_days)
@@ -102,47 +219,80 @@ class EC2(Provider):
                     return True
         return False
 
+    def snapshots_to_delete(self, region, cleanup_ec2_max_snapshot_age_days):
+        ''' Only snapshots with a description matched by needs_to_delete_snapshot are fetched, the age is checked
+        page by page, as the API can not filter by a time range '''
+        snapshots = list()
+        for page in self.ec2_client(region).get_paginator('describe_snapshots').paginate(
+                OwnerIds=['self'], Filters=[{'Name': 'description', 'Values': EC2.deletable_snapshot_descriptions}],
+                PaginationConfig={'PageSize': EC2.describe_page_size}):
+            snapshots += [snapshot for snapshot in page['Snapshots']
+                          if EC2.needs_to_delete_snapshot(snapshot, cleanup_ec2_max_snapshot_age_days)]
+        snapshots.sort(key=lambda snapshot: snapshot['StartTime'].timestamp())
+        return snapshots
+
+    def delete_snapshot(self, region, snapshot):
+        self.log_info("Deleting snapshot {} in region {} with StartTime={}", snapshot['SnapshotId'],
+                      region, snapshot['StartTime'])
+        try:
+            if self.dry_run:
+                self.log_info("Snapshot deletion of {} skipped due to dry run mode",
+                              snapshot['SnapshotId'])
+            else:
+                self.ec2_client(region).delete_snapshot(SnapshotId=snapshot['SnapshotId'])
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == 'InvalidSnapshot.InUse':
+                self.log_info(ex.response['Error']['Message'])
+                return 0
+            else:
+                raise ex
+
     def cleanup_snapshots(self, cleanup_ec2_max_snapshot_age_days):
-        for region in self.all_regions:
-            response = self.ec2_client(region).describe_snapshots(OwnerIds=['self'])
-            response['Snapshots'].sort(key=lambda snapshot: snapshot['StartTime'].timestamp())
-            for snapshot in response['Snapshots']:
-                if EC2.needs_to_delete_snapshot(snapshot, cleanup_ec2_max_snapshot_age_days):
-                    self.log_info("Deleting snapshot {} in region {} with StartTime={}", snapshot['SnapshotId'],
-                                  region, snapshot['StartTime'])
-                    try:
-                        if self.dry_run:
-                            self.log_info("Snapshot deletion of {} skipped due to dry run mode",
-                                          snapshot['SnapshotId'])
-                        else:
-                            self.ec2_client(region).delete_snapshot(SnapshotId=snapshot['SnapshotId'])
-                    except ClientError as ex:
-                        if ex.response['Error']['Code'] == 'InvalidSnapshot.InUse':
-                            self.log_info(ex.response['Error']['Message'])
-                        else:
-                            raise ex
+        return self.run_cleanup([self.snapshots_cleanup(cleanup_ec2_max_snapshot_age_days)])
 
-    def cleanup_volumes(self, cleanup_ec2_max_volumes_age_days):
+    def snapshots_cleanup(self, cleanup_ec2_max_snapshot_age_days):
+        return ('snapshots', partial(self.snapshots_to_delete,
+                                     cleanup_ec2_max_snapshot_age_days=cleanup_ec2_max_snapshot_age_days),
+                self.delete_snapshot)
+
+    def volumes_to_delete(self, region, cleanup_ec2_max_volumes_age_days):
         delete_older_than = date.today() - timedelta(days=cleanup_ec2_max_volumes_age_days)
-        for region in self.all_regions:
-            response = self.ec2_client(region).describe_volumes()
-            for volume in response['Volumes']:
+        volumes = list()
+        # attached volumes can not be deleted anyway
+        for page in self.ec2_client(region).get_paginator('describe_volumes').paginate(
+                Filters=[{'Name': 'status', 'Values': EC2.deletable_volume_states}],
+                PaginationConfig={'PageSize': EC2.describe_page_size}):
+            for volume in page['Volumes']:
                 if datetime.date(volume['CreateTime']) < delete_older_than:
                     if self.volume_protected(volume):
                         self.log_info('Volume {} has tag DO_NOT_DELETE so protected from deletion',
                                       volume['VolumeId'])
-                    elif self.dry_run:
-                        self.log_info("Volume deletion of {} skipped due to dry run mode", volume['VolumeId'])
                     else:
-                        self.log_info("Deleting volume {} in region {} with CreateTime={}", volume['VolumeId'], region,
-                                      volume['CreateTime'])
-                        try:
-                            self.ec2_client(region).delete_volume(VolumeId=volume['VolumeId'])
-                        except ClientError as ex:
-                            if ex.response['Error']['Code'] == 'VolumeInUse':
-                                self.log_info(ex.response['Error'])
-                            else:
-                                raise ex
+                        volumes.append(volume)
+        return volumes
+
+    def delete_volume(self, region, volume):
+        if self.dry_run:
+            self.log_info("Volume deletion of {} skipped due to dry run mode", volume['VolumeId'])
+        else:
+            self.log_info("Deleting volume {} in region {} with CreateTime={}", volume['VolumeId'], region,
+                          volume['CreateTime'])
+            try:
+                self.ec2_client(region).delete_volume(VolumeId=volume['VolumeId'])
+            except ClientError as ex:
+                if ex.response['Error']['Code'] == 'VolumeInUse':
+                    self.log_info(ex.response['Error'])
+                    return 0
+                else:
+                    raise ex
+
+    def cleanup_volumes(self, cleanup_ec2_max_volumes_age_days):
+        return self.run_cleanup([self.volumes_cleanup(cleanup_ec2_max_volumes_age_days)])
+
+    def volumes_cleanup(self, cleanup_ec2_max_volumes_age_days):
+        return ('volumes', partial(self.volumes_to_delete,
+                                   cleanup_ec2_max_volumes_age_days=cleanup_ec2_max_volumes_age_days),
+                self.delete_volume)
 
     def volume_protected(self, volume):
         if 'Tags' in volume:
@@ -152,7 +302,22 @@ class EC2(Provider):
         return False
 
     def list_instances(self, region):
-        return [i for i in self.ec2_resource(region).instances.all()]
+        ''' Instances which are not terminated yet, fetched with describe_instances_page_size instances per call '''
+        return list(self.ec2_resource(region).instances.filter(
+            Filters=[{'Name': 'instance-state-name', 'Values': EC2.listed_instance_states}]
+        ).page_size(EC2.describe_instances_page_size))
+
+    def get_image_names(self, region, image_ids):
+        ''' Resolve image ids to names with one describe_images call per chunk of ids. Ids of images which
+        do not exist anymore are mapped to None.'''
+        image_names = dict.fromkeys(image_ids)
+        ids = sorted(image_names)
+        for n in range(0, len(ids), EC2.filter_values_limit):
+            response = self.ec2_client(region).describe_images(
+                Filters=[{'Name': 'image-id', 'Values': ids[n:n + EC2.filter_values_limit]}], IncludeDeprecated=True)
+            for img in response['Images']:
+                image_names[img['ImageId']] = img.get('Name')
+        return image_names
 
     def get_all_regions(self):
         regions_resp = self.ec2_client(EC2.default_region).describe_regions()
@@ -160,54 +325,143 @@ class EC2(Provider):
         return regions
 
     def delete_instance(self, region, instance_id):
-        try:
+        outcome = self.delete_instances(region, [instance_id])[instance_id]
+        if isinstance(outcome, Exception):
+            raise outcome
+
+    def delete_instances(self, region, instance_ids):
+        '''
+        Terminates the instances with one TerminateInstances call per terminate_instances_limit ids. If some of the
+        ids do not exist, the call is repeated without them. Returns a dict with the outcome of every id, which is
+        one of TERMINATED, NOT_FOUND, DRY_RUN or the ClientError which prevented the termination.
+        '''
+        if self.dry_run:
+            self.log_info("Termination of instances {} skipped due to dry run mode", ', '.join(instance_ids))
+            return dict.fromkeys(instance_ids, EC2.DRY_RUN)
+        outcomes = dict()
+        ids = sorted(set(instance_ids))
+        for n in range(0, len(ids), EC2.terminate_instances_limit):
+            chunk = ids[n:n + EC2.terminate_instances_limit]
+            while chunk:
+                try:
+                    self.ec2_client(region).terminate_instances(InstanceIds=chunk)
+                    outcomes.update(dict.fromkeys(chunk, EC2.TERMINATED))
+                    break
+                except ClientError as ex:
+                    missing = set()
+                    if ex.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
+                        missing = set(re.findall(r'i-[0-9a-f]+', ex.response['Error'].get('Message', ''))) & set(chunk)
+                    if not missing:
+                        self.log_err("Failed to terminate instances {}: {}", ', '.join(chunk), ex)
+                        outcomes.update(dict.fromkeys(chunk, ex))
+                        break
+                    self.log_warn("Failed to delete instance(s) with id {}. It does not exists on EC2",
+                                  ', '.join(sorted(missing)))
+                    outcomes.update(dict.fromkeys(missing, EC2.NOT_FOUND))
+                    chunk = [i for i in chunk if i not in missing]
+        return outcomes
+
+    def start_cluster_teardown(self, region, cluster):
+        '''
+        Starts the deletion of all nodegroups of the cluster. A cluster without nodegroups is deleted right away.
+        Returns the outcome of the cluster or None if it has to wait for its nodegroups.
+        '''
+        nodegroups = self.eks_client(region).list_nodegroups(clusterName=cluster)['nodegroups']
+        if len(nodegroups):
+            self.log_info("Found {} nodegroups for {}", len(nodegroups), cluster)
+        for nodegroup in nodegroups:
             if self.dry_run:
-                self.log_info("Instance termination {} skipped due to dry run mode", instance_id)
+                self.log_info("Skipping {} nodegroup deletion due to dry-run mode", nodegroup)
             else:
-                self.ec2_resource(region).instances.filter(InstanceIds=[instance_id]).terminate()
-        except ClientError as ex:
-            if ex.response['Error']['Code'] == 'InvalidInstanceID.NotFound':
-                self.log_warn("Failed to delete instance with id {}. It does not exists on EC2", instance_id)
-            else:
-                raise ex
-
-    def wait_for_empty_nodegroup_list(self, region, clusterName, timeout_minutes=20):
+                self.log_info("Deleting {}", nodegroup)
+                self.eks_client(region).delete_nodegroup(clusterName=cluster, nodegroupName=nodegroup)
         if self.dry_run:
-            self.log_info("Skip waiting due to dry-run mode")
-            return True
-        self.log_info("Waiting empty nodegroup list in {}", clusterName)
-        end = datetime.now(timezone.utc) + timedelta(minutes=timeout_minutes)
-        resp_nodegroup = self.eks_client(region).list_nodegroups(clusterName=clusterName)
-
-        while datetime.now(timezone.utc) < end and len(resp_nodegroup['nodegroups']) > 0:
-            time.sleep(20)
-            resp_nodegroup = self.eks_client(region).list_nodegroups(clusterName=clusterName)
-            if len(resp_nodegroup['nodegroups']) > 0:
-                self.log_info("Still waiting for {} nodegroups to disappear", len(resp_nodegroup['nodegroups']))
+            self.log_info("Skipping {} cluster deletion due to dry-run mode", cluster)
+            return EC2.DRY_RUN
+        if len(nodegroups):
+            return None
+        return self.delete_cluster(region, cluster)
+
+    def delete_cluster_if_free(self, region, cluster):
+        ''' Deletes the cluster if its nodegroups are gone, returns None if some of them are left '''
+        if len(self.eks_client(region).list_nodegroups(clusterName=cluster)['nodegroups']):
+            return None
+        return self.delete_cluster(region, cluster)
+
+    def delete_cluster(self, region, cluster):
+        self.log_info("Finally deleting {} cluster", cluster)
+        self.eks_client(region).delete_cluster(name=cluster)
+        return EC2.DELETED
 
     def delete_all_clusters(self):
+        '''
+        Tears down the clusters of all cluster_regions at once. The clusters of all regions are listed, reusing a
+        recent listing of all_clusters, and the deletion of all their nodegroups is started in parallel. Then the
+        nodegroup lists of all waiting clusters are checked together every nodegroup_poll_seconds and each cluster is
+        deleted as soon as its nodegroups are gone. Clusters which still have nodegroups after
+        clusters/delete-timeout-minutes are left alone.
+        Returns a dict with the outcome of every (region, cluster) pair, which is one of DELETED, TIMED_OUT, DRY_RUN
+        or the exception which prevented the deletion. Failures are logged and the first one is raised after all
+        clusters are done.
+        '''
         self.log_info("Deleting all clusters!")
+        max_workers = PCWConfig.get_feature_property('clusters', 'parallel-tasks', self._namespace)
+        timeout = PCWConfig.get_feature_property('clusters', 'delete-timeout-minutes', self._namespace)
+        deadline = time.monotonic() + timeout * 60
+        outcomes = dict()
+        errors = list()
+        # the clients are created here, creating them is serialized anyway
         for region in self.cluster_regions:
-            response = self.eks_client(region).list_clusters()
-            if len(response['clusters']):
-                self.log_info("Found {} cluster(s) in {}", len(response['clusters']), region)
-                for cluster in response['clusters']:
-                    resp_nodegroup = self.eks_client(region).list_nodegroups(clusterName=cluster)
-                    if len(resp_nodegroup['nodegroups']):
-                        self.log_info("Found {} nodegroups for {}", len(resp_nodegroup['nodegroups']), cluster)
-                        for nodegroup in resp_nodegroup['nodegroups']:
-                            if self.dry_run:
-                                self.log_info("Skipping {} nodegroup deletion due to dry-run mode", nodegroup)
-                            else:
-                                self.log_info("Deleting {}", nodegroup)
-                                self.eks_client(region).delete_nodegroup(
-                                    clusterName=cluster, nodegroupName=nodegroup)
-                        self.wait_for_empty_nodegroup_list(region, cluster)
-                    if self.dry_run:
-                        self.log_info("Skipping {} cluster deletion due to dry-run mode", cluster)
-                    else:
-                        self.log_info("Finally deleting {} cluster", cluster)
-                        self.eks_client(region).delete_cluster(name=cluster)
+            self.eks_client(region)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            clusters = list()
+            futures = {executor.submit(self.list_cluster_names, region): region for region in self.cluster_regions}
+            for future in as_completed(futures):
+                region = futures[future]
+                try:
+                    names = future.result()
+                except Exception as ex:
+                    self.log_err("Listing clusters in {} failed: {}", region, ex)
+                    errors.append(ex)
+                    continue
+                if len(names):
+                    self.log_info("Found {} cluster(s) in {}", len(names), region)
+                clusters += [(region, name) for name in names]
+            waiting = self._teardown_step(executor, self.start_cluster_teardown, clusters, outcomes)
+            while waiting:
+                if time.monotonic() + EC2.nodegroup_poll_seconds > deadline:
+                    for region, cluster in waiting:
+                        self.log_err("Nodegroups of {} in {} were not deleted within {} minutes", cluster, region,
+                                     timeout)
+                        outcomes[(region, cluster)] = EC2.TIMED_OUT
+                    break
+                self.log_info("Still waiting for the nodegroups of {} cluster(s) to disappear", len(waiting))
+                time.sleep(EC2.nodegroup_poll_seconds)
+                waiting = self._teardown_step(executor, self.delete_cluster_if_free, waiting, outcomes)
+        self.forget_clusters()
+        errors += [outcome for outcome in outcomes.values() if isinstance(outcome, Exception)]
+        self.log_info("Tore down {} cluster(s), {} failure(s)",
+                      sum(1 for outcome in outcomes.values() if outcome == EC2.DELETED), len(errors))
+        if errors:
+            raise errors[0]
+        return outcomes
+
+    def _teardown_step(self, executor, step, clusters, outcomes):
+        ''' Calls step(region, cluster) for all clusters in parallel, returns the clusters which are still waiting '''
+        futures = {executor.submit(step, region, cluster): (region, cluster) for region, cluster in clusters}
+        waiting = list()
+        for future in as_completed(futures):
+            region, cluster = futures[future]
+            try:
+                outcome = future.result()
+            except Exception as ex:
+                self.log_err("Deleting cluster {} in {} failed: {}", cluster, region, ex)
+                outcome = ex
+            if outcome is None:
+                waiting.append((region, cluster))
+            else:
+                outcomes[(region, cluster)] = outcome
+        return waiting
 
     def parse_image_name(self, img_name):
         regexes = [
@@ -264,136 +518,232 @@ class EC2(Provider):
                                                                            self._namespace)
         cleanup_ec2_max_volumes_age_days = PCWConfig.get_feature_property('cleanup', 'ec2-max-volumes-age-days',
                                                                           self._namespace)
-        self.cleanup_images()
+        resources = [self.images_cleanup()]
         if cleanup_ec2_max_snapshot_age_days >= 0:
-            self.cleanup_snapshots(cleanup_ec2_max_snapshot_age_days)
+            resources.append(self.snapshots_cleanup(cleanup_ec2_max_snapshot_age_days))
         if cleanup_ec2_max_volumes_age_days >= 0:
-            self.cleanup_volumes(cleanup_ec2_max_volumes_age_days)
+            resources.append(self.volumes_cleanup(cleanup_ec2_max_volumes_age_days))
         if PCWConfig.getBoolean('cleanup/vpc_cleanup', self._namespace):
-            self.cleanup_uploader_vpcs()
-
-    def delete_vpc(self, region, vpc, vpcId):
-        try:
-            self.log_info('{} has no associated instances. Initializing cleanup of it', vpc)
-            self.delete_internet_gw(vpc)
-            self.delete_routing_tables(vpc)
-            self.delete_vpc_endpoints(region, vpcId)
-            self.delete_security_groups(vpc)
-            self.delete_vpc_peering_connections(region, vpcId)
-            self.delete_network_acls(vpc)
-            self.delete_vpc_subnets(vpc)
-            if self.dry_run:
-                self.log_info('Deletion of VPC skipped due to dry_run mode')
-            else:
-                # finally, delete the vpc
-                self.ec2_resource(region).meta.client.delete_vpc(VpcId=vpcId)
-        except Exception as e:
-            self.log_err("{} on VPC deletion. {}", type(e).__name__, traceback.format_exc())
-            send_mail('{} on VPC deletion in [{}]'.format(type(e).__name__, self._namespace), traceback.format_exc())
-
-    def delete_vpc_subnets(self, vpc):
-        for subnet in vpc.subnets.all():
-            for interface in subnet.network_interfaces.all():
-                if self.dry_run:
-                    self.log_info('Deletion of {} skipped due to dry_run mode', interface)
-                else:
-                    self.log_info('Deleting {}', interface)
-                    interface.delete()
-            if self.dry_run:
-                self.log_info('Deletion of {} skipped due to dry_run mode', subnet)
-            else:
-                self.log_info('Deleting {}', subnet)
-                subnet.delete()
-
-    def delete_network_acls(self, vpc):
-        for netacl in vpc.network_acls.all():
-            if not netacl.is_default:
-                if self.dry_run:
-                    self.log_info('Deletion of {} skipped due to dry_run mode', netacl)
-                else:
-                    self.log_info('Deleting {}', netacl)
-                    netacl.delete()
-
-    def delete_vpc_peering_connections(self, region, vpcId):
-        response = self.ec2_client(region).describe_vpc_peering_connections(
-            Filters=[{'Name': 'requester-vpc-info.vpc-id', 'Values': [vpcId]}])
-        for vpcpeer in response['VpcPeeringConnections']:
-            vpcpeer_connection = self.ec2_resource(region).VpcPeeringConnection(vpcpeer['VpcPeeringConnectionId'])
-            if self.dry_run:
-                self.log_info('Deletion of {} skipped due to dry_run mode', vpcpeer_connection)
-            else:
-                self.log_info('Deleting {}', vpcpeer_connection)
-                vpcpeer_connection.delete()
-
-    def delete_security_groups(self, vpc):
-        for sg in vpc.security_groups.all():
-            if sg.group_name != 'default':
-                if self.dry_run:
-                    self.log_info('Deletion of {} skipped due to dry_run mode', sg)
-                else:
-                    self.log_info('Deleting {}', sg)
-                    sg.delete()
+            resources.append(self.uploader_vpcs_cleanup())
+        return self.run_cleanup(resources)
+
+    def run_cleanup(self, resources):
+        '''
+        resources is a list of (name, list, delete) tuples. list(region) returns the resources of one region which
+        need to be deleted, delete(region, resource) deletes one of them. delete may return the number of resources
+        it deleted, or would have deleted in dry run mode, if that is not one.
+        All (region, resource type) pairs are listed in parallel. As soon as all resource types of a region are
+        listed, the region is cleaned up: the resource types are deleted one after another in the given order with
+        at most cleanup/ec2-region-deletions concurrent delete calls. Failures are logged and the first one is raised
+        after all regions are done. Returns the wall time in seconds until all regions were listed ('list'), from
+        the start of the first until the end of the last region cleanup ('delete') and of the whole run ('total').
+        '''
+        max_workers = PCWConfig.get_feature_property('cleanup', 'ec2-parallel-tasks', self._namespace)
+        timings = dict()
+        errors = list()
+        plan = {region: list() for region in self.all_regions}
+        unlisted = {region: len(resources) for region in self.all_regions}
+        deletions = list()
+        deleted = 0
+        delete_start = None
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max_workers) as list_executor, \
+                ThreadPoolExecutor(max_workers=max_workers) as delete_executor:
+            futures = {list_executor.submit(list_resources, region): (region, n)
+                       for region in self.all_regions for n, (_, list_resources, _) in enumerate(resources)}
+            for future in as_completed(futures):
+                region, n = futures[future]
+                name, _, delete = resources[n]
+                try:
+                    plan[region].append((n, name, delete, future.result()))
+                except Exception as ex:
+                    self.log_err("Listing {} in {} failed: {}", name, region, ex)
+                    errors.append(ex)
+                unlisted[region] -= 1
+                if unlisted[region] == 0 and any(items for (_, _, _, items) in plan[region]):
+                    delete_start = delete_start or time.monotonic()
+                    deletions.append(delete_executor.submit(self._cleanup_region, region,
+                                                            sorted(plan[region], key=lambda p: p[0])))
+            timings['list'] = time.monotonic() - start
+            candidates = sum(len(items) for region in plan.values() for (_, _, _, items) in region)
+            self.log_info("Listed {} resource(s) to delete in {} region(s) in {:.1f}s", candidates,
+                          len(self.all_regions), timings['list'])
+            for future in as_completed(deletions):
+                region_deleted, region_errors = future.result()
+                deleted += region_deleted
+                errors += region_errors
+        timings['total'] = time.monotonic() - start
+        timings['delete'] = time.monotonic() - delete_start if delete_start else 0.0
+        if self.dry_run:
+            self.log_info("Would delete {} resource(s), skipped due to dry run mode, {} failure(s)", deleted,
+                          len(errors))
+        else:
+            self.log_info("Deleted {} resource(s) in {:.1f}s, {} failure(s)", deleted, timings['delete'], len(errors))
+        if errors:
+            raise errors[0]
+        return timings
+
+    def _cleanup_region(self, region, region_plan):
+        ''' Returns the number of deleted resources and the errors of the failed deletions '''
+        deleted = 0
+        errors = list()
+        max_workers = PCWConfig.get_feature_property('cleanup', 'ec2-region-deletions', self._namespace)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _, name, delete, items in region_plan:
+                futures = [executor.submit(delete, region, item) for item in items]
+                for future in futures:
+                    try:
+                        count = future.result()
+                        deleted += 1 if count is None else count
+                    except Exception as ex:
+                        self.log_err("Deleting {} in {} failed: {}", name, region, ex)
+                        errors.append(ex)
+        return deleted, errors
+
+    def uploader_vpcs(self, region):
+        response = self.ec2_client(region).describe_vpcs(Filters=[{'Name': 'isDefault', 'Values': ['false']},
+                                                                  {'Name': 'tag:Name', 'Values': ['uploader-*']}])
+        return response['Vpcs']
 
-    def delete_vpc_endpoints(self, region, vpcId):
-        response = self.ec2_client(region).describe_vpc_endpoints(Filters=[{'Name': 'vpc-id', 'Values': [vpcId]}])
-        for ep in response['VpcEndpoints']:
-            if self.dry_run:
-                self.log_info('Deletion of {} skipped due to dry_run mode', ep)
-            else:
-                self.log_info('Deleting {}', ep)
-                self.ec2_client(region).delete_vpc_endpoints(VpcEndpointIds=[ep['VpcEndpointId']])
-
-    def delete_routing_tables(self, vpc):
-        for rt in vpc.route_tables.all():
-            # we can not delete main RouteTable's , not main one don't have associations_attributes
-            if len(rt.associations_attribute) == 0:
-                if self.dry_run:
-                    self.log_info('{} will be not deleted due to dry_run mode', rt)
-                else:
-                    self.log_info('Deleting {}', rt)
-                    rt.delete()
+    @staticmethod
+    def vpc_of(kind, item):
+        ''' The id of the VPC which the dependency item of vpc_dependencies belongs to '''
+        if kind == 'internet gateways':
+            return item['Attachments'][0]['VpcId'] if item['Attachments'] else None
+        if kind == 'vpc peering connections':
+            return item['RequesterVpcInfo']['VpcId']
+        return item['VpcId']
 
-    def delete_internet_gw(self, vpc):
-        for gw in vpc.internet_gateways.all():
-            if self.dry_run:
-                self.log_info('{} will be not deleted due to dry_run mode', gw)
-            else:
-                self.log_info('Deleting {}', gw)
-                vpc.detach_internet_gateway(InternetGatewayId=gw.id)
-                gw.delete()
+    @staticmethod
+    def vpc_dependency_deletable(kind, item):
+        if kind == 'route tables':
+            # the main route table is deleted with the VPC, associated ones would fail
+            return len(item['Associations']) == 0
+        if kind == 'security groups':
+            return item['GroupName'] != 'default'
+        if kind == 'network acls':
+            return not item['IsDefault']
+        if kind == 'network interfaces':
+            # e.g. the interfaces of VPC endpoints, they are removed by their owner
+            return not item.get('RequesterManaged')
+        return True
+
+    def describe_by_vpc(self, region, operation, filter_name, vpc_ids, page_size, extra_filters=()):
+        '''
+        Yields the pages of the describe operation for the given VPCs, filter_values_limit VPC ids are passed to a
+        single call. page_size has to be within the MaxResults range of the operation, AWS rejects larger ones.
+        '''
+        paginator = self.ec2_client(region).get_paginator(operation)
+        for n in range(0, len(vpc_ids), EC2.filter_values_limit):
+            filters = [{'Name': filter_name, 'Values': vpc_ids[n:n + EC2.filter_values_limit]}] + list(extra_filters)
+            yield from paginator.paginate(Filters=filters, PaginationConfig={'PageSize': page_size})
+
+    def plan_vpc_deletion(self, region, vpcs):
+        '''
+        Fetches the instances and all dependencies of the given VPCs with one describe call per resource type,
+        page and filter_values_limit VPCs. Returns a VpcPlan holding the VPCs with instances and the deletable
+        dependencies of the others.
+        '''
+        plan = VpcPlan(region, vpcs)
+        vpc_ids = [vpc['VpcId'] for vpc in vpcs]
+        for page in self.describe_by_vpc(region, 'describe_instances', 'vpc-id', vpc_ids, EC2.describe_page_size, [
+                {'Name': 'instance-state-name', 'Values': EC2.listed_instance_states}]):
+            plan.api_calls += 1
+            for reservation in page['Reservations']:
+                plan.locked.update(instance['VpcId'] for instance in reservation['Instances'])
+        for kind, (operation, key, filter_name, page_size) in EC2.vpc_dependencies.items():
+            for page in self.describe_by_vpc(region, operation, filter_name, vpc_ids, page_size):
+                plan.api_calls += 1
+                plan.resources[kind] += [(EC2.vpc_of(kind, item), item) for item in page[key]
+                                         if EC2.vpc_dependency_deletable(kind, item)]
+        plan.resources['vpcs'] = [(vpc['VpcId'], vpc) for vpc in vpcs]
+        subnets = {vpc_id: 0 for vpc_id in vpc_ids}
+        for vpc_id, _ in plan.resources['subnets']:
+            subnets[vpc_id] += 1
+        # walking the boto3 collections of a VPC took eight listings and two more per subnet for its instances
+        # and network interfaces
+        plan.calls_saved = sum(8 + 2 * n for n in subnets.values()) - plan.api_calls
+        return plan
+
+    def delete_vpc_dependency(self, region, kind, item):
+        operation, id_param, id_key = EC2.vpc_deletions[kind]
+        if self.dry_run:
+            self.log_info('Deletion of {} {} skipped due to dry_run mode', kind, item[id_key])
+            return
+        self.log_info('Deleting {} {}', kind, item[id_key])
+        client = self.ec2_client(region)
+        if kind == 'internet gateways':
+            client.detach_internet_gateway(InternetGatewayId=item[id_key], VpcId=EC2.vpc_of(kind, item))
+        # DeleteVpcEndpoints is the only one of them taking a list of ids
+        getattr(client, operation)(**{id_param: [item[id_key]] if kind == 'vpc endpoints' else item[id_key]})
+
+    def delete_vpcs(self, region, plan):
+        '''
+        Deletes the VPCs of the plan which have no instances. Every level of vpc_deletion_levels is deleted after the
+        previous one, the resources of one level are deleted concurrently with at most cleanup/ec2-region-deletions
+        calls. After a failure, the remaining resources of the VPC are kept and a mail is sent. Returns the number of
+        deleted resources.
+        '''
+        max_workers = PCWConfig.get_feature_property('cleanup', 'ec2-region-deletions', self._namespace)
+        deleted = 0
+        failed = dict()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for level in EC2.vpc_deletion_levels:
+                futures = {executor.submit(self.delete_vpc_dependency, region, kind, item): vpc_id
+                           for kind in level for vpc_id, item in plan.resources[kind]
+                           if vpc_id not in plan.locked and vpc_id not in failed}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                        deleted += 1
+                    except Exception as e:
+                        self.log_err("{} on VPC deletion. {}", type(e).__name__, traceback.format_exc())
+                        failed.setdefault(futures[future], (type(e).__name__, traceback.format_exc()))
+        for vpc_id, (error, trace) in failed.items():
+            send_mail('{} on VPC deletion in [{}]'.format(error, self._namespace),
+                      'Deletion of {} in {} failed\n{}'.format(vpc_id, region, trace))
+        return deleted
+
+    def uploader_vpc_plan(self, region):
+        vpcs = self.uploader_vpcs(region)
+        if not vpcs:
+            return []
+        if PCWConfig.getBoolean('cleanup/vpc-notify-only', self._namespace):
+            return [VpcPlan(region, vpcs)]
+        plan = self.plan_vpc_deletion(region, vpcs)
+        self.log_info("Planned deletion of {} VPC(s) in {} with {} describe call(s), {} call(s) saved", len(vpcs),
+                      region, plan.api_calls, plan.calls_saved)
+        return [plan]
+
+    def cleanup_uploader_vpc_plan(self, region, plan):
+        for vpc in plan.vpcs:
+            self.log_info('{} in {} looks like uploader leftover. (OwnerId={}).', vpc['VpcId'], region, vpc['OwnerId'])
+        if PCWConfig.getBoolean('cleanup/vpc-notify-only', self._namespace):
+            for vpc in plan.vpcs:
+                send_mail('VPC {} should be deleted, skipping due vpc-notify-only=True'.format(vpc['VpcId']), '')
+            return 0
+        for vpc in plan.vpcs:
+            if vpc['VpcId'] in plan.locked:
+                self.log_warn('{} has associated instance(s) so can not be deleted', vpc['VpcId'])
+                if not self.dry_run:
+                    body = 'Uploader leftover {} (OwnerId={}) in {} is locked'.format(vpc['VpcId'], vpc['OwnerId'],
+                                                                                      region)
+                    send_mail('VPC deletion locked by running VMs', body)
+        return self.delete_vpcs(region, plan)
 
     def cleanup_uploader_vpcs(self):
-        for region in self.all_regions:
-            response = self.ec2_client(region).describe_vpcs(Filters=[{'Name': 'isDefault', 'Values': ['false']},
-                                                                      {'Name': 'tag:Name', 'Values': ['uploader-*']}])
-            for response_vpc in response['Vpcs']:
-                self.log_info('{} in {} looks like uploader leftover. (OwnerId={}).', response_vpc['VpcId'], region,
-                              response_vpc['OwnerId'])
-                if PCWConfig.getBoolean('cleanup/vpc-notify-only', self._namespace):
-                    send_mail('VPC {} should be deleted, skipping due vpc-notify-only=True'.format(
-                        response_vpc['VpcId']), '')
-                else:
-                    resource_vpc = self.ec2_resource(region).Vpc(response_vpc['VpcId'])
-                    can_be_deleted = True
-                    for subnet in resource_vpc.subnets.all():
-                        if len(list(subnet.instances.all())):
-                            self.log_warn('{} has associated instance(s) so can not be deleted',
-                                          response_vpc['VpcId'])
-                            can_be_deleted = False
-                            break
-                    if can_be_deleted:
-                        self.delete_vpc(region, resource_vpc, response_vpc['VpcId'])
-                    elif not self.dry_run:
-                        body = 'Uploader leftover {} (OwnerId={}) in {} is locked'.format(response_vpc['VpcId'],
-                                                                                          response_vpc['OwnerId'],
-                                                                                          region)
-                        send_mail('VPC deletion locked by running VMs', body)
+        return self.run_cleanup([self.uploader_vpcs_cleanup()])
 
-    def cleanup_images(self):
-        for region in self.all_regions:
-            response = self.ec2_client(region).describe_images(Owners=['self'])
-            images = list()
-            for img in response['Images']:
+    def uploader_vpcs_cleanup(self):
+        # all uploader VPCs of a region are planned and deleted together
+        return ('uploader vpcs', self.uploader_vpc_plan, self.cleanup_uploader_vpc_plan)
+
+    def images_to_delete(self, region):
+        images = list()
+        for page in self.ec2_client(region).get_paginator('describe_images').paginate(
+                Owners=['self'], PaginationConfig={'PageSize': EC2.describe_page_size}):
+            for img in page['Images']:
                 # img is in the format described here:
                 # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.describe_images
                 m = self.parse_image_name(img['Name'])
@@ -404,10 +754,18 @@ class EC2(Provider):
                               img_id=img['ImageId']))
                 else:
                     self.log_err(" Unable to parse image name '{}'", img['Name'])
-            keep_images = self.get_keeping_image_names(images)
-            for img in [i for i in images if i.name not in keep_images]:
-                self.log_dbg("Delete image '{}' (ami:{})".format(img.name, img.id))
-                if self.dry_run:
-                    self.log_info("Image deletion {} skipped due to dry run mode", img.id)
-                else:
-                    self.ec2_client(region).deregister_image(ImageId=img.id, DryRun=False)
+        keep_images = self.get_keeping_image_names(images)
+        return [i for i in images if i.name not in keep_images]
+
+    def delete_image(self, region, img):
+        self.log_dbg("Delete image '{}' (ami:{})".format(img.name, img.id))
+        if self.dry_run:
+            self.log_info("Image deletion {} skipped due to dry run mode", img.id)
+        else:
+            self.ec2_client(region).deregister_image(ImageId=img.id, DryRun=False)
+
+    def cleanup_images(self):
+        return self.run_cleanup([self.images_cleanup()])
+
+    def images_cleanup(self):
+        return ('images', self.images_to_delete, self.delete_image)
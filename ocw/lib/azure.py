@@ -6,6 +6,7 @@ from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.storage import StorageManagementClient
 from azure.storage.blob import BlobServiceClient
 from msrest.exceptions import AuthenticationError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import re
 import time
 from typing import Dict
@@ -13,6 +14,20 @@ from typing import Dict
 
 class Azure(Provider):
     __instances: Dict[str, "Azure"] = dict()
+    # max. number of sub-requests of one blob batch request
+    blob_batch_size = 256
+    # throttled or failed batch sub-requests are retried up to blob_batch_retries times, the first retry waits
+    # blob_batch_backoff seconds and every further one twice as long as the previous
+    blob_batch_retry_status = (429, 500, 503)
+    blob_batch_retries = 3
+    blob_batch_backoff = 2
+    # resource types of the upload resource group which are cleaned up
+    upload_resource_types = {'disk': 'Microsoft.Compute/disks', 'image': 'Microsoft.Compute/images'}
+    # outcomes of delete_from_rg
+    DELETED = 'deleted'
+    PENDING = 'still deleting'
+    IN_USE = 'in use'
+    DRY_RUN = 'skipped due to dry run mode'
 
     def __init__(self, namespace: str):
         super().__init__(namespace)
@@ -85,10 +100,11 @@ class Azure(Provider):
         return [r for r in self.resource_mgmt_client().resource_groups.list()]
 
     def delete_resource(self, resource_id):
+        ''' Starts the deletion of the resource group and returns its poller, None in dry run mode '''
         if self.dry_run:
             self.log_info("Deletion of resource group {} skipped due to dry run mode", resource_id)
-        else:
-            self.resource_mgmt_client().resource_groups.begin_delete(resource_id)
+            return None
+        return self.resource_mgmt_client().resource_groups.begin_delete(resource_id)
 
     def list_images_by_resource_group(self, resource_group):
         return self.list_by_resource_group(resource_group,
@@ -102,7 +118,8 @@ class Azure(Provider):
         return [item for item in self.resource_mgmt_client().resources.list_by_resource_group(
             resource_group, filter=filters)]
 
-    def get_keeping_image_names(self):
+    def sle_images(self):
+        ''' Images in the sle-images container, read with one pass over its blobs '''
         images = list()
         for item in self.container_client('sle-images').list_blobs():
             m = self.parse_image_name(item.name)
@@ -110,34 +127,51 @@ class Azure(Provider):
                 images.append(Image(item.name, flavor=m['key'], build=m['build'], date=item.last_modified))
             else:
                 self.log_err("Unable to parse image name '{}'", item.name)
+        return images
 
-        return super().get_keeping_image_names(images)
+    def get_keeping_image_names(self, images=None):
+        return super().get_keeping_image_names(self.sle_images() if images is None else images)
 
     def cleanup_all(self):
         ''' Cleanup all autodateed data which might created during automated tests.'''
         self.cleanup_bootdiagnostics()
 
-        keep_images = self.get_keeping_image_names()
-        self.cleanup_sle_images_container(keep_images)
-        self.cleanup_disks_from_rg(keep_images)
-        self.cleanup_images_from_rg(keep_images)
+        images = self.sle_images()
+        keep_images = self.get_keeping_image_names(images)
+        self.cleanup_sle_images_container(keep_images, images)
+        resources = self.list_upload_resources()
+        self.delete_from_rg([(kind, name) for kind in ('disk', 'image')
+                             for name in self.rg_deletion_candidates(kind, keep_images, resources)])
         for i in keep_images:
             self.log_info("Keep image {} ", i)
 
     def cleanup_bootdiagnostics(self):
-        containers = self.bs_client().list_containers()
-        for c in containers:
+        ''' Containers are checked in parallel by cleanup/azure-parallel-containers threads. Failures are logged and
+        the first one is raised after all containers are done. '''
+        containers = list()
+        for c in self.bs_client().list_containers():
             self.log_dbg('Found container {}', c.name)
             if (re.match('^bootdiagnostics-', c.name)):
-                self.cleanup_bootdiagnostics_container(c)
+                containers.append(c)
+        errors = list()
+        max_workers = PCWConfig.get_feature_property('cleanup', 'azure-parallel-containers', self._namespace)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.cleanup_bootdiagnostics_container, c): c for c in containers}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as ex:
+                    self.log_err("Cleanup of container {} failed: {}", futures[future].name, ex)
+                    errors.append(ex)
+        if errors:
+            raise errors[0]
 
     def cleanup_bootdiagnostics_container(self, container):
-        latest_modification = container.last_modified
-        container_blobs = self.container_client(container.name).list_blobs()
-        for blob in container_blobs:
-            if (latest_modification > blob.last_modified):
-                latest_modification = blob.last_modified
-        if (self.older_than_min_age(latest_modification)):
+        ''' The container is deleted if it or one of its blobs is older than min-image-age-hours, so the blobs are
+        only listed until the first old one '''
+        expired = self.older_than_min_age(container.last_modified) or any(
+            self.older_than_min_age(blob.last_modified) for blob in self.container_client(container.name).list_blobs())
+        if expired:
             self.log_info("Mark container for deletion {}", container.name)
             if self.dry_run:
                 self.log_info("Deletion of boot diagnostic container {} skipped due to dry run mode", container.name)
@@ -182,44 +216,124 @@ class Azure(Provider):
         ]
         return self.parse_image_name_helper(img_name, regexes)
 
-    def cleanup_sle_images_container(self, keep_images):
-        container_client = self.container_client('sle-images')
-        for img in container_client.list_blobs():
-            m = self.parse_image_name(img.name)
-            if m:
-                self.log_dbg('Blob {} is candidate for deletion with build {} ', img.name, m['build'])
+    def cleanup_sle_images_container(self, keep_images, images=None):
+        ''' images are the result of sle_images(), they are listed again if not given '''
+        to_delete = list()
+        for img in self.sle_images() if images is None else images:
+            self.log_dbg('Blob {} is candidate for deletion with build {} ', img.name, img.build)
+
+            if img.name not in keep_images:
+                self.log_info("Delete blob '{}'", img.name)
+                if self.dry_run:
+                    self.log_info("Deletion of blob image {} skipped due to dry run mode", img.name)
+                else:
+                    to_delete.append(img.name)
+        if to_delete:
+            for name, status in self.delete_blobs('sle-images', to_delete).items():
+                if status == 404:
+                    self.log_warn("Blob {} was already deleted", name)
+                elif status >= 300:
+                    self.log_err("Deletion of blob {} failed with status {}", name, status)
+
+    def delete_blobs(self, container_name, names):
+        ''' Deletes the blobs including their snapshots with one batch request per blob_batch_size names. Returns the
+        HTTP status of the last sub-request of every blob, 202 if it got deleted. '''
+        container_client = self.container_client(container_name)
+        results = dict()
+        for n in range(0, len(names), Azure.blob_batch_size):
+            pending = names[n:n + Azure.blob_batch_size]
+            for retry in range(Azure.blob_batch_retries + 1):
+                if retry:
+                    self.log_info("Retrying deletion of {} blob(s) in {}", len(pending), container_name)
+                    time.sleep(Azure.blob_batch_backoff * 2 ** (retry - 1))
+                responses = container_client.delete_blobs(*pending, delete_snapshots="include",
+                                                          raise_on_any_failure=False)
+                for name, response in zip(pending, responses):
+                    results[name] = response.status_code
+                pending = [name for name in pending if results[name] in Azure.blob_batch_retry_status]
+                if not pending:
+                    break
+        return results
 
-                if img.name not in keep_images:
-                    self.log_info("Delete blob '{}'", img.name)
-                    if self.dry_run:
-                        self.log_info("Deletion of blob image {} skipped due to dry run mode", img.name)
-                    else:
-                        container_client.delete_blob(img.name, delete_snapshots="include")
+    def list_upload_resources(self):
+        ''' Disks and images of the upload resource group, listed with a single call '''
+        types = {t.lower() for t in Azure.upload_resource_types.values()}
+        return [item for item in self.list_by_resource_group(self.__resource_group) if item.type.lower() in types]
 
-    def cleanup_images_from_rg(self, keep_images):
-        for item in self.list_images_by_resource_group(self.__resource_group):
+    def _upload_resources(self, kind, resources):
+        if resources is None:
+            if kind == 'disk':
+                return self.list_disks_by_resource_group(self.__resource_group)
+            return self.list_images_by_resource_group(self.__resource_group)
+        return [item for item in resources if item.type.lower() == Azure.upload_resource_types[kind].lower()]
+
+    def rg_deletion_candidates(self, kind, keep_images, resources=None):
+        ''' Names of the disks or images of the upload resource group which are not kept. resources is the result
+        of list_upload_resources(), they are listed again if not given. '''
+        names = list()
+        for item in self._upload_resources(kind, resources):
             m = self.parse_image_name(item.name)
             if m:
-                self.log_dbg('Image {} is candidate for deletion with build {} ', item.name, m['build'])
+                self.log_dbg('{} {} is candidate for deletion with build {} ', kind.capitalize(), item.name,
+                             m['build'])
                 if item.name not in keep_images:
-                    self.log_info("Delete image '{}'", item.name)
-                    if self.dry_run:
-                        self.log_info("Deletion of image {} skipped due to dry run mode", item.name)
-                    else:
-                        self.compute_mgmt_client().images.begin_delete(self.__resource_group, item.name)
-
-    def cleanup_disks_from_rg(self, keep_images):
-        for item in self.list_disks_by_resource_group(self.__resource_group):
-            m = self.parse_image_name(item.name)
-            if m:
-                self.log_dbg('Disk {} is candidate for deletion with build {} ', item.name, m['build'])
+                    names.append(item.name)
+        return names
 
-                if item.name not in keep_images:
-                    if self.compute_mgmt_client().disks.get(self.__resource_group, item.name).managed_by:
-                        self.log_warn("Disk is in use - unable delete {}", item.name)
-                    else:
-                        self.log_info("Delete disk '{}'", item.name)
-                        if self.dry_run:
-                            self.log_info("Deletion of image {} skipped due to dry run mode", item.name)
-                        else:
-                            self.compute_mgmt_client().disks.begin_delete(self.__resource_group, item.name)
+    def cleanup_images_from_rg(self, keep_images, resources=None):
+        return self.delete_from_rg([('image', name) for name in self.rg_deletion_candidates(
+            'image', keep_images, resources)])
+
+    def cleanup_disks_from_rg(self, keep_images, resources=None):
+        return self.delete_from_rg([('disk', name) for name in self.rg_deletion_candidates(
+            'disk', keep_images, resources)])
+
+    def delete_from_rg(self, resources):
+        '''
+        Deletes the (kind, name) resources of the upload resource group, kind is 'disk' or 'image'. At most
+        cleanup/azure-parallel-deletions deletions are in flight at once, they are waited for until
+        cleanup/azure-delete-timeout seconds after the start. Returns the outcome of every resource, which is one
+        of DELETED, PENDING, IN_USE, DRY_RUN or the exception which prevented the deletion.
+        '''
+        if not resources:
+            return dict()
+        deadline = time.monotonic() + PCWConfig.get_feature_property('cleanup', 'azure-delete-timeout',
+                                                                     self._namespace)
+        # created on this thread, the lazy init is not thread-safe
+        self.compute_mgmt_client()
+        outcomes = dict()
+        max_workers = PCWConfig.get_feature_property('cleanup', 'azure-parallel-deletions', self._namespace)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self._delete_rg_resource, kind, name, deadline): (kind, name)
+                       for kind, name in resources}
+            for future in as_completed(futures):
+                kind, name = futures[future]
+                try:
+                    outcomes[(kind, name)] = future.result()
+                except Exception as ex:
+                    self.log_err("Deletion of {} {} failed: {}", kind, name, ex)
+                    outcomes[(kind, name)] = ex
+        if any(outcome == Azure.PENDING for outcome in outcomes.values()):
+            self.log_warn("Deletion of {} still running after the timeout",
+                          ', '.join('{} {}'.format(*r) for r in resources if outcomes[r] == Azure.PENDING))
+        self.log_info("Deleted {} of {} resource(s) from {}",
+                      sum(1 for outcome in outcomes.values() if outcome == Azure.DELETED), len(resources),
+                      self.__resource_group)
+        return outcomes
+
+    def _delete_rg_resource(self, kind, name, deadline):
+        client = self.compute_mgmt_client().disks if kind == 'disk' else self.compute_mgmt_client().images
+        if kind == 'disk' and client.get(self.__resource_group, name).managed_by:
+            self.log_warn("Disk is in use - unable delete {}", name)
+            return Azure.IN_USE
+        self.log_info("Delete {} '{}'", kind, name)
+        if self.dry_run:
+            self.log_info("Deletion of {} {} skipped due to dry run mode", kind, name)
+            return Azure.DRY_RUN
+        poller = client.begin_delete(self.__resource_group, name)
+        poller.wait(timeout=max(0, deadline - time.monotonic()))
+        if not poller.done():
+            return Azure.PENDING
+        # raises the error of a failed deletion
+        poller.result()
+        return Azure.DELETED
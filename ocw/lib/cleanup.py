@@ -6,7 +6,7 @@ from ocw.lib.emailnotify import send_mail
 from ocw.lib.emailnotify import send_cluster_notification
 import logging
 import traceback
-from ocw.apps import getScheduler
+from ocw.apps import add_measured_job
 
 logger = logging.getLogger(__name__)
 
@@ -44,5 +44,6 @@ def list_clusters():
 
 
 def init_cron():
-    getScheduler().add_job(cleanup_run, trigger='interval', minutes=60, id='cleanup_all', misfire_grace_time=1800)
-    getScheduler().add_job(list_clusters, trigger='interval', hours=18, id='list_clusters', misfire_grace_time=10000)
+    add_measured_job(cleanup_run, 'cleanup', trigger='interval', minutes=60, id='cleanup_all', misfire_grace_time=1800)
+    add_measured_job(list_clusters, 'clusters', trigger='interval', hours=18, id='list_clusters',
+                     misfire_grace_time=10000)
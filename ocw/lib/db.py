@@ -1,12 +1,21 @@
 from webui.settings import PCWConfig
 from ..models import Instance
+from ..models import InstanceTag
 from ..models import StateChoice
 from ..models import ProviderChoice
+from ..models import DataVersion
+from ..models import SyncGeneration
+from ..models import OPENQA_TAG_FIELDS
+from ..models import openqa_tag_values
 from django.db import transaction
-from django.db.models import F
+from django.db import connections
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 import time
 import json
+import hashlib
+import threading
 import dateutil.parser
 from .emailnotify import send_mail, send_leftover_notification
 import traceback
@@ -16,27 +25,65 @@ from .EC2 import EC2
 from .gce import GCE
 from datetime import datetime
 from datetime import timedelta
-from ocw.apps import getScheduler
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from ocw.apps import getScheduler, add_measured_job
 
 logger = logging.getLogger(__name__)
 __running = False
 __last_update = None
+# SQLite allows only one writing transaction at a time and a sync transaction can take longer than the busy timeout
+# of the other writers, so every write of this module holds this lock
+__write_lock = threading.Lock()
+SYNC_UPDATE_FIELDS = ['region', 'first_seen', 'seen_until', 'state', 'csp_info', 'csp_hash', 'active'] + \
+    list(OPENQA_TAG_FIELDS)
+
+
+def sync_csp_to_local_db(pc_instances, provider, namespace, skip_regions=(), fingerprint=None):
+    '''
+    Instances stored for one of skip_regions are left untouched if they are missing in pc_instances. This is
+    used when the listing of a region failed, so its instances must not be marked as DELETED.
+    Only rows which appeared, disappeared or whose fingerprint(csp_info) changed are written, the hash of the
+    fingerprint is stored in csp_hash. Without fingerprint the whole csp_info is compared. last_seen and age of
+    instances which are still there follow from the SyncGeneration of provider and namespace, see InstanceManager.
+    '''
+    # providers are updated in parallel
+    with __write_lock:
+        _sync_csp_to_local_db(pc_instances, provider, namespace, skip_regions, fingerprint or (lambda info: info))
+
+
+def csp_hash(fingerprint):
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
 
 
 @transaction.atomic
-def sync_csp_to_local_db(pc_instances, provider, namespace):
+def _sync_csp_to_local_db(pc_instances, provider, namespace, skip_regions, fingerprint):
     t_now = timezone.now()
-    Instance.objects.filter(provider=provider, vault_namespace=namespace).update(active=False)
+    batch_size = PCWConfig.get_feature_property('updaterun', 'sync_batch_size', namespace)
+    sync, _ = SyncGeneration.objects.get_or_create(provider=provider, vault_namespace=namespace)
+    # instances which are gone now were seen by the previous sync the last time
+    previous_sync = sync.time or t_now
+    existing = {o.instance_id: o for o in Instance.objects.filter(provider=provider, vault_namespace=namespace).
+                only('instance_id', 'first_seen', 'seen_until', 'active', 'state', 'region', 'csp_hash')}
+    seen = set()
+    to_create = dict()
+    to_update = dict()
 
     for i in pc_instances:
         if i.provider != provider:
             raise ValueError('Instance {} does not belong to {}'.format(i, provider))
         if i.vault_namespace != namespace:
             raise ValueError('Instance {} does not belong to {}'.format(i, namespace))
-
-        if Instance.objects.filter(provider=i.provider, instance_id=i.instance_id, vault_namespace=namespace).exists():
+        seen.add(i.instance_id)
+        i_hash = csp_hash(fingerprint(i.csp_info))
+
+        if i.instance_id in existing:
+            o = existing[i.instance_id]
+            if i.instance_id not in to_create and i.instance_id not in to_update and o.active and \
+                    o.seen_until is None and o.state in (StateChoice.ACTIVE, StateChoice.DELETING) and \
+                    o.region == i.region and o.csp_hash == i_hash:
+                continue
             logger.debug("[%s] Update instance %s:%s", namespace, provider, i.instance_id)
-            o = Instance.objects.get(provider=i.provider, instance_id=i.instance_id, vault_namespace=namespace)
             if o.region != i.region:
                 logger.info("[%s] Instance %s:%s changed region from %s to %s",
                             namespace, provider, i.instance_id, o.region, i.region)
@@ -47,6 +94,8 @@ def sync_csp_to_local_db(pc_instances, provider, namespace):
                 o.first_seen = i.first_seen
             if o.state != StateChoice.DELETING:
                 o.state = StateChoice.ACTIVE
+            if i.instance_id not in to_create:
+                to_update[i.instance_id] = o
         else:
             logger.debug("[%s] Create instance %s:%s", namespace, provider, i.instance_id)
             o = Instance(
@@ -58,13 +107,65 @@ def sync_csp_to_local_db(pc_instances, provider, namespace):
                 ttl=i.ttl,
                 region=i.region
             )
-        o.csp_info = i.csp_info
-        o.last_seen = t_now
+            existing[i.instance_id] = to_create[i.instance_id] = o
+        o.set_csp_info(i.csp_info)
+        o.csp_hash = i_hash
+        o.seen_until = None
         o.active = True
-        o.age = o.last_seen - o.first_seen
-        o.save()
-    Instance.objects.filter(provider=provider, vault_namespace=namespace, active=False). \
-        update(state=StateChoice.DELETED)
+
+    Instance.objects.bulk_create(to_create.values(), batch_size=batch_size)
+    Instance.objects.bulk_update(to_update.values(), SYNC_UPDATE_FIELDS, batch_size=batch_size)
+    if any(o.pk is None for o in to_create.values()):
+        # backend can not return the primary keys of bulk inserted rows
+        pks = dict(Instance.objects.filter(provider=provider, vault_namespace=namespace).
+                   values_list('instance_id', 'pk'))
+        for o in to_create.values():
+            o.pk = pks[o.instance_id]
+    _sync_instance_tags(list(to_create.values()), list(to_update.values()), batch_size)
+    gone = [o.pk for o in existing.values() if o.instance_id not in seen and o.region not in skip_regions and
+            (o.active or o.state != StateChoice.DELETED)]
+    for n in range(0, len(gone), batch_size):
+        Instance.objects.filter(pk__in=gone[n:n + batch_size]).update(
+            active=False, state=StateChoice.DELETED, seen_until=Coalesce('seen_until', Value(previous_sync)))
+    if skip_regions:
+        # these were not seen by this sync, so they keep the last_seen of the previous one
+        Instance.objects.filter(provider=provider, vault_namespace=namespace, region__in=skip_regions,
+                                seen_until__isnull=True).update(seen_until=previous_sync)
+    sync.generation += 1
+    sync.time = t_now
+    sync.save()
+    DataVersion.bump()
+
+
+def _tag_strings(instance):
+    tags = instance.tags()
+    if not isinstance(tags, dict):
+        return dict()
+    return {k: '' if v is None else str(v) for k, v in tags.items()}
+
+
+def _sync_instance_tags(created, updated, batch_size):
+    ''' Rewrite the InstanceTag rows of the given instances whose tags differ from the stored ones '''
+    instances = created + updated
+    if not instances:
+        return
+    stored = dict()
+    # created instances have no tags yet and the ones of unchanged instances are not read at all
+    updated_pks = [o.pk for o in updated]
+    for n in range(0, len(updated_pks), batch_size):
+        tag_rows = InstanceTag.objects.filter(instance_id__in=updated_pks[n:n + batch_size])
+        for instance_pk, key, value in tag_rows.values_list('instance_id', 'key', 'value'):
+            stored.setdefault(instance_pk, dict())[key] = value
+    changed = dict()
+    for o in instances:
+        tags = _tag_strings(o)
+        if stored.get(o.pk, dict()) != tags:
+            changed[o.pk] = (o, tags)
+    pks = list(changed)
+    for n in range(0, len(pks), batch_size):
+        InstanceTag.objects.filter(instance_id__in=pks[n:n + batch_size]).delete()
+    InstanceTag.objects.bulk_create([InstanceTag(instance=o, key=k, value=v) for o, tags in changed.values()
+                                     for k, v in tags.items()], batch_size=batch_size)
 
 
 def tag_to_boolean(tag_name, csp_info):
@@ -74,7 +175,7 @@ def tag_to_boolean(tag_name, csp_info):
         return False
 
 
-def ec2_to_json(i):
+def ec2_to_json(i, image_names):
     info = {
         'state': i.state['Name'],
         'image_id': i.image_id,
@@ -90,20 +191,24 @@ def ec2_to_json(i):
     if i.state_reason:
         info['state_reason'] = i.state_reason['Message']
 
-    if i.image:
-        img = i.image
+    if i.image_id:
         info['image'] = {
-            'image_id': img.image_id
+            'image_id': i.image_id
         }
         # This happen, if the image was already deleted
-        if img.meta.data is not None:
-            info['image']['name'] = img.name
+        if image_names.get(i.image_id) is not None:
+            info['image']['name'] = image_names[i.image_id]
 
     return info
 
 
-def ec2_to_local_instance(instance, vault_namespace, region):
-    csp_info = ec2_to_json(instance)
+def ec2_fingerprint(csp_info):
+    ''' The parts of ec2_to_json which change during the life of an instance '''
+    return csp_info.get('state'), csp_info.get('tags'), csp_info.get('launch_time')
+
+
+def ec2_to_local_instance(instance, vault_namespace, region, image_names):
+    csp_info = ec2_to_json(instance, image_names)
     return Instance(
         provider=ProviderChoice.EC2,
         vault_namespace=vault_namespace,
@@ -111,7 +216,8 @@ def ec2_to_local_instance(instance, vault_namespace, region):
         instance_id=instance.instance_id,
         state=StateChoice.ACTIVE,
         region=region,
-        csp_info=json.dumps(csp_info, ensure_ascii=False),
+        csp_info=csp_info,
+        **openqa_tag_values(csp_info['tags']),
         ttl=timedelta(seconds=int(csp_info['tags'].get(
             'openqa_ttl', PCWConfig.get_feature_property('updaterun', 'default_ttl', vault_namespace)))),
         ignore=tag_to_boolean('pcw_ignore', csp_info)
@@ -139,7 +245,8 @@ def azure_to_local_instance(instance, vault_namespace):
         first_seen=dateutil.parser.parse(csp_info.get('launch_time', str(timezone.now()))),
         instance_id=instance.name,
         region=instance.location,
-        csp_info=json.dumps(csp_info, ensure_ascii=False),
+        csp_info=csp_info,
+        **openqa_tag_values(csp_info['tags']),
         ttl=timedelta(seconds=int(csp_info['tags'].get(
             'openqa_ttl', PCWConfig.get_feature_property('updaterun', 'default_ttl', vault_namespace)))),
         ignore=tag_to_boolean('pcw_ignore', csp_info)
@@ -171,13 +278,45 @@ def gce_to_local_instance(instance, vault_namespace):
         first_seen=dateutil.parser.parse(csp_info.get('launch_time', str(timezone.now()))),
         instance_id=instance['id'],
         region=GCE.url_to_name(instance['zone']),
-        csp_info=json.dumps(csp_info, ensure_ascii=False),
+        csp_info=csp_info,
+        **openqa_tag_values(csp_info['tags']),
         ttl=timedelta(seconds=int(csp_info['tags'].get(
             'openqa_ttl', PCWConfig.get_feature_property('updaterun', 'default_ttl', vault_namespace)))),
         ignore=tag_to_boolean('pcw_ignore', csp_info)
     )
 
 
+def _list_ec2_region(ec2, vault_namespace, region):
+    instances_csp = ec2.list_instances(region=region)
+    image_names = ec2.get_image_names(region, {i.image_id for i in instances_csp if i.image_id})
+    return [ec2_to_local_instance(i, vault_namespace, region, image_names) for i in instances_csp]
+
+
+def _update_ec2(vault_namespace):
+    instances = []
+    errors = dict()
+    ec2 = EC2(vault_namespace)
+    max_workers = PCWConfig.get_feature_property('default', 'ec2_parallel_regions', vault_namespace)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_list_ec2_region, ec2, vault_namespace, region): region
+                   for region in ec2.all_regions}
+        for future in as_completed(futures):
+            region = futures[future]
+            try:
+                region_instances = future.result()
+            except Exception:
+                logger.exception("[%s] Listing EC2 instances failed in region %s", vault_namespace, region)
+                errors[region] = traceback.format_exc()
+            else:
+                logger.info("Got %d instances from EC2 in region %s", len(region_instances), region)
+                instances += region_instances
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, vault_namespace, skip_regions=list(errors),
+                         fingerprint=ec2_fingerprint)
+    if errors:
+        raise RuntimeError("Listing EC2 instances failed in region(s) {}\n{}".format(
+            ', '.join(sorted(errors)), "\n{}\n".format('#'*79).join(errors.values())))
+
+
 def _update_provider(name, vault_namespace):
     if 'azure' in name:
         instances = Azure(vault_namespace).list_resource_groups()
@@ -186,12 +325,7 @@ def _update_provider(name, vault_namespace):
         sync_csp_to_local_db(instances, ProviderChoice.AZURE, vault_namespace)
 
     if 'ec2' in name:
-        instances = []
-        for region in EC2(vault_namespace).all_regions:
-            instances_csp = EC2(vault_namespace).list_instances(region=region)
-            instances += [ec2_to_local_instance(i, vault_namespace, region) for i in instances_csp]
-            logger.info("Got %d instances from EC2 in region %s", len(instances), region)
-        sync_csp_to_local_db(instances, ProviderChoice.EC2, vault_namespace)
+        _update_ec2(vault_namespace)
 
     if 'gce' in name:
         instances = GCE(vault_namespace).list_all_instances()
@@ -200,36 +334,50 @@ def _update_provider(name, vault_namespace):
         sync_csp_to_local_db(instances, ProviderChoice.GCE, vault_namespace)
 
 
+def _update_provider_with_retries(provider, namespace):
+    '''
+    Runs within a worker thread of update_run. Failed attempts are retried with exponential backoff, which only
+    delays this (namespace, provider) pair. Returns False if all attempts failed.
+    '''
+    max_retries = 3
+    backoff = PCWConfig.get_feature_property('updaterun', 'retry_backoff_seconds', namespace)
+    email_text = set()
+    logger.info("[%s] Check provider %s", namespace, provider)
+    try:
+        for n in range(max_retries):
+            try:
+                _update_provider(provider, namespace)
+                return True
+            except Exception:
+                logger.exception("[%s] Update failed for %s", namespace, provider)
+                email_text.add(traceback.format_exc())
+                if n + 1 < max_retries:
+                    time.sleep(backoff * 2 ** n)
+        send_mail('Error on update {} in namespace {}'.format(provider, namespace),
+                  "\n{}\n".format('#'*79).join(email_text))
+        return False
+    finally:
+        # django opens one DB connection per thread, which would be leaked by the worker thread otherwise
+        connections.close_all()
+
+
 def update_run():
     '''
     Each update is using Instance.active to mark the model is still availalbe on CSP.
     Instance.state is used to reflect the "local" state, e.g. if someone triggered a delete, the
     state will moved to DELETING. If the instance is gone from CSP, the state will set to DELETED.
+    Every (namespace, provider) pair is updated as independent task, so the update takes as long as the
+    slowest provider instead of the sum of all of them.
     '''
     global __running, __last_update
     __running = True
-    max_retries = 3
-    error_occured = False
-    for namespace in PCWConfig.get_namespaces_for('default'):
-        for provider in PCWConfig.get_providers_for('default', namespace):
-            logger.info("[%s] Check provider %s", namespace, provider)
-            email_text = set()
-            for n in range(max_retries):
-                try:
-                    _update_provider(provider, namespace)
-                except Exception:
-                    logger.exception("[%s] Update failed for %s", namespace, provider)
-                    email_text.add(traceback.format_exc())
-                    time.sleep(5)
-                else:
-                    break
-            else:
-                error_occured = True
-                send_mail('Error on update {} in namespace {}'.format(provider, namespace),
-                          "\n{}\n".format('#'*79).join(email_text))
+    tasks = [(provider, namespace) for namespace in PCWConfig.get_namespaces_for('default')
+             for provider in PCWConfig.get_providers_for('default', namespace)]
+    with ThreadPoolExecutor(max_workers=PCWConfig.get_feature_property('updaterun', 'parallel_updates')) as executor:
+        results = list(executor.map(lambda task: _update_provider_with_retries(*task), tasks))
+    error_occured = not all(results)
 
-    auto_delete_instances()
-    send_leftover_notification()
+    start_auto_delete()
     __running = False
     if not error_occured:
         __last_update = datetime.now(timezone.utc)
@@ -238,10 +386,18 @@ def update_run():
         init_cron()
 
 
+def mark_notified(instances):
+    ''' Sets notified of the given instances, for send_leftover_notification which must not write unlocked '''
+    with __write_lock:
+        if instances.filter(notified=False).update(notified=True):
+            DataVersion.bump()
+
+
 def delete_instance(instance):
     logger.debug("[%s] Delete instance %s:%s", instance.vault_namespace, instance.provider, instance.instance_id)
+    poller = None
     if (instance.provider == ProviderChoice.AZURE):
-        Azure(instance.vault_namespace).delete_resource(instance.instance_id)
+        poller = Azure(instance.vault_namespace).delete_resource(instance.instance_id)
     elif (instance.provider == ProviderChoice.EC2):
         EC2(instance.vault_namespace).delete_instance(instance.region, instance.instance_id)
     elif (instance.provider == ProviderChoice.GCE):
@@ -250,29 +406,226 @@ def delete_instance(instance):
         raise NotImplementedError(
             "Provider({}).delete() isn't implemented".format(instance.provider))
 
-    instance.state = StateChoice.DELETING
-    instance.save()
+    with __write_lock:
+        instance.state = StateChoice.DELETING
+        instance.save()
+        DataVersion.bump()
+    if poller is not None:
+        deletion_tracker.track(instance, poller)
 
 
-def auto_delete_instances():
-    for namespace in PCWConfig.get_namespaces_for('default'):
-        o = Instance.objects
-        o = o.filter(state=StateChoice.ACTIVE, vault_namespace=namespace, ttl__gt=timedelta(0),
-                     age__gte=F('ttl')).exclude(csp_info__icontains='pcw_ignore')
-        email_text = set()
-        for i in o:
-            logger.info("[%s] TTL expire for instance %s:%s %s", i.vault_namespace,
-                        i.provider, i.instance_id, i.all_time_fields())
+class DeletionTracker:
+    '''
+    Keeps the pollers of running deletions, so poll_deletions() can update the state of the instances as soon as
+    their deletion finished instead of waiting for the next update run to miss them
+    '''
+
+    def __init__(self):
+        self.__pollers = dict()
+        self.__lock = threading.Lock()
+
+    def track(self, instance, poller):
+        with self.__lock:
+            self.__pollers[instance.pk] = (instance, poller)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__pollers)
+
+    def finished(self):
+        ''' Removes the finished deletions and returns (instance, error) for each of them, error is None if the
+        deletion succeeded '''
+        with self.__lock:
+            tracked = list(self.__pollers.items())
+        finished = list()
+        for pk, (instance, poller) in tracked:
+            if not poller.done():
+                continue
             try:
-                delete_instance(i)
+                poller.result()
+                finished.append((instance, None))
             except Exception:
-                msg = "[{}] Deleting instance ({}:{}) failed".format(i.vault_namespace, i.provider, i.instance_id)
-                logger.exception(msg)
-                email_text.add("{}\n\n{}".format(msg, traceback.format_exc()))
+                finished.append((instance, traceback.format_exc()))
+            with self.__lock:
+                del self.__pollers[pk]
+        return finished
+
+
+deletion_tracker = DeletionTracker()
+
+
+def poll_deletions():
+    ''' Moves instances whose tracked deletion finished to DELETED. Instances whose deletion failed go back to ACTIVE,
+    so the next auto delete run tries again, and are reported with one email. '''
+    finished = deletion_tracker.finished()
+    if not finished:
+        return
+    deleted = [instance.pk for instance, error in finished if error is None]
+    failed = [(instance, error) for instance, error in finished if error is not None]
+    for instance, _ in finished:
+        logger.info("[%s] Deletion of instance %s:%s %s", instance.vault_namespace, instance.provider,
+                    instance.instance_id, 'finished' if instance.pk in deleted else 'failed')
+    with __write_lock:
+        Instance.objects.filter(pk__in=deleted).update(
+            state=StateChoice.DELETED, active=False, seen_until=Coalesce('seen_until', Value(timezone.now())))
+        Instance.objects.filter(pk__in=[instance.pk for instance, _ in failed], state=StateChoice.DELETING).update(
+            state=StateChoice.ACTIVE)
+        DataVersion.bump()
+    if failed:
+        email_text = ["[{}] Deleting instance ({}:{}) failed\n\n{}".format(
+            instance.vault_namespace, instance.provider, instance.instance_id, error) for instance, error in failed]
+        send_mail('Error on deleting {} instance(s)'.format(len(failed)), "\n{}\n".format('#'*79).join(email_text))
+
+
+class RateLimiter:
+    ''' Spaces out the returns of wait(), so at most rate calls per second pass it '''
+
+    def __init__(self, rate):
+        self.__interval = 1.0 / rate if rate > 0 else 0.0
+        self.__next = 0.0
+        self.__lock = threading.Lock()
+
+    def wait(self):
+        with self.__lock:
+            now = time.monotonic()
+            start = max(now, self.__next)
+            self.__next = start + self.__interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _auto_delete_tasks(instances, pollers):
+    '''
+    Groups the instances by the API call which deletes them. Yields (provider, instances, delete) tuples, all EC2
+    instances of one region are terminated by the same call. If the provider of a namespace can not be created,
+    delete() of its batches raises that error. The (instance, poller) pairs of started Azure deletions are appended
+    to pollers.
+    '''
+    providers = dict()
+    ec2_batches = dict()
+
+    def task(cls, namespace, delete, *args):
+        if (cls, namespace) not in providers:
+            try:
+                providers[(cls, namespace)] = (cls(namespace), None)
+            except Exception as ex:
+                logger.exception("[%s] Creating %s failed", namespace, cls.__name__)
+                providers[(cls, namespace)] = (None, ex)
+        provider, error = providers[(cls, namespace)]
+        if error is not None:
+            return partial(_raise, error)
+        return partial(delete, provider, *args)
+
+    for i in instances:
+        if i.provider == ProviderChoice.EC2:
+            ec2_batches.setdefault((i.vault_namespace, i.region), []).append(i)
+        elif i.provider == ProviderChoice.AZURE:
+            yield 'azure', [i], task(Azure, i.vault_namespace, _delete_azure_instance, i, pollers)
+        elif i.provider == ProviderChoice.GCE:
+            yield 'gce', [i], task(GCE, i.vault_namespace, GCE.delete_instance, i.instance_id, i.region)
+        else:
+            raise NotImplementedError("Provider({}).delete() isn't implemented".format(i.provider))
+    for (namespace, region), batch in ec2_batches.items():
+        yield 'ec2', batch, task(EC2, namespace, _delete_ec2_instances, region, [i.instance_id for i in batch])
+
+
+def _raise(error):
+    raise error
+
+
+def _delete_azure_instance(azure, instance, pollers):
+    poller = azure.delete_resource(instance.instance_id)
+    if poller is not None:
+        pollers.append((instance, poller))
+
+
+def _delete_ec2_instances(ec2, region, instance_ids):
+    outcomes = ec2.delete_instances(region, instance_ids)
+    return {instance_id: str(outcome) for instance_id, outcome in outcomes.items() if isinstance(outcome, Exception)}
+
+
+def _run_delete_task(limiter, delete, batch):
+    '''
+    Runs within a worker thread of auto_delete_instances. Returns the error of every instance of batch which could
+    not be deleted, delete() itself may return such a dict if it can fail for single instances.
+    '''
+    limiter.wait()
+    try:
+        return delete() or dict()
+    except Exception:
+        return dict.fromkeys([i.instance_id for i in batch], traceback.format_exc())
+
+
+def auto_delete_instances():
+    '''
+    Deletes all instances whose TTL expired. Every provider has its own worker pool which limits the number of
+    concurrent delete calls (autodelete/<provider>-workers) and the calls started per second
+    (autodelete/<provider>-rate). All failures are reported with one email.
+    '''
+    expired = list(Instance.objects.filter(
+        state=StateChoice.ACTIVE, vault_namespace__in=PCWConfig.get_namespaces_for('default'),
+        ttl__gt=timedelta(0), age__gte=F('ttl')).exclude(instance_tags__key='pcw_ignore'))
+    for i in expired:
+        logger.info("[%s] TTL expire for instance %s:%s %s", i.vault_namespace,
+                    i.provider, i.instance_id, i.all_time_fields())
+    executors = dict()
+    limiters = dict()
+    futures = dict()
+    deleted = []
+    pollers = []
+    email_text = []
+    try:
+        for provider, batch, delete in _auto_delete_tasks(expired, pollers):
+            if provider not in executors:
+                executors[provider] = ThreadPoolExecutor(
+                    max_workers=PCWConfig.get_feature_property('autodelete', provider + '-workers'))
+                limiters[provider] = RateLimiter(PCWConfig.get_feature_property('autodelete', provider + '-rate'))
+            futures[executors[provider].submit(_run_delete_task, limiters[provider], delete, batch)] = batch
+        for future in as_completed(futures):
+            batch = futures[future]
+            errors = future.result()
+            deleted += [i for i in batch if i.instance_id not in errors]
+            failed = dict()
+            for instance_id, error in errors.items():
+                failed.setdefault(error, []).append(instance_id)
+            for error, instance_ids in failed.items():
+                msg = "[{}] Deleting instance(s) ({}:{}) failed".format(
+                    batch[0].vault_namespace, batch[0].provider, ', '.join(sorted(instance_ids)))
+                logger.error("%s\n%s", msg, error)
+                email_text.append("{}\n\n{}".format(msg, error))
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+    batch_size = PCWConfig.get_feature_property('updaterun', 'sync_batch_size')
+    with __write_lock:
+        for n in range(0, len(deleted), batch_size):
+            Instance.objects.filter(pk__in=[i.pk for i in deleted[n:n + batch_size]],
+                                    state=StateChoice.ACTIVE).update(state=StateChoice.DELETING)
+        if deleted:
+            DataVersion.bump()
+    # only tracked once they are DELETING, otherwise poll_deletions could reset a failed deletion to ACTIVE before
+    # the update above and the instance would stay DELETING forever
+    for instance, poller in pollers:
+        deletion_tracker.track(instance, poller)
+    if email_text:
+        send_mail('Error on auto deleting {} of {} instance(s)'.format(len(expired) - len(deleted), len(expired)),
+                  "\n{}\n".format('#'*79).join(email_text))
+
+
+def auto_delete_and_notify():
+    # instances which are deleted right now are no leftovers
+    auto_delete_instances()
+    send_leftover_notification()
+
 
-        if len(email_text) > 0:
-            send_mail('[{}] Error on auto deleting instance(s)'.format(namespace),
-                      "\n{}\n".format('#'*79).join(email_text))
+def start_auto_delete():
+    if not getScheduler().running:
+        # e.g. manage.py updaterun, nobody would run the job
+        auto_delete_and_notify()
+        return
+    # own job on its own executor, so deleting many instances does not delay the next update run
+    add_measured_job(auto_delete_and_notify, 'delete', trigger='date', id='auto_delete', replace_existing=True)
 
 
 def is_updating():
@@ -292,4 +645,6 @@ def start_update():
 
 
 def init_cron():
-    getScheduler().add_job(update_run, trigger='interval', minutes=5, id='update_db')
+    add_measured_job(update_run, 'update', trigger='interval', minutes=5, id='update_db')
+    add_measured_job(poll_deletions, 'default', trigger='interval',
+                     seconds=PCWConfig.get_feature_property('autodelete', 'poll-seconds'), id='poll_deletions')
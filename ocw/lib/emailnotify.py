@@ -4,7 +4,6 @@ from ..models import Instance
 from datetime import timedelta
 from texttable import Texttable
 from django.urls import reverse
-import json
 import smtplib
 import logging
 from email.mime.text import MIMEText
@@ -19,13 +18,10 @@ def draw_instance_table(objects):
     table.set_deco(Texttable.HEADER)
     table.header(['Provider', 'id', 'Created-By', 'Namespace', 'Age', 'Delete', 'openQA'])
     for i in objects:
-        j = json.loads(i.csp_info)
         hours, remainder = divmod(i.age.total_seconds(), 3600)
         minutes, seconds = divmod(remainder, 60)
         link = i.get_openqa_job_link()
-        created_by = 'N/A'
-        if 'openqa_created_by' in j['tags']:
-            created_by = j['tags']['openqa_created_by']
+        created_by = i.openqa_created_by or 'N/A'
         table.add_row([
             i.provider,
             i.instance_id,
@@ -42,7 +38,7 @@ def send_leftover_notification():
     if PCWConfig.has('notify'):
         o = Instance.objects
         o = o.filter(active=True, age__gt=timedelta(hours=PCWConfig.get_feature_property(
-            'notify', 'age-hours'))).exclude(csp_info__icontains='pcw_ignore')
+            'notify', 'age-hours'))).exclude(instance_tags__key='pcw_ignore')
         body_prefix = "Message from {url}\n\n".format(url=build_absolute_uri())
         # Handle namespaces
         for namespace in PCWConfig.get_namespaces_for('notify'):
@@ -51,7 +47,8 @@ def send_leftover_notification():
             if namespace_objects.filter(notified=False).count() > 0 and receiver_email:
                 send_mail('CSP left overs - {}'.format(namespace),
                           body_prefix + draw_instance_table(namespace_objects), receiver_email=receiver_email)
-        o.update(notified=True)
+        from ocw.lib.db import mark_notified
+        mark_notified(o)
 
 
 def send_cluster_notification(namespace, clusters):
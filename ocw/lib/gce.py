@@ -1,29 +1,41 @@
 from .provider import Provider, Image
+from webui.settings import PCWConfig
 import googleapiclient.discovery
+from googleapiclient.errors import HttpError
 from google.oauth2 import service_account
 from dateutil.parser import parse
 import re
+import threading
+import time
 
 
 class GCE(Provider):
     __instances = dict()
+    # requests per batch HTTP request, the API accepts up to 1000
+    batch_size = 500
+    # seconds between two polls of running operations
+    operation_poll_seconds = 2
+    # outcomes of delete_images
+    DELETED = "deleted"
+    PENDING = "still deleting"
 
     def __new__(cls, vault_namespace):
         if vault_namespace not in GCE.__instances:
             GCE.__instances[vault_namespace] = self = object.__new__(cls)
-            self.__compute_client = None
+            # the httplib2 transport of a client is not thread-safe, so every thread builds its own client
+            self.__local = threading.local()
             self.__project = None
         return GCE.__instances[vault_namespace]
 
     def compute_client(self):
         self.private_key_data = self.getData()
         self.__project = self.private_key_data["project_id"]
-        if self.__compute_client is None:
+        if getattr(self.__local, "compute_client", None) is None:
             credentials = service_account.Credentials.from_service_account_info(self.private_key_data)
-            self.__compute_client = googleapiclient.discovery.build(
+            self.__local.compute_client = googleapiclient.discovery.build(
                 "compute", "v1", credentials=credentials, cache_discovery=False
             )
-        return self.__compute_client
+        return self.__local.compute_client
 
     def list_instances(self, zone):
         """ List all instances by zone."""
@@ -42,7 +54,31 @@ class GCE(Provider):
             )
         return result
 
+    def list_aggregated_instances(self):
+        """ List instances of all zones with one paginated aggregatedList walk.
+        @see https://cloud.google.com/compute/docs/reference/rest/v1/instances/aggregatedList"""
+        result = []
+        request = (
+            self.compute_client().instances().aggregatedList(project=self.__project)
+        )
+        while request is not None:
+            response = request.execute()
+            for scope in response.get("items", {}).values():
+                result += scope.get("instances", [])
+            request = (
+                self.compute_client()
+                .instances()
+                .aggregatedList_next(previous_request=request, previous_response=response)
+            )
+        return result
+
     def list_all_instances(self):
+        try:
+            return self.list_aggregated_instances()
+        except HttpError as err:
+            if err.resp.status != 403:
+                raise err
+            self.log_warn("instances().aggregatedList is not allowed, walking through all zones")
         result = []
         for region in self.list_regions():
             for zone in self.list_zones(region):
@@ -182,6 +218,7 @@ class GCE(Provider):
 
         keep_images = self.get_keeping_image_names(images)
 
+        to_delete = list()
         for img in [i for i in images if i.name not in keep_images]:
             self.log_info("Delete image '{}'", img.name)
             if self.dry_run:
@@ -189,15 +226,67 @@ class GCE(Provider):
                     "Deletion of image {} skipped due to dry run mode", img.name
                 )
             else:
-                request = (
-                    self.compute_client()
-                    .images()
-                    .delete(project=self.__project, image=img.name)
-                )
-                response = request.execute()
-                if "error" in response:
-                    for e in response["error"]["errors"]:
-                        self.log_err(e["message"])
-                if "warnings" in response:
-                    for w in response["warnings"]:
+                to_delete.append(img.name)
+        if to_delete:
+            outcomes = self.delete_images(to_delete)
+            self.log_info(
+                "Deleted {} of {} image(s)",
+                sum(1 for outcome in outcomes.values() if outcome == GCE.DELETED),
+                len(to_delete),
+            )
+            for name, outcome in outcomes.items():
+                if outcome == GCE.PENDING:
+                    self.log_warn("Deletion of image {} is still running", name)
+                elif outcome != GCE.DELETED:
+                    self.log_err("Deletion of image {} failed: {}", name, outcome)
+
+    def execute_batch(self, requests):
+        """ Executes the requests of the {request_id: request} dict with one batch HTTP request per batch_size
+        requests. Returns {request_id: response}, the response is the HttpError of a failed request."""
+        results = dict()
+
+        def callback(request_id, response, exception):
+            results[request_id] = response if exception is None else exception
+
+        request_ids = list(requests)
+        for n in range(0, len(request_ids), GCE.batch_size):
+            batch = self.compute_client().new_batch_http_request(callback=callback)
+            for request_id in request_ids[n:n + GCE.batch_size]:
+                batch.add(requests[request_id], request_id=request_id)
+            batch.execute()
+        return results
+
+    def delete_images(self, names):
+        """ Deletes the images with batch requests and polls their global operations with batch requests until they
+        are done, at most cleanup/gce-operation-timeout seconds. Returns the outcome of every image, which is one of
+        DELETED, PENDING or the error message."""
+        deadline = time.monotonic() + PCWConfig.get_feature_property(
+            "cleanup", "gce-operation-timeout", self._namespace
+        )
+        outcomes = dict()
+        responses = self.execute_batch(
+            {name: self.compute_client().images().delete(project=self.__project, image=name) for name in names}
+        )
+        while True:
+            operations = dict()
+            for name, operation in responses.items():
+                if isinstance(operation, Exception):
+                    outcomes[name] = str(operation)
+                elif operation.get("status") != "DONE":
+                    operations[name] = operation["name"]
+                else:
+                    for w in operation.get("warnings", []):
                         self.log_warn(w["message"])
+                    errors = [e["message"] for e in operation.get("error", {}).get("errors", [])]
+                    outcomes[name] = "; ".join(errors) if errors else GCE.DELETED
+            if not operations or time.monotonic() >= deadline:
+                break
+            time.sleep(GCE.operation_poll_seconds)
+            responses = self.execute_batch(
+                {
+                    name: self.compute_client().globalOperations().get(project=self.__project, operation=operation)
+                    for name, operation in operations.items()
+                }
+            )
+        outcomes.update(dict.fromkeys(operations, GCE.PENDING))
+        return outcomes
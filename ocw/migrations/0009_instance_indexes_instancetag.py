@@ -0,0 +1,67 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:11
+
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+def fill_instance_tags(apps, schema_editor):
+    Instance = apps.get_model('ocw', 'Instance')
+    InstanceTag = apps.get_model('ocw', 'InstanceTag')
+    tags = []
+    for pk, csp_info in Instance.objects.values_list('pk', 'csp_info').iterator():
+        try:
+            info_tags = json.loads(csp_info).get('tags', {})
+        except (json.JSONDecodeError, AttributeError):
+            continue
+        if isinstance(info_tags, dict):
+            tags += [InstanceTag(instance_id=pk, key=k, value='' if v is None else str(v)) for k, v in info_tags.items()]
+    InstanceTag.objects.bulk_create(tags, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocw', '0008_instance_ignore'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InstanceTag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=512)),
+                ('value', models.TextField(default='')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['provider', 'vault_namespace'], name='instance_sync_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['state', 'vault_namespace', 'age'], name='instance_ttl_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['vault_namespace', 'age', 'active'], name='instance_leftover_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['state', 'ignore'], name='instance_filter_idx'),
+        ),
+        migrations.AddField(
+            model_name='instancetag',
+            name='instance',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='instance_tags', to='ocw.instance'),
+        ),
+        migrations.AddIndex(
+            model_name='instancetag',
+            index=models.Index(fields=['key', 'value'], name='instancetag_key_value_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='instancetag',
+            unique_together={('instance', 'key')},
+        ),
+        migrations.RunPython(fill_instance_tags, migrations.RunPython.noop),
+    ]
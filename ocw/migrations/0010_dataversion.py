@@ -0,0 +1,28 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def create_data_version(apps, schema_editor):
+    DataVersion = apps.get_model('ocw', 'DataVersion')
+    DataVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocw', '0009_instance_indexes_instancetag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+                ('modified', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.RunPython(create_data_version, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:19
+
+from django.db import migrations, models
+import json
+import ocw.models
+
+
+def normalize_csp_info(apps, schema_editor):
+    ''' Replace csp_info which isn't valid JSON and copy the openQA tags to their new columns '''
+    Instance = apps.get_model('ocw', 'Instance')
+    fields = {'openqa_created_by': 'openqa_created_by', 'openqa_var_job_id': 'openqa_var_JOB_ID',
+              'openqa_var_name': 'openqa_var_NAME'}
+    instances = []
+    for instance in Instance.objects.only('pk', 'csp_info').iterator():
+        try:
+            info = json.loads(instance.csp_info)
+        except json.JSONDecodeError:
+            info = {}
+            instance.csp_info = '{}'
+        tags = info.get('tags') if isinstance(info, dict) else None
+        tags = tags if isinstance(tags, dict) else {}
+        for field, tag in fields.items():
+            setattr(instance, field, '' if tags.get(tag) is None else str(tags[tag])[:256])
+        instances.append(instance)
+    Instance.objects.bulk_update(instances, ['csp_info'] + list(fields), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocw', '0010_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='instance',
+            name='openqa_created_by',
+            field=models.CharField(db_index=True, default='', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='openqa_var_job_id',
+            field=models.CharField(db_index=True, default='', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='openqa_var_name',
+            field=models.CharField(db_index=True, default='', max_length=256),
+        ),
+        migrations.RunPython(normalize_csp_info, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='instance',
+            name='csp_info',
+            field=models.JSONField(default=dict, encoder=ocw.models.CspInfoEncoder),
+        ),
+    ]
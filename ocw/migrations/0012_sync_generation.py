@@ -0,0 +1,100 @@
+# Generated by Django 4.0.6 on 2026-10-18 19:29
+
+from django.db import migrations, models
+from django.db.models import Max
+from django.utils import timezone
+
+
+def fill_seen_until(apps, schema_editor):
+    ''' Only instances which were missing in the last sync keep their last_seen, for all others it is derived from
+    the time of the last sync '''
+    Instance = apps.get_model('ocw', 'Instance')
+    SyncGeneration = apps.get_model('ocw', 'SyncGeneration')
+    last_syncs = Instance.objects.filter(active=True).values('provider', 'vault_namespace').annotate(
+        time=Max('last_seen'))
+    SyncGeneration.objects.bulk_create([SyncGeneration(generation=1, **sync) for sync in last_syncs])
+    Instance.objects.filter(active=False).update(seen_until=models.F('last_seen'))
+
+
+def fill_last_seen(apps, schema_editor):
+    Instance = apps.get_model('ocw', 'Instance')
+    SyncGeneration = apps.get_model('ocw', 'SyncGeneration')
+    now = timezone.now()
+    sync_times = {(s.provider, s.vault_namespace): s.time for s in SyncGeneration.objects.all()}
+    instances = []
+    for instance in Instance.objects.only('pk', 'provider', 'vault_namespace', 'first_seen', 'seen_until').iterator():
+        instance.last_seen = instance.seen_until or sync_times.get(
+            (instance.provider, instance.vault_namespace)) or now
+        instance.age = instance.last_seen - instance.first_seen
+        instances.append(instance)
+    Instance.objects.bulk_update(instances, ['last_seen', 'age'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ocw', '0011_instance_csp_info_json'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('provider', models.CharField(choices=[('GCE', 'Google'), ('EC2', 'EC2'), ('AZURE', 'Azure')], max_length=8)),
+                ('vault_namespace', models.CharField(default='', max_length=64)),
+                ('generation', models.PositiveIntegerField(default=0)),
+                ('time', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='csp_hash',
+            field=models.CharField(default='', help_text='Hash of the csp_info fingerprint of the last sync', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='seen_until',
+            field=models.DateTimeField(help_text='Last sync which saw this instance, only set if it is missing in the latest sync of its provider and namespace', null=True),
+        ),
+        # nullable, so the columns can be added back and filled by fill_last_seen when migrating backwards
+        migrations.AlterField(
+            model_name='instance',
+            name='age',
+            field=models.DurationField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='instance',
+            name='last_seen',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fill_seen_until, fill_last_seen),
+        migrations.RemoveIndex(
+            model_name='instance',
+            name='instance_ttl_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='instance',
+            name='instance_leftover_idx',
+        ),
+        migrations.RemoveField(
+            model_name='instance',
+            name='age',
+        ),
+        migrations.RemoveField(
+            model_name='instance',
+            name='last_seen',
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['state', 'vault_namespace'], name='instance_ttl_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='instance',
+            index=models.Index(fields=['vault_namespace', 'active'], name='instance_leftover_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='syncgeneration',
+            unique_together={('provider', 'vault_namespace')},
+        ),
+    ]
@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 from enum import Enum
 from datetime import timedelta
 from webui.settings import PCWConfig
@@ -44,11 +46,59 @@ def format_seconds(seconds):
     return '{:.0f}m'.format(minutes)
 
 
+# Instance fields which are a copy of a tag in csp_info
+OPENQA_TAG_FIELDS = {
+    'openqa_created_by': 'openqa_created_by',
+    'openqa_var_job_id': 'openqa_var_JOB_ID',
+    'openqa_var_name': 'openqa_var_NAME',
+}
+
+
+def openqa_tag_values(tags):
+    return {field: '' if tags.get(tag) is None else str(tags[tag])[:256] for field, tag in OPENQA_TAG_FIELDS.items()}
+
+
+class CspInfoEncoder(json.JSONEncoder):
+    ''' Keeps non-ASCII characters of csp_info as they are, so the text filters on csp_info still match them '''
+
+    def __init__(self, *args, **kwargs):
+        kwargs['ensure_ascii'] = False
+        super().__init__(*args, **kwargs)
+
+
+class SyncGeneration(models.Model):
+    ''' Counts the syncs of one (provider, namespace) pair, time is when the last one finished '''
+    provider = models.CharField(max_length=8, choices=ProviderChoice.choices())
+    vault_namespace = models.CharField(max_length=64, default='')
+    generation = models.PositiveIntegerField(default=0)
+    time = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('provider', 'vault_namespace'),)
+
+
+class InstanceManager(models.Manager):
+    '''
+    Annotates last_seen and age, which are not stored for instances which were seen by the last sync of their
+    provider and namespace. Instances which were never synced count as seen now.
+    '''
+
+    def get_queryset(self):
+        sync_time = SyncGeneration.objects.filter(
+            provider=models.OuterRef('provider'),
+            vault_namespace=models.OuterRef('vault_namespace')).values('time')[:1]
+        return super().get_queryset().annotate(
+            last_seen=Coalesce('seen_until', models.Subquery(sync_time),
+                               models.Value(timezone.now(), output_field=models.DateTimeField())),
+            age=models.ExpressionWrapper(models.F('last_seen') - models.F('first_seen'),
+                                         output_field=models.DurationField()))
+
+
 class Instance(models.Model):
     provider = models.CharField(max_length=8, choices=ProviderChoice.choices())
     first_seen = models.DateTimeField()
-    last_seen = models.DateTimeField()
-    age = models.DurationField(default=timedelta())
+    seen_until = models.DateTimeField(null=True, help_text='Last sync which saw this instance, only set if it is '
+                                      'missing in the latest sync of its provider and namespace')
     ttl = models.DurationField(default=timedelta(0))
     active = models.BooleanField(default=False, help_text='True if the last sync found this instance on CSP')
     state = models.CharField(max_length=8, default=StateChoice.UNK, choices=StateChoice.choices(),
@@ -56,10 +106,37 @@ class Instance(models.Model):
     instance_id = models.CharField(max_length=200)
     region = models.CharField(max_length=64, default='')
     vault_namespace = models.CharField(max_length=64, default='')
-    csp_info = models.TextField(default='')
+    csp_info = models.JSONField(default=dict, encoder=CspInfoEncoder)
+    # copies of csp_info tags, set by set_csp_info
+    openqa_created_by = models.CharField(max_length=256, default='', db_index=True)
+    openqa_var_job_id = models.CharField(max_length=256, default='', db_index=True)
+    openqa_var_name = models.CharField(max_length=256, default='', db_index=True)
+    csp_hash = models.CharField(max_length=40, default='',
+                                help_text='Hash of the csp_info fingerprint of the last sync')
     notified = models.BooleanField(default=False)
     ignore = models.BooleanField(default=False)
 
+    objects = InstanceManager()
+
+    # last_seen and age are annotated by Instance.objects, instances created otherwise were only seen once
+    @property
+    def last_seen(self):
+        return self.__dict__.get('_last_seen') or self.seen_until or self.first_seen
+
+    @last_seen.setter
+    def last_seen(self, value):
+        self.__dict__['_last_seen'] = value
+
+    @property
+    def age(self):
+        if '_age' in self.__dict__:
+            return self.__dict__['_age']
+        return self.last_seen - self.first_seen if self.first_seen and self.last_seen else timedelta()
+
+    @age.setter
+    def age(self, value):
+        self.__dict__['_age'] = value
+
     def age_formated(self):
         return format_seconds(self.age.total_seconds())
 
@@ -77,21 +154,76 @@ class Instance(models.Model):
         return all_time_pattern.format(self.age_formated(), first_fmt, last_fmt, self.ttl_formated())
 
     def tags(self):
-        try:
-            info = json.loads(self.csp_info)
-            if 'tags' in info:
-                return info['tags']
-        except json.JSONDecodeError:
-            pass
-        return dict()
+        ''' The tags of csp_info, only computed again when csp_info was replaced '''
+        if getattr(self, '_tags_source', None) is not self.csp_info:
+            info = self.csp_info
+            if isinstance(info, str):
+                try:
+                    info = json.loads(info)
+                except json.JSONDecodeError:
+                    info = None
+            tags = info.get('tags') if isinstance(info, dict) else None
+            self._tags = tags if isinstance(tags, dict) else dict()
+            self._tags_source = self.csp_info
+        return self._tags
+
+    def set_csp_info(self, csp_info):
+        self.csp_info = csp_info
+        for field, value in openqa_tag_values(self.tags()).items():
+            setattr(self, field, value)
 
     def get_openqa_job_link(self):
-        tags = self.tags()
-        if tags.get('openqa_created_by', '') == 'openqa-suse-de' and 'openqa_var_JOB_ID' in tags:
-            url = '{}/t{}'.format(PCWConfig.get_feature_property('webui', 'openqa_url'), tags['openqa_var_JOB_ID'])
-            title = tags.get('openqa_var_NAME', '')
-            return {'url': url, 'title': title}
+        if self.openqa_created_by == 'openqa-suse-de' and self.openqa_var_job_id:
+            url = '{}/t{}'.format(PCWConfig.get_feature_property('webui', 'openqa_url'), self.openqa_var_job_id)
+            return {'url': url, 'title': self.openqa_var_name}
         return None
 
     class Meta:
         unique_together = (('provider', 'instance_id', 'vault_namespace'),)
+        # boolean filters are rendered as plain column predicates which SQLite can not use as index key, so
+        # they are only trailing index columns
+        indexes = [
+            # sync_csp_to_local_db
+            models.Index(fields=['provider', 'vault_namespace'], name='instance_sync_idx'),
+            # auto_delete_instances
+            models.Index(fields=['state', 'vault_namespace'], name='instance_ttl_idx'),
+            # send_leftover_notification
+            models.Index(fields=['vault_namespace', 'active'], name='instance_leftover_idx'),
+            # InstanceFilter defaults
+            models.Index(fields=['state', 'ignore'], name='instance_filter_idx'),
+        ]
+
+
+class InstanceTag(models.Model):
+    ''' Normalized copy of the tags in Instance.csp_info, kept in sync by sync_csp_to_local_db '''
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE, related_name='instance_tags')
+    # tag names of Azure have up to 512 characters, the ones of EC2 and GCE are shorter
+    key = models.CharField(max_length=512)
+    value = models.TextField(default='')
+
+    class Meta:
+        unique_together = (('instance', 'key'),)
+        indexes = [
+            models.Index(fields=['key', 'value'], name='instancetag_key_value_idx'),
+        ]
+
+
+class DataVersion(models.Model):
+    '''
+    Single row counter which is bumped on every change of the Instance table. Used by the views to answer
+    conditional requests and as part of their cache keys.
+    '''
+    SINGLETON_ID = 1
+    version = models.BigIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def current(cls):
+        obj, _ = cls.objects.get_or_create(pk=cls.SINGLETON_ID)
+        return obj
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=cls.SINGLETON_ID).update(version=models.F('version') + 1,
+                                                              modified=timezone.now()):
+            cls.objects.get_or_create(pk=cls.SINGLETON_ID, defaults={'version': 1})
@@ -62,6 +62,7 @@ class InstanceTable(tables.Table):
                                                  static('img/trash.png'))
                                 )
     openqa = OpenQALinkColumn()
+    last_seen = tables.DateTimeColumn()
     age = tables.Column(attrs={
         'td': {
             'class': lambda record: 'old' if record.age.seconds > 60*60 else ''
@@ -77,7 +78,8 @@ class InstanceTable(tables.Table):
 
     class Meta:
         model = Instance
-        exclude = ['active']
+        exclude = ['active', 'openqa_created_by', 'openqa_var_job_id', 'openqa_var_name', 'seen_until', 'csp_hash']
+        sequence = ['id', 'provider', 'first_seen', 'last_seen', 'age', '...']
         template_name = 'django_tables2/bootstrap.html'
         row_attrs = {
             'class': lambda record: "state_{}".format(record.state)
@@ -111,3 +113,10 @@ class InstanceFilter(BaseFilterSet):
     class Meta:
         model = Instance
         fields = ['provider', 'state', 'instance_id', 'region', 'csp_info', 'ignore']
+
+
+# Same filters as InstanceFilter but without initial values, so /instances.json keeps returning every active
+# instance unless the client asks for something else.
+class InstanceJsonFilter(InstanceFilter):
+    state = django_filters.MultipleChoiceFilter(field_name='state', choices=StateChoice.choices())
+    ignore = django_filters.BooleanFilter(field_name='ignore')
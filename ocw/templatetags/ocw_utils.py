@@ -5,6 +5,11 @@ from django import template
 register = template.Library()
 
 
+@register.filter
+def json_string(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
 @register.filter
 def pretty_json_string(value):
-    return json.dumps(json.loads(value), indent=2, sort_keys=True)
+    return json.dumps(value, indent=2, sort_keys=True)
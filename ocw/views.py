@@ -1,12 +1,77 @@
 from django.shortcuts import redirect
+from django.template.loader import render_to_string
 from django_tables2 import SingleTableView
 from .lib import db
+from .apps import job_metrics
 from .models import Instance
+from .models import DataVersion
 from .tables import InstanceTable
 from .tables import InstanceFilter
+from .tables import InstanceJsonFilter
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponse
-from django.core.serializers import serialize
+from django.http import JsonResponse, StreamingHttpResponse, HttpResponseBadRequest, HttpResponse
+from django.core.cache import cache
+from django.core.serializers import get_serializer
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.decorators import method_decorator
+from django.utils.duration import duration_string
+from django.views.decorators.http import condition
+from webui.settings import PCWConfig
+from hashlib import md5
+from itertools import islice
+import json
+
+INSTANCE_JSON_FIELDS = (
+    "provider",
+    "state",
+    "first_seen",
+    "last_seen",
+    "age",
+    "ttl",
+    "instance_id",
+    "region",
+    "vault_namespace",
+    "csp_info",
+)
+# annotated by Instance.objects instead of stored
+INSTANCE_JSON_DERIVED_FIELDS = ("last_seen", "age")
+INSTANCE_JSON_CHUNK_SIZE = 500
+# max. number of characters of a cached response, bigger ones are streamed on every request
+INSTANCE_JSON_CACHE_MAX_SIZE = 4 * 1024 * 1024
+
+
+def data_version(request):
+    if not hasattr(request, 'data_version'):
+        request.data_version = DataVersion.current()
+    return request.data_version
+
+
+def instance_json_etag(request, *args, **kwargs):
+    return '"{}"'.format(data_version(request).version)
+
+
+def instance_table_etag(request, *args, **kwargs):
+    # the page shows a login or logout button
+    return '"{}-{}"'.format(data_version(request).version, int(request.user.is_authenticated))
+
+
+def instance_last_modified(request, *args, **kwargs):
+    return data_version(request).modified
+
+
+def cache_key(request, prefix):
+    return '{}.{}'.format(prefix, md5(request.GET.urlencode().encode()).hexdigest())
+
+
+def get_cached(request, prefix):
+    # one entry per query which is replaced after a change of DataVersion, so outdated versions don't pile up
+    version, content = cache.get(cache_key(request, prefix), (None, None))
+    return content if version == data_version(request).version else None
+
+
+def set_cached(request, prefix, content):
+    cache.set(cache_key(request, prefix), (data_version(request).version, content),
+              PCWConfig.get_feature_property('webui', 'cache_timeout'))
 
 
 class FilteredSingleTableView(SingleTableView):
@@ -24,35 +89,101 @@ class FilteredSingleTableView(SingleTableView):
 
 
 # Displayed with '/ocw/instances' @see urls.py
+@method_decorator(condition(etag_func=instance_table_etag, last_modified_func=instance_last_modified), name='get')
 class FilteredInstanceTableView(FilteredSingleTableView):
     model = Instance
     table_class = InstanceTable
     filter_class = InstanceFilter
 
+    def get_context_data(self, **kwargs):
+        # building the table already queries the DB, so the rendered table is cached instead of a template fragment
+        table_html = get_cached(self.request, 'instance_table')
+        if table_html is None:
+            table_html = render_to_string('ocw/instance_table.html',
+                                          super(FilteredInstanceTableView, self).get_context_data(**kwargs),
+                                          request=self.request)
+            set_cached(self.request, 'instance_table', table_html)
+        return {'view': self, 'table_html': table_html}
+
 
 def health(request):
     return JsonResponse({"status": "ok"})
 
 
+@condition(etag_func=instance_json_etag, last_modified_func=instance_last_modified)
 def instance_json(request):
-    instances = Instance.objects.filter(active=True)
-    data = serialize(
-        "json",
-        instances,
-        fields=(
-            "provider",
-            "state",
-            "first_seen",
-            "last_seen",
-            "age",
-            "ttl",
-            "instance_id",
-            "region",
-            "vault_namespace",
-            "csp_info",
-        ),
-    )
-    return HttpResponse(data, content_type="application/json")
+    '''
+    Streams all active instances in the format of django's JSON serializer.
+    Query parameters:
+    -----------------
+    after  : only instances with a pk greater than this, use the pk of the last received instance to get the next page
+    limit  : max. number of returned instances
+    fields : comma separated subset of INSTANCE_JSON_FIELDS
+    Additionally all filters of InstanceFilter are supported.
+    Responses up to INSTANCE_JSON_CACHE_MAX_SIZE are cached until the next change of DataVersion.
+    '''
+    fields = INSTANCE_JSON_FIELDS
+    if request.GET.get('fields'):
+        fields = tuple(f.strip() for f in request.GET['fields'].split(','))
+        unknown = set(fields) - set(INSTANCE_JSON_FIELDS)
+        if unknown:
+            return HttpResponseBadRequest('Unknown field(s) {}'.format(', '.join(sorted(unknown))))
+    try:
+        after = int(request.GET.get('after', 0))
+        limit = int(request.GET['limit']) if request.GET.get('limit') else None
+    except ValueError:
+        return HttpResponseBadRequest('after and limit have to be integers')
+    if after < 0 or (limit is not None and limit < 0):
+        return HttpResponseBadRequest('after and limit must not be negative')
+    instance_filter = InstanceJsonFilter(request.GET, queryset=Instance.objects.filter(active=True, pk__gt=after))
+    if not instance_filter.is_valid():
+        return HttpResponseBadRequest(instance_filter.errors.as_json(), content_type="application/json")
+    instances = instance_filter.qs.order_by('pk').only(*[f for f in fields if f not in INSTANCE_JSON_DERIVED_FIELDS])
+    content = get_cached(request, 'instance_json')
+    if content is not None:
+        return HttpResponse(content, content_type="application/json")
+    if limit is not None:
+        instances = instances[:limit]
+    return StreamingHttpResponse(cache_stream(request, stream_json(instances, fields)),
+                                 content_type="application/json")
+
+
+def cache_stream(request, chunks):
+    ''' Yields the chunks and caches them for the query of the request unless they exceed the size limit '''
+    parts = []
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size <= INSTANCE_JSON_CACHE_MAX_SIZE:
+            parts.append(chunk)
+        elif parts:
+            parts.clear()
+        yield chunk
+    if size <= INSTANCE_JSON_CACHE_MAX_SIZE:
+        set_cached(request, 'instance_json', ''.join(parts))
+
+
+def stream_json(instances, fields):
+    serializer = get_serializer('python')()
+    stored_fields = [f for f in fields if f not in INSTANCE_JSON_DERIVED_FIELDS]
+    rows = instances.iterator(chunk_size=INSTANCE_JSON_CHUNK_SIZE)
+    separator = ''
+    yield '['
+    while True:
+        chunk = list(islice(rows, INSTANCE_JSON_CHUNK_SIZE))
+        if not chunk:
+            break
+        for instance, obj in zip(chunk, serializer.serialize(chunk, fields=stored_fields)):
+            if 'last_seen' in fields:
+                obj['fields']['last_seen'] = instance.last_seen
+            if 'age' in fields:
+                obj['fields']['age'] = duration_string(instance.age)
+            if 'csp_info' in obj['fields']:
+                # csp_info was a JSON string before it became a JSONField, keep that format for existing clients
+                obj['fields']['csp_info'] = json.dumps(obj['fields']['csp_info'], ensure_ascii=False)
+            yield separator + json.dumps(obj, cls=DjangoJSONEncoder)
+            separator = ', '
+    yield ']'
 
 
 def update(request):
@@ -64,7 +195,8 @@ def update_status(request):
     if 'application/json' in request.META.get('HTTP_ACCEPT'):
         return JsonResponse({
                   'status': 'running' if db.is_updating() else 'idle',
-                  'last_update': db.last_update()
+                  'last_update': db.last_update(),
+                  'jobs': job_metrics()
                   })
 
     return redirect('instances')
@@ -29,19 +29,13 @@ def mock_get_feature_property(feature: str, property: str, namespace: str = None
         return ec2_max_snapshot_age_days
     elif property == 'ec2-max-volumes-age-days':
         return ec2_max_volumes_age_days
+    elif property in ('ec2-parallel-tasks', 'ec2-region-deletions', 'azure-parallel-containers',
+                      'azure-parallel-deletions', 'parallel-tasks'):
+        return 4
+    elif property in ('azure-delete-timeout', 'gce-operation-timeout', 'delete-timeout-minutes'):
+        return 1
 
 
-class ec2_meta_mock:
-    def __init__(self):
-        self.data = fake.uuid4()
-
-
-class ec2_image_mock:
-    def __init__(self):
-        self.image_id = fake.uuid4()
-        self.meta = ec2_meta_mock()
-        self.name = fake.uuid4()
-
 def ec2_tags_mock(tags={fake.uuid4(): fake.uuid4()}):
     return [ {'Key': key, 'Value': tags[key]} for key in tags]
 
@@ -60,7 +54,6 @@ class ec2_instance_mock:
         self.sriov_net_support = fake.uuid4()
         self.tags = ec2_tags_mock(**kwargs)
         self.state_reason = {'Message': fake.uuid4()}
-        self.image = ec2_image_mock()
 
 
 class azure_instance_mock:
@@ -0,0 +1,51 @@
+from ocw import apps
+from datetime import datetime, timedelta
+from pytz import utc
+import threading
+
+
+def test_update_not_blocked_by_cleanup(monkeypatch):
+    monkeypatch.setattr(apps, '__scheduler', None)
+    cleanup_running = threading.Event()
+    release_cleanup = threading.Event()
+    update_done = threading.Event()
+
+    def cleanup():
+        cleanup_running.set()
+        release_cleanup.wait(10)
+
+    scheduler = apps.getScheduler()
+    scheduler.start()
+    try:
+        apps.add_measured_job(cleanup, 'cleanup', trigger='date', id='test_cleanup')
+        assert cleanup_running.wait(10)
+        apps.add_measured_job(update_done.set, 'update', trigger='date', id='test_update')
+        assert update_done.wait(10)
+        release_cleanup.set()
+    finally:
+        release_cleanup.set()
+        scheduler.shutdown()
+
+    metrics = apps.job_metrics()
+    assert metrics['test_update']['runs'] == 1
+    assert metrics['test_update']['last_queue_delay'] < 5
+    assert metrics['test_cleanup']['runs'] == 1
+
+
+def test_job_listener_metrics():
+    class FakeEvent:
+        job_id = 'test_metrics'
+        exception = None
+        scheduled_run_time = datetime.now(utc) - timedelta(seconds=30)
+
+    apps.run_measured('test_metrics', lambda: None)
+    apps.job_listener(FakeEvent())
+    FakeEvent.exception = Exception()
+    apps.run_measured('test_metrics', lambda: None)
+    apps.job_listener(FakeEvent())
+
+    metrics = apps.job_metrics()['test_metrics']
+    assert metrics['runs'] == 2
+    assert metrics['failures'] == 1
+    assert metrics['last_queue_delay'] >= 30
+    assert metrics['max_queue_delay'] >= 30
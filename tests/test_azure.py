@@ -6,6 +6,7 @@ from .generators import mock_get_feature_property
 from tests import generators
 from msrest.exceptions import AuthenticationError
 import time
+import threading
 import pytest
 
 
@@ -78,12 +79,14 @@ def test_cleanup_sle_images_container(azure_patch, monkeypatch):
                 MockImage('YouWillNotGetMyBuildNumber'),
             ]
 
-        def delete_blob(self, img_name, delete_snapshots):
-            self.deleted_blobs.append(img_name)
+        def delete_blobs(self, *blobs, delete_snapshots, raise_on_any_failure):
+            self.deleted_blobs.extend(blobs)
+            return [FakeResponse(202) for _ in blobs]
 
     fakecontainerclient = FakeContainerClient()
 
     monkeypatch.setattr(Azure, 'container_client', lambda *args, **kwargs: fakecontainerclient)
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
     az = Azure('fake')
     keep_images = ['SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.3.vhd']
 
@@ -98,6 +101,7 @@ def test_cleanup_images_from_rg(azure_patch, monkeypatch):
         MockImage('SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.3.vhd'),
         MockImage('YouWillNotGetMyBuildNumber'),
     ]
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
 
     def mock_res_mgmt_client(self):
         def res_mgmt_client():
@@ -110,7 +114,7 @@ def test_cleanup_images_from_rg(azure_patch, monkeypatch):
         def compute_mgmt_client():
             pass
         compute_mgmt_client.images = lambda: None
-        compute_mgmt_client.images.begin_delete = lambda rg, name: deleted_images.append(name)
+        compute_mgmt_client.images.begin_delete = lambda rg, name: FakePoller(lambda: deleted_images.append(name))
         return compute_mgmt_client
 
     monkeypatch.setattr(Azure, 'resource_mgmt_client', mock_res_mgmt_client)
@@ -118,12 +122,14 @@ def test_cleanup_images_from_rg(azure_patch, monkeypatch):
 
     az = Azure('fake')
     keep_images = ['SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.3.vhd']
-    az.cleanup_images_from_rg(keep_images)
+    assert az.cleanup_images_from_rg(keep_images) == {
+        ('image', 'SLES15-SP2-Azure-HPC.x86_64-0.9.0-Build1.43.vhd'): Azure.DELETED}
     assert deleted_images == ['SLES15-SP2-Azure-HPC.x86_64-0.9.0-Build1.43.vhd']
 
 
 def test_cleanup_disks_from_rg(azure_patch, monkeypatch):
     deleted_disks = list()
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
 
     items = [
         MockImage('SLES15-SP2-Azure-HPC.x86_64-0.9.0-Build1.43.vhd'),
@@ -148,7 +154,7 @@ def test_cleanup_disks_from_rg(azure_patch, monkeypatch):
             pass
         compute_mgmt_client.disks = lambda: None
         compute_mgmt_client.disks.get = lambda rg, name: FakeDisk(rg, name)
-        compute_mgmt_client.disks.begin_delete = lambda rg, name: deleted_disks.append(name)
+        compute_mgmt_client.disks.begin_delete = lambda rg, name: FakePoller(lambda: deleted_disks.append(name))
         return compute_mgmt_client
 
     monkeypatch.setattr(Azure, 'resource_mgmt_client', mock_res_mgmt_client)
@@ -156,10 +162,99 @@ def test_cleanup_disks_from_rg(azure_patch, monkeypatch):
 
     keep_images = ['SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.3.vhd']
     az = Azure('fake')
-    az.cleanup_disks_from_rg(keep_images)
+    assert az.cleanup_disks_from_rg(keep_images) == {
+        ('disk', 'SLES15-SP2-Azure-HPC.x86_64-0.9.0-Build1.43.vhd'): Azure.IN_USE,
+        ('disk', 'SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.7.vhd'): Azure.DELETED}
     assert deleted_disks == ['SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.7.vhd']
 
 
+def test_list_upload_resources(azure_patch, monkeypatch):
+    calls = list()
+
+    def list_by_resource_group(self, resource_group, filters=None):
+        calls.append(filters)
+        return [FakeResource('disk1', 'Microsoft.Compute/disks'), FakeResource('img1', 'Microsoft.Compute/images'),
+                FakeResource('account', 'Microsoft.Storage/storageAccounts')]
+
+    monkeypatch.setattr(Azure, 'list_by_resource_group', list_by_resource_group)
+    monkeypatch.setattr(Azure, 'parse_image_name', lambda self, name: {'build': '1'})
+    az = Azure('fake')
+    resources = az.list_upload_resources()
+    assert az.rg_deletion_candidates('disk', [], resources) == ['disk1']
+    assert az.rg_deletion_candidates('image', ['img2'], resources) == ['img1']
+    assert calls == [None]
+
+
+class FakeResource:
+
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+
+
+class FakePoller:
+    ''' Runs delete when waited for, unless it is slower than the timeout '''
+
+    def __init__(self, delete, duration=0, error=None):
+        self.delete = delete
+        self.duration = duration
+        self.error = error
+        self.finished = False
+
+    def wait(self, timeout=None):
+        if timeout is None or self.duration <= timeout:
+            time.sleep(self.duration)
+            self.delete()
+            self.finished = True
+        else:
+            time.sleep(timeout)
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if self.error:
+            raise self.error
+
+
+def test_delete_from_rg(azure_patch, monkeypatch):
+    deleted = list()
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def begin_delete(rg, name):
+        def delete():
+            nonlocal running
+            deleted.append(name)
+            with lock:
+                running -= 1
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        if name == 'slow':
+            return FakePoller(delete, duration=5)
+        return FakePoller(delete, duration=0.05, error=RuntimeError('failed') if name == 'broken' else None)
+
+    def compute_mgmt_client():
+        pass
+    compute_mgmt_client.images = lambda: None
+    compute_mgmt_client.images.begin_delete = begin_delete
+    monkeypatch.setattr(Azure, 'compute_mgmt_client', lambda self: compute_mgmt_client)
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
+
+    resources = [('image', 'slow'), ('image', 'broken')] + [('image', 'i{}'.format(n)) for n in range(10)]
+    start = time.monotonic()
+    outcomes = Azure('fake').delete_from_rg(resources)
+    # mock_get_feature_property sets the timeout to 1s
+    assert time.monotonic() - start < 2
+    assert outcomes[('image', 'slow')] == Azure.PENDING
+    assert isinstance(outcomes[('image', 'broken')], RuntimeError)
+    assert all(outcomes[('image', 'i{}'.format(n))] == Azure.DELETED for n in range(10))
+    assert max_running == 4
+
+
 def test_get_keeping_image_names(azure_patch, monkeypatch):
     class FakeContainerClient:
         def list_blobs(self):
@@ -186,16 +281,21 @@ def test_cleanup_all(azure_patch, monkeypatch):
         called = called + 1
 
     monkeypatch.setattr(Azure, 'get_storage_key', lambda *args, **kwargs: 'FOOXX')
+    monkeypatch.setattr(Azure, 'sle_images', lambda *args, **kwargs: [])
     monkeypatch.setattr(Azure, 'get_keeping_image_names', lambda *args, **kwargs: ['a', 'b'])
     monkeypatch.setattr(Azure, 'cleanup_sle_images_container', count_call)
-    monkeypatch.setattr(Azure, 'cleanup_disks_from_rg', count_call)
-    monkeypatch.setattr(Azure, 'cleanup_images_from_rg', count_call)
+    monkeypatch.setattr(Azure, 'list_upload_resources', count_call)
+    monkeypatch.setattr(Azure, 'rg_deletion_candidates', lambda self, kind, keep_images, resources: [kind])
+    monkeypatch.setattr(Azure, 'delete_from_rg', lambda self, resources: deleted.extend(resources))
     monkeypatch.setattr(Azure, 'cleanup_bootdiagnostics', count_call)
     monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
+    deleted = list()
 
     az = Azure('fake')
     az.cleanup_all()
-    assert called == 4
+    assert called == 3
+    # disks and images are deleted together
+    assert deleted == [('disk', 'disk'), ('image', 'image')]
 
 
 def test_cleanup_bootdiagnostics(azure_patch, monkeypatch):
@@ -288,6 +388,121 @@ def test_cleanup_bootdiagnostics_container_all_newer(azure_patch, monkeypatch):
     assert len(fakeblobserviceclient.deleted_containers) == 0
 
 
+class FakeBlobService:
+    ''' Counts the list calls and the blobs read from them '''
+
+    def __init__(self, containers):
+        self.containers = containers
+        self.list_calls = dict()
+        self.listed_blobs = 0
+        self.deleted_containers = list()
+        self.deleted_blobs = list()
+        self.batch_calls = 0
+        # status codes returned for the deletions of a blob, the last one repeats
+        self.blob_status = dict()
+
+    def list_containers(self):
+        return [MockImage(name, last_modified) for name, (last_modified, _) in self.containers.items()]
+
+    def get_container_client(self, container_name):
+        return FakeBlobContainer(self, container_name)
+
+    def delete_container(self, container_name):
+        self.deleted_containers.append(container_name)
+
+
+class FakeBlobContainer:
+
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+
+    def list_blobs(self):
+        self.service.list_calls[self.name] = self.service.list_calls.get(self.name, 0) + 1
+        for blob in self.service.containers[self.name][1]:
+            self.service.listed_blobs += 1
+            yield blob
+
+    def delete_blobs(self, *blobs, delete_snapshots, raise_on_any_failure):
+        assert delete_snapshots == 'include' and not raise_on_any_failure
+        assert len(blobs) <= Azure.blob_batch_size
+        self.service.batch_calls += 1
+        responses = list()
+        for name in blobs:
+            status = self.service.blob_status.get(name, [202])
+            responses.append(FakeResponse(status.pop(0) if len(status) > 1 else status[0]))
+            if responses[-1].status_code == 202:
+                self.service.deleted_blobs.append(name)
+        return iter(responses)
+
+
+class FakeResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_cleanup_all_lists_sle_images_once(azure_patch, monkeypatch):
+    old = datetime.now(timezone.utc) - timedelta(hours=generators.max_image_age_hours + 1)
+    service = FakeBlobService({'sle-images': (old, [
+        MockImage('SLES15-SP2-Azure-HPC.x86_64-0.9.0-Build1.43.vhd', old),
+        MockImage('SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.3.vhd', datetime.now(timezone.utc)),
+        MockImage('YouWillNotGetMyBuildNumber', old)])})
+    monkeypatch.setattr(Azure, 'bs_client', lambda self: service)
+    monkeypatch.setattr(Azure, 'list_upload_resources', lambda self: [])
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
+
+    Azure('fake').cleanup_all()
+    assert service.list_calls == {'sle-images': 1}
+    assert service.deleted_blobs == ['SLES15-SP2-Azure-HPC.x86_64-0.9.0-Build1.43.vhd']
+
+
+def test_cleanup_sle_images_container_batches(azure_patch, monkeypatch):
+    images = [MockImage('SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.{}.vhd'.format(n)) for n in range(2000)]
+    service = FakeBlobService({'sle-images': (None, images)})
+    names = [i.name for i in images]
+    service.blob_status = {names[0]: [429, 202], names[1]: [503, 503, 503, 503, 202], names[2]: [404],
+                           names[3]: [403]}
+    monkeypatch.setattr(Azure, 'bs_client', lambda self: service)
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
+    monkeypatch.setattr(time, 'sleep', lambda *args, **kwargs: None)
+
+    Azure('fake').cleanup_sle_images_container([])
+    # 8 batches, the first retry for both throttled blobs and two more for the one which stays throttled
+    assert service.batch_calls == 8 + 3
+    assert sorted(service.deleted_blobs) == sorted([names[0]] + names[4:])
+
+
+def test_cleanup_sle_images_container_dry_run(azure_patch, monkeypatch):
+    service = FakeBlobService({'sle-images': (None, [
+        MockImage('SLES15-SP2-Azure-HPC.x86_64-0.9.1-Build1.{}.vhd'.format(n)) for n in range(10)])})
+    monkeypatch.setattr(Azure, 'bs_client', lambda self: service)
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: True)
+
+    Azure('fake').cleanup_sle_images_container([])
+    assert service.batch_calls == 0
+
+
+def test_cleanup_bootdiagnostics_stops_at_first_old_blob(azure_patch, monkeypatch):
+    now = datetime.now(timezone.utc)
+    old = now - timedelta(hours=generators.min_image_age_hours + 1)
+    service = FakeBlobService({
+        # expired by its own last_modified, never listed
+        'bootdiagnostics-old': (old, [MockImage('blob', now)] * 100),
+        'bootdiagnostics-mixed': (now, [MockImage('blob', now), MockImage('blob', old)] +
+                                  [MockImage('blob', now)] * 100),
+        'bootdiagnostics-new': (now, [MockImage('blob', now)] * 10),
+        'sle-images': (old, [MockImage('blob', old)] * 10),
+    })
+    monkeypatch.setattr(Azure, 'bs_client', lambda self: service)
+    monkeypatch.setattr(PCWConfig, 'getBoolean', lambda *args, **kwargs: False)
+
+    Azure('fake').cleanup_bootdiagnostics()
+    assert sorted(service.deleted_containers) == ['bootdiagnostics-mixed', 'bootdiagnostics-old']
+    assert service.list_calls == {'bootdiagnostics-mixed': 1, 'bootdiagnostics-new': 1}
+    assert service.listed_blobs == 2 + 10
+
+
 def test_check_credentials(monkeypatch):
     count_list_resource_groups = 0
     failed_list_resource_groups = 0
@@ -1,19 +1,41 @@
 import json
 from ocw.lib.db import ec2_to_local_instance
 from ocw.lib.db import ec2_to_json
+from ocw.lib.db import ec2_fingerprint
 from ocw.lib.db import azure_to_json
 from ocw.lib.db import azure_to_local_instance
 from ocw.lib.db import gce_to_json
 from ocw.lib.db import tag_to_boolean
+from ocw.lib.db import sync_csp_to_local_db
+from ocw.lib.db import _update_ec2
+from ocw.lib.db import update_run
+from ocw.lib.db import auto_delete_instances
+from ocw.lib.db import RateLimiter
+from ocw.lib.db import DeletionTracker
+from ocw.lib.db import poll_deletions
+from ocw.lib.emailnotify import send_leftover_notification
+from ocw.lib import db
+from ocw.models import Instance
+from ocw.models import InstanceTag
+from ocw.models import DataVersion
 from ocw.models import ProviderChoice
 from ocw.models import StateChoice
+from ocw.models import SyncGeneration
 from ocw.lib.gce import GCE
 from tests.generators import ec2_instance_mock
 from tests.generators import azure_instance_mock
 from tests.generators import gce_instance_mock
 from faker import Faker
-from datetime import datetime
+from datetime import datetime, timedelta
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .conftest import set_pcw_ini
 import dateutil.parser
+import pytest
+from django.core.management import call_command
+import threading
+import time
 
 fake = Faker()
 
@@ -21,10 +43,10 @@ fake = Faker()
 def test_ec2_to_json():
     test_instance = ec2_instance_mock()
     test_instance.state_reason = None
-    test_instance.image = None
-    result = ec2_to_json(test_instance)
+    test_instance.image_id = None
+    result = ec2_to_json(test_instance, {})
     assert result['state'] == test_instance.state['Name']
-    assert result['image_id'] == test_instance.image_id
+    assert result['image_id'] is None
     assert result['instance_lifecycle'] == test_instance.instance_lifecycle
     assert result['instance_type'] == test_instance.instance_type
     assert result['kernel_id'] == test_instance.kernel_id
@@ -41,22 +63,31 @@ def test_ec2_to_json():
 
 def test_ec2_to_json_state_reason():
     test_instance = ec2_instance_mock()
-    result = ec2_to_json(test_instance)
+    result = ec2_to_json(test_instance, {})
     assert result['state_reason'] == test_instance.state_reason['Message']
 
 
-def test_ec2_to_json_image_without_meta():
+def test_ec2_to_json_image_deleted():
     test_instance = ec2_instance_mock()
-    test_instance.image.meta.data = None
-    result = ec2_to_json(test_instance)
-    assert result['image']['image_id'] == test_instance.image.image_id
+    result = ec2_to_json(test_instance, {test_instance.image_id: None})
+    assert result['image']['image_id'] == test_instance.image_id
     assert 'name' not in result['image']
 
 
-def test_ec2_to_json_image_with_meta():
+def test_ec2_to_json_image_with_name():
     test_instance = ec2_instance_mock()
-    result = ec2_to_json(test_instance)
-    assert result['image']['name'] == test_instance.image.name
+    result = ec2_to_json(test_instance, {test_instance.image_id: 'image name'})
+    assert result['image']['name'] == 'image name'
+
+
+def test_ec2_fingerprint():
+    info = ec2_to_json(ec2_instance_mock(), {})
+    changed = dict(info, public_ip_address='10.0.0.1')
+    assert ec2_fingerprint(changed) == ec2_fingerprint(info)
+    changed = dict(info, tags={'new': 'tag'})
+    assert ec2_fingerprint(changed) != ec2_fingerprint(info)
+    changed = dict(info, state='stopped')
+    assert ec2_fingerprint(changed) != ec2_fingerprint(info)
 
 
 def test_ec2_to_local_instance():
@@ -64,7 +95,7 @@ def test_ec2_to_local_instance():
     test_vault_namespace = fake.uuid4()
     test_region = fake.uuid4()
 
-    result = ec2_to_local_instance(test_instance, test_vault_namespace, test_region)
+    result = ec2_to_local_instance(test_instance, test_vault_namespace, test_region, {})
 
     assert result.provider == ProviderChoice.EC2
     assert result.vault_namespace == test_vault_namespace
@@ -72,7 +103,7 @@ def test_ec2_to_local_instance():
     assert result.instance_id == test_instance.instance_id
     assert result.state == StateChoice.ACTIVE
     assert result.region == test_region
-    json.loads(result.csp_info)
+    json.dumps(result.csp_info)
 
 
 def test_azure_to_json():
@@ -106,7 +137,7 @@ def test_azure_to_local_instance():
     assert result.first_seen == dateutil.parser.parse(test_instance.tags.get('openqa_created_date'))
     assert result.instance_id == test_instance.name
     assert result.region == test_instance.location
-    json.loads(result.csp_info)
+    json.dumps(result.csp_info)
 
 
 def test_gce_to_json():
@@ -155,3 +186,539 @@ def test_tag_to_boolean():
     assert tag_to_boolean(tag_name, csp_info) == False
     csp_info = {'tags' : {'test': '1'}}
     assert tag_to_boolean(tag_name, csp_info) == True
+
+
+def _local_instances(count, namespace='ns'):
+    instances = []
+    for n in range(count):
+        instances.append(Instance(
+            provider=ProviderChoice.EC2,
+            vault_namespace=namespace,
+            first_seen=timezone.now() - timedelta(hours=1),
+            instance_id='i-{}'.format(n),
+            state=StateChoice.ACTIVE,
+            region='region1',
+            csp_info={'tags': {}},
+            ttl=timedelta(hours=2)
+        ))
+    return instances
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_create_update_delete():
+    sync_csp_to_local_db(_local_instances(3), ProviderChoice.EC2, 'ns')
+    assert Instance.objects.filter(state=StateChoice.ACTIVE, active=True).count() == 3
+
+    Instance.objects.filter(instance_id='i-0').update(state=StateChoice.DELETING)
+    Instance.objects.filter(instance_id='i-1').update(state=StateChoice.DELETED)
+    instances = _local_instances(2)
+    instances[1].region = 'region2'
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns')
+
+    assert Instance.objects.get(instance_id='i-0').state == StateChoice.DELETING
+    i1 = Instance.objects.get(instance_id='i-1')
+    assert i1.state == StateChoice.ACTIVE
+    assert i1.region == 'region2'
+    assert i1.age >= timedelta(hours=1)
+    i2 = Instance.objects.get(instance_id='i-2')
+    assert i2.state == StateChoice.DELETED
+    assert not i2.active
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_last_seen():
+    instances = _local_instances(3)
+    instances[2].region = 'region2'
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns')
+    first_sync = SyncGeneration.objects.get(provider=ProviderChoice.EC2, vault_namespace='ns')
+    assert first_sync.generation == 1
+    i0 = Instance.objects.get(instance_id='i-0')
+    assert i0.seen_until is None
+    assert i0.last_seen == first_sync.time
+    assert i0.age == first_sync.time - i0.first_seen
+
+    sync_csp_to_local_db(_local_instances(1), ProviderChoice.EC2, 'ns', skip_regions=['region2'])
+    sync = SyncGeneration.objects.get(provider=ProviderChoice.EC2, vault_namespace='ns')
+    assert sync.generation == 2
+    # seen by the latest sync
+    assert Instance.objects.get(instance_id='i-0').last_seen == sync.time
+    # gone and not queried keep the time of the sync which saw them last
+    for instance_id in ('i-1', 'i-2'):
+        instance = Instance.objects.get(instance_id=instance_id)
+        assert instance.seen_until == first_sync.time
+        assert instance.last_seen == first_sync.time
+    assert Instance.objects.filter(age__lt=sync.time - i0.first_seen).count() == 2
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_instance_tags():
+    instances = _local_instances(2)
+    instances[0].csp_info = {'tags': {'pcw_ignore': '1', 'openqa_created_by': 'me'}}
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns')
+    assert set(InstanceTag.objects.values_list('instance__instance_id', 'key', 'value')) == {
+        ('i-0', 'pcw_ignore', '1'), ('i-0', 'openqa_created_by', 'me')}
+
+    instances = _local_instances(2)
+    instances[1].csp_info = {'tags': {'openqa_created_by': 'you'}}
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns')
+    assert set(InstanceTag.objects.values_list('instance__instance_id', 'key', 'value')) == {
+        ('i-1', 'openqa_created_by', 'you')}
+    assert Instance.objects.exclude(instance_tags__key='pcw_ignore').count() == 2
+    assert list(Instance.objects.filter(openqa_created_by='you').values_list('instance_id', flat=True)) == ['i-1']
+    assert Instance.objects.get(instance_id='i-0').openqa_created_by == ''
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_long_tag_key():
+    instances = _local_instances(1)
+    instances[0].csp_info = {'tags': {'k' * 512: 'v'}}
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns')
+    tag = InstanceTag.objects.get()
+    assert tag.key == 'k' * 512
+    # SQLite does not check the length, other databases would reject the row
+    tag.full_clean()
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_bumps_data_version():
+    before = DataVersion.current()
+    sync_csp_to_local_db(_local_instances(1), ProviderChoice.EC2, 'ns')
+    after = DataVersion.current()
+    assert after.version == before.version + 1
+    assert after.modified >= before.modified
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_rejects_foreign_instance():
+    with pytest.raises(ValueError):
+        sync_csp_to_local_db(_local_instances(1, 'other'), ProviderChoice.EC2, 'ns')
+
+
+def _count_queries(ctx):
+    return len([q for q in ctx.captured_queries if 'SAVEPOINT' not in q['sql']])
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_query_count(pcw_file):
+    set_pcw_ini(pcw_file, """
+[updaterun]
+sync_batch_size = 50
+""")
+    with CaptureQueriesContext(connection) as ctx:
+        sync_csp_to_local_db(_local_instances(300), ProviderChoice.EC2, 'ns')
+    # get_or_create sync generation, select existing, 6 * bulk_create, save sync generation, bump version
+    assert _count_queries(ctx) == 11
+
+    instances = _local_instances(300)
+    for i in instances[:60]:
+        i.csp_info = {'tags': {'changed': '1'}}
+    with CaptureQueriesContext(connection) as ctx:
+        sync_csp_to_local_db(instances[:250], ProviderChoice.EC2, 'ns')
+    # select sync generation, select existing, 2 * bulk_update, 2 * select tags of the changed instances,
+    # 2 * delete tags, 2 * insert tags, 1 * update(state=DELETED), save sync generation, bump version
+    assert _count_queries(ctx) == 13
+    tag_selects = [q['sql'] for q in ctx.captured_queries
+                   if q['sql'].startswith('SELECT') and 'FROM "ocw_instancetag"' in q['sql']]
+    # only the tags of the 60 changed instances are read
+    assert sum(len(sql.split(' IN (')[1].split(')')[0].split(',')) for sql in tag_selects) == 60
+    assert Instance.objects.filter(active=True).count() == 250
+
+    with CaptureQueriesContext(connection) as ctx:
+        sync_csp_to_local_db(instances[:250], ProviderChoice.EC2, 'ns')
+    # select sync generation, select existing, save sync generation, bump version
+    assert _count_queries(ctx) == 4
+    assert all(q['sql'].startswith('SELECT') for q in ctx.captured_queries
+               if 'ocw_instance' in q['sql'] and 'SAVEPOINT' not in q['sql'])
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_fingerprint():
+    instances = _local_instances(2)
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns', fingerprint=lambda info: info['tags'])
+    i0 = Instance.objects.get(instance_id='i-0')
+
+    instances = _local_instances(2)
+    instances[0].csp_info = {'tags': {}, 'public_ip_address': '1.2.3.4'}
+    instances[1].csp_info = {'tags': {'a': 'b'}}
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns', fingerprint=lambda info: info['tags'])
+    # not part of the fingerprint, so not written
+    assert Instance.objects.get(instance_id='i-0').csp_info == {'tags': {}}
+    assert Instance.objects.get(instance_id='i-1').csp_info == {'tags': {'a': 'b'}}
+    # but unchanged rows are still seen
+    assert Instance.objects.get(instance_id='i-0').last_seen > i0.last_seen
+    assert Instance.objects.get(instance_id='i-0').age > i0.age
+
+    Instance.objects.filter(instance_id='i-0').update(state=StateChoice.DELETED, active=False)
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns', fingerprint=lambda info: info['tags'])
+    i0 = Instance.objects.get(instance_id='i-0')
+    assert i0.state == StateChoice.ACTIVE and i0.active
+
+
+class FakeEC2:
+    all_regions = ['region1', 'region2', 'broken']
+
+    def __init__(self, namespace):
+        pass
+
+    def list_instances(self, region):
+        if region == 'broken':
+            raise Exception('region is broken')
+        return [ec2_instance_mock(), ec2_instance_mock()]
+
+    def get_image_names(self, region, image_ids):
+        return {image_id: 'name' for image_id in image_ids}
+
+
+def test_update_ec2_collects_region_errors(monkeypatch):
+    synced = {}
+
+    def mocked_sync(instances, provider, namespace, skip_regions=(), fingerprint=None):
+        synced['instances'] = instances
+        synced['skip_regions'] = skip_regions
+        synced['fingerprint'] = fingerprint
+
+    monkeypatch.setattr('ocw.lib.db.EC2', FakeEC2)
+    monkeypatch.setattr('ocw.lib.db.sync_csp_to_local_db', mocked_sync)
+    with pytest.raises(RuntimeError, match='broken'):
+        _update_ec2('ns')
+    assert len(synced['instances']) == 4
+    assert {i.region for i in synced['instances']} == {'region1', 'region2'}
+    assert synced['skip_regions'] == ['broken']
+    assert synced['fingerprint'] is ec2_fingerprint
+
+
+@pytest.mark.django_db
+def test_sync_csp_to_local_db_skip_regions():
+    instances = _local_instances(2)
+    instances[1].region = 'broken'
+    sync_csp_to_local_db(instances, ProviderChoice.EC2, 'ns')
+
+    sync_csp_to_local_db([], ProviderChoice.EC2, 'ns', skip_regions=['broken'])
+    assert Instance.objects.get(instance_id='i-0').state == StateChoice.DELETED
+    assert Instance.objects.get(instance_id='i-1').state == StateChoice.ACTIVE
+
+
+def test_update_run_parallel_with_retries(pcw_file, monkeypatch):
+    set_pcw_ini(pcw_file, """
+[default]
+namespaces = ns1, ns2
+providers = ec2, gce
+""")
+    # every pair has to be started before any of them can finish, which only works in parallel
+    barrier = threading.Barrier(4, timeout=10)
+    calls = []
+    sleeps = []
+    mails = []
+
+    def mocked_update_provider(provider, namespace):
+        calls.append((provider, namespace))
+        if len(calls) <= 4:
+            barrier.wait()
+        if (provider, namespace) == ('gce', 'ns2'):
+            raise Exception('gce is broken')
+
+    monkeypatch.setattr('ocw.lib.db._update_provider', mocked_update_provider)
+    monkeypatch.setattr('ocw.lib.db.time.sleep', lambda seconds: sleeps.append(seconds))
+    monkeypatch.setattr('ocw.lib.db.send_mail', lambda subject, body: mails.append(subject))
+    monkeypatch.setattr('ocw.lib.db.start_auto_delete', lambda: None)
+    monkeypatch.setattr('ocw.lib.db.getScheduler', lambda: FakeScheduler())
+    update_run()
+
+    assert len(calls) == 6
+    assert calls.count(('gce', 'ns2')) == 3
+    assert sleeps == [5, 10]
+    assert mails == ['Error on update gce in namespace ns2']
+
+
+class FakeScheduler:
+    running = True
+
+    def get_job(self, job_id):
+        return True
+
+
+@pytest.mark.parametrize('running', [True, False])
+def test_updaterun_command_auto_deletes(monkeypatch, running):
+    calls = []
+    scheduler = FakeScheduler()
+    scheduler.running = running
+    monkeypatch.setattr('ocw.lib.db.PCWConfig.get_namespaces_for', lambda feature: [])
+    monkeypatch.setattr('ocw.lib.db.send_leftover_notification', lambda: calls.append('send_leftover_notification'))
+    monkeypatch.setattr('ocw.lib.db.getScheduler', lambda: scheduler)
+    monkeypatch.setattr('ocw.lib.db.auto_delete_instances', lambda: calls.append('auto_delete_instances'))
+    monkeypatch.setattr('ocw.lib.db.add_measured_job',
+                        lambda func, executor, **kwargs: calls.append((kwargs['id'], func)))
+    call_command('updaterun')
+    if running:
+        assert calls == [('auto_delete', db.auto_delete_and_notify)]
+        calls.pop()[1]()
+    # without running scheduler, e.g. in the container startup, the command deletes on its own, in both cases the
+    # expired instances are deleted before the leftovers are reported
+    assert calls == ['auto_delete_instances', 'send_leftover_notification']
+
+
+class FakeDeleter:
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def delete_instances(self, region, instance_ids):
+        FakeDeleter.calls.append(('ec2', region, sorted(instance_ids)))
+        return {i: Exception('i-2 is protected') if i == 'i-2' else 'terminated' for i in instance_ids}
+
+    def delete_resource(self, resource_id):
+        with FakeDeleter.lock:
+            FakeDeleter.running += 1
+            FakeDeleter.max_running = max(FakeDeleter.max_running, FakeDeleter.running)
+        time.sleep(0.05)
+        with FakeDeleter.lock:
+            FakeDeleter.running -= 1
+        FakeDeleter.calls.append(('azure', resource_id))
+        if resource_id == 'rg-broken':
+            raise Exception('can not delete rg-broken')
+
+    def delete_instance(self, instance_id, zone):
+        FakeDeleter.calls.append(('gce', zone, instance_id))
+
+
+def _expired_instance(provider, instance_id, region='region1', ttl=timedelta(hours=1), namespace='ns'):
+    # seen by the last sync of its provider, so its age is 2 hours
+    sync, _ = SyncGeneration.objects.get_or_create(provider=provider, vault_namespace=namespace,
+                                                   defaults={'generation': 1, 'time': timezone.now()})
+    return Instance.objects.create(provider=provider, vault_namespace=namespace, instance_id=instance_id,
+                                   region=region, first_seen=sync.time - timedelta(hours=2), ttl=ttl, active=True,
+                                   state=StateChoice.ACTIVE)
+
+
+@pytest.mark.django_db
+def test_auto_delete_instances(pcw_file, monkeypatch):
+    set_pcw_ini(pcw_file, """
+[default]
+namespaces = ns
+
+[autodelete]
+azure-workers = 2
+azure-rate = 1000
+""")
+    FakeDeleter.calls = []
+    FakeDeleter.lock = threading.Lock()
+    FakeDeleter.running = FakeDeleter.max_running = 0
+    mails = []
+    for name in ('EC2', 'Azure', 'GCE'):
+        monkeypatch.setattr('ocw.lib.db.{}'.format(name), FakeDeleter)
+    monkeypatch.setattr('ocw.lib.db.send_mail', lambda subject, body: mails.append((subject, body)))
+    for n in range(3):
+        _expired_instance(ProviderChoice.EC2, 'i-{}'.format(n))
+    _expired_instance(ProviderChoice.EC2, 'i-3', region='region2')
+    for n in range(4):
+        _expired_instance(ProviderChoice.AZURE, 'rg-{}'.format(n))
+    _expired_instance(ProviderChoice.AZURE, 'rg-broken')
+    _expired_instance(ProviderChoice.GCE, 'gce-0', region='zone1')
+    _expired_instance(ProviderChoice.GCE, 'gce-young', ttl=timedelta(hours=3))
+    InstanceTag.objects.create(instance=_expired_instance(ProviderChoice.GCE, 'gce-ignored'), key='pcw_ignore')
+
+    auto_delete_instances()
+
+    calls = FakeDeleter.calls
+    assert sorted(c for c in calls if c[0] == 'ec2') == [('ec2', 'region1', ['i-0', 'i-1', 'i-2']),
+                                                        ('ec2', 'region2', ['i-3'])]
+    assert sorted(c[1] for c in calls if c[0] == 'azure') == ['rg-0', 'rg-1', 'rg-2', 'rg-3', 'rg-broken']
+    assert [c for c in calls if c[0] == 'gce'] == [('gce', 'zone1', 'gce-0')]
+    assert FakeDeleter.max_running == 2
+    assert set(Instance.objects.filter(state=StateChoice.ACTIVE).values_list('instance_id', flat=True)) == {
+        'i-2', 'rg-broken', 'gce-young', 'gce-ignored'}
+    assert len(mails) == 1
+    assert mails[0][0] == 'Error on auto deleting 2 of 10 instance(s)'
+    assert 'can not delete rg-broken' in mails[0][1]
+    assert '(EC2:i-2) failed\n\ni-2 is protected' in mails[0][1]
+
+
+@pytest.mark.django_db
+def test_auto_delete_instances_broken_namespace(pcw_file, monkeypatch):
+    set_pcw_ini(pcw_file, """
+[default]
+namespaces = ns, ns2
+""")
+
+    class BrokenNamespaceDeleter(FakeDeleter):
+        def __init__(self, namespace):
+            if namespace == 'ns2':
+                raise Exception('no credentials for ns2')
+            super().__init__(namespace)
+
+    FakeDeleter.calls = []
+    FakeDeleter.lock = threading.Lock()
+    FakeDeleter.running = FakeDeleter.max_running = 0
+    mails = []
+    for name in ('EC2', 'Azure', 'GCE'):
+        monkeypatch.setattr('ocw.lib.db.{}'.format(name), BrokenNamespaceDeleter)
+    monkeypatch.setattr('ocw.lib.db.send_mail', lambda subject, body: mails.append((subject, body)))
+    _expired_instance(ProviderChoice.EC2, 'i-0')
+    _expired_instance(ProviderChoice.EC2, 'i-1', namespace='ns2')
+    _expired_instance(ProviderChoice.AZURE, 'rg-0', namespace='ns2')
+    _expired_instance(ProviderChoice.GCE, 'gce-0', region='zone1')
+
+    auto_delete_instances()
+
+    assert sorted(FakeDeleter.calls) == [('ec2', 'region1', ['i-0']), ('gce', 'zone1', 'gce-0')]
+    assert set(Instance.objects.filter(state=StateChoice.DELETING).values_list('instance_id', flat=True)) == {
+        'i-0', 'gce-0'}
+    assert set(Instance.objects.filter(state=StateChoice.ACTIVE).values_list('instance_id', flat=True)) == {
+        'i-1', 'rg-0'}
+    assert len(mails) == 1
+    assert mails[0][0] == 'Error on auto deleting 2 of 4 instance(s)'
+    assert '[ns2] Deleting instance(s) (EC2:i-1) failed' in mails[0][1]
+    assert '[ns2] Deleting instance(s) (AZURE:rg-0) failed' in mails[0][1]
+    assert 'no credentials for ns2' in mails[0][1]
+
+
+class FakePoller:
+    def __init__(self, error=None):
+        self.finished = False
+        self.error = error
+
+    def done(self):
+        return self.finished
+
+    def result(self):
+        if self.error:
+            raise self.error
+
+
+@pytest.mark.django_db
+def test_poll_deletions(monkeypatch):
+    mails = []
+    monkeypatch.setattr('ocw.lib.db.send_mail', lambda subject, body: mails.append((subject, body)))
+    monkeypatch.setattr('ocw.lib.db.deletion_tracker', DeletionTracker())
+    pollers = {'rg-ok': FakePoller(), 'rg-running': FakePoller(), 'rg-broken': FakePoller(Exception('rg is locked'))}
+    for instance_id, poller in pollers.items():
+        instance = _expired_instance(ProviderChoice.AZURE, instance_id)
+        instance.state = StateChoice.DELETING
+        instance.save()
+        db.deletion_tracker.track(instance, poller)
+
+    poll_deletions()
+    assert len(db.deletion_tracker) == 3
+    assert mails == []
+
+    pollers['rg-ok'].finished = pollers['rg-broken'].finished = True
+    version = DataVersion.current().version
+    poll_deletions()
+    assert len(db.deletion_tracker) == 1
+    assert DataVersion.current().version > version
+    ok = Instance.objects.get(instance_id='rg-ok')
+    assert ok.state == StateChoice.DELETED and not ok.active and ok.seen_until is not None
+    assert Instance.objects.get(instance_id='rg-running').state == StateChoice.DELETING
+    assert Instance.objects.get(instance_id='rg-broken').state == StateChoice.ACTIVE
+    assert len(mails) == 1
+    assert mails[0][0] == 'Error on deleting 1 instance(s)'
+    assert 'rg is locked' in mails[0][1]
+
+
+@pytest.mark.django_db
+def test_auto_delete_tracks_azure_deletions(pcw_file, monkeypatch):
+    set_pcw_ini(pcw_file, """
+[default]
+namespaces = ns
+""")
+    poller = FakePoller()
+
+    class FakeAzure:
+        def __init__(self, namespace):
+            pass
+
+        def delete_resource(self, resource_id):
+            return poller
+
+    tracker = DeletionTracker()
+    track = tracker.track
+    tracked_states = []
+
+    def recording_track(instance, poller):
+        tracked_states.append(Instance.objects.get(pk=instance.pk).state)
+        track(instance, poller)
+
+    tracker.track = recording_track
+    monkeypatch.setattr('ocw.lib.db.Azure', FakeAzure)
+    monkeypatch.setattr('ocw.lib.db.deletion_tracker', tracker)
+    _expired_instance(ProviderChoice.AZURE, 'rg-0')
+
+    auto_delete_instances()
+    # a quickly failing deletion must not be reset to ACTIVE before it is DELETING
+    assert tracked_states == [StateChoice.DELETING]
+    assert Instance.objects.get(instance_id='rg-0').state == StateChoice.DELETING
+    assert len(db.deletion_tracker) == 1
+
+    poller.finished = True
+    poll_deletions()
+    assert Instance.objects.get(instance_id='rg-0').state == StateChoice.DELETED
+
+
+class RecordingLock:
+    def __init__(self):
+        self.held = False
+
+    def __enter__(self):
+        assert not self.held
+        self.held = True
+
+    def __exit__(self, *args):
+        self.held = False
+
+
+@pytest.mark.django_db
+def test_writers_hold_write_lock(pcw_file, monkeypatch):
+    set_pcw_ini(pcw_file, """
+[default]
+namespaces = ns
+
+[notify]
+age-hours = 1
+to = pcw@example.com
+""")
+    lock = RecordingLock()
+    writes = []
+
+    def record_writes(execute, sql, params, many, context):
+        if sql.split()[0] in ('INSERT', 'UPDATE', 'DELETE'):
+            writes.append(lock.held)
+        return execute(sql, params, many, context)
+
+    monkeypatch.setattr(db, '__write_lock', lock)
+    monkeypatch.setattr('ocw.lib.db.Azure', FakeDeleter)
+    monkeypatch.setattr('ocw.lib.db.deletion_tracker', DeletionTracker())
+    monkeypatch.setattr('ocw.lib.emailnotify.send_mail', lambda *args, **kwargs: None)
+    FakeDeleter.calls = []
+    FakeDeleter.lock = threading.Lock()
+    FakeDeleter.running = FakeDeleter.max_running = 0
+    _expired_instance(ProviderChoice.AZURE, 'rg-0')
+    rg1 = _expired_instance(ProviderChoice.AZURE, 'rg-1')
+    poller = FakePoller()
+    poller.finished = True
+
+    with connection.execute_wrapper(record_writes):
+        sync_csp_to_local_db(_local_instances(1), ProviderChoice.EC2, 'ns')
+        auto_delete_instances()
+        db.deletion_tracker.track(Instance.objects.get(instance_id='rg-0'), poller)
+        poll_deletions()
+        db.delete_instance(rg1)
+        send_leftover_notification()
+    # sync, auto delete, poll deletions, delete view and leftover notification
+    assert len(writes) > 5
+    assert all(writes)
+    assert not lock.held
+
+
+def test_rate_limiter(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('ocw.lib.db.time.monotonic', lambda: 100.0)
+    monkeypatch.setattr('ocw.lib.db.time.sleep', lambda seconds: sleeps.append(seconds))
+    limiter = RateLimiter(4)
+    for n in range(4):
+        limiter.wait()
+    assert sleeps == [0.25, 0.5, 0.75]
+
+    sleeps.clear()
+    unlimited = RateLimiter(0)
+    unlimited.wait()
+    unlimited.wait()
+    assert sleeps == []
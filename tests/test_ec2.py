@@ -5,11 +5,13 @@ from tests.generators import min_image_age_hours, max_image_age_hours, ec2_max_v
     ec2_max_snapshot_age_days
 from datetime import datetime, timezone, timedelta
 from botocore.exceptions import ClientError
+import botocore.session
+from concurrent.futures import ThreadPoolExecutor
 import pytest
+import threading
+import time
 
 older_then_min_age = (datetime.now(timezone.utc) - timedelta(hours=min_image_age_hours + 1)).isoformat()
-# used by test_delete_vpc_deleting_everything test. Needs to be global due to use in ec2_patch fixture
-delete_vpc_calls_stack = []
 
 
 # fixture setting up a commonly used mocks
@@ -18,22 +20,6 @@ def ec2_patch(monkeypatch):
     def mocked_ec2_resource():
         pass
 
-    def mocked_vpc(vpcId):
-        return MockedVpc(vpcId)
-
-    # used only in test_delete_vpc_deleting_everything. needs to be here because it is single place where we
-    # mocking mocking ec2_resource
-    def mocked_boto3_delete_vpc(VpcId):
-        delete_vpc_calls_stack.append('boto3_delete_vpc')
-
-    # only reason we need it is to mock long call chain
-    def mocked_meta():
-        pass
-
-    # only reason we need it is to mock long call chain
-    def mocked_client():
-        pass
-
     monkeypatch.setattr(EC2, 'check_credentials', lambda *args, **kwargs: True)
     monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
     monkeypatch.setattr(EC2, 'get_all_regions', lambda self: ['region1'])
@@ -41,22 +27,16 @@ def ec2_patch(monkeypatch):
     monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: MockedEC2Client())
     monkeypatch.setattr(EC2, 'needs_to_delete_snapshot', lambda *args, **kwargs: True)
     monkeypatch.setattr(EC2, 'ec2_resource', lambda self, region: mocked_ec2_resource)
-
-    mocked_ec2_resource.Vpc = mocked_vpc
-    mocked_ec2_resource.meta = mocked_meta
-    mocked_ec2_resource.VpcPeeringConnection = lambda id: MockedVpcPeeringConnection()
-    mocked_meta.client = mocked_client
-    # don't mix up this with EC2.delete_vpc . this one is boto3 side of the call
-    mocked_client.delete_vpc = mocked_boto3_delete_vpc
-    return EC2('fake')
+    ec2 = EC2('fake')
+    ec2.forget_clusters()
+    return ec2
 
 
 @pytest.fixture
 def ec2_patch_for_vpc(ec2_patch, monkeypatch):
     def mocked_get_boolean(config_path, field=None):
         # all places where this fixture is called needs to have dry_run=False
-        # most of tests except test_delete_vpc_exception_swallow does not care about vpc-notify-only
-        # because delete_vpc ( only place where it currently used ) is mocked
+        # vpc-notify-only is only enabled by test_delete_vpc_no_delete_due_notify_only_config
         return config_path not in ['default/dry_run', 'cleanup/vpc-notify-only']
 
     # needs within emailnotify.send_mail
@@ -67,14 +47,15 @@ def ec2_patch_for_vpc(ec2_patch, monkeypatch):
         # within emailnotify.send_mail we needs sane strings
         if feature == 'notify' and property in ('to', 'from'):
             return 'email'
+        elif property in ('ec2-parallel-tasks', 'ec2-region-deletions'):
+            return 4
         else:
             return -1
 
-    MockedEC2Client.response = {
-        'Vpcs': [
-            {'VpcId': 'someId', 'OwnerId': 'someId'}
-        ]
-    }
+    # the only uploader VPC has an instance
+    client = VpcEC2Client([{'VpcId': 'someId', 'OwnerId': 'someId'}],
+                          {'describe_instances': [('someId', {'Instances': [{'VpcId': 'someId'}]})]})
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
     monkeypatch.setattr(PCWConfig, 'getBoolean', mocked_get_boolean)
     monkeypatch.setattr(PCWConfig, 'has', mocked_has)
     monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_local_get_feature_property)
@@ -90,7 +71,6 @@ class MockedEC2Client():
     volumeid_to_delete = 'delete_me'
     snapshotid_i_have_ami = 'you_can_not_delete_me'
     delete_snapshot_raise_error = False
-    delete_vpc_endpoints_called = False
 
     ec2_snapshots = {snapshotid_to_delete: 'snapshot', snapshotid_i_have_ami: 'snapshot'}
 
@@ -116,17 +96,18 @@ class MockedEC2Client():
     def describe_volumes(self, *args, **kwargs):
         return MockedEC2Client.response
 
-    def describe_vpcs(self, Filters):
-        return MockedEC2Client.response
+    def get_paginator(self, operation_name):
+        return MockedPaginator()
 
-    def describe_vpc_endpoints(self, Filters):
-        return MockedEC2Client.response
 
-    def delete_vpc_endpoints(self, VpcEndpointIds):
-        MockedEC2Client.delete_vpc_endpoints_called = True
+class MockedPaginator:
+    # paginate() returns these pages if set, otherwise MockedEC2Client.response as the only page
+    pages = None
+    calls = list()
 
-    def describe_vpc_peering_connections(self, Filters):
-        return MockedEC2Client.response
+    def paginate(self, **kwargs):
+        MockedPaginator.calls.append(kwargs)
+        return MockedPaginator.pages or [MockedEC2Client.response]
 
 class MockedEKSClient():
 
@@ -136,6 +117,9 @@ class MockedEKSClient():
     def list_clusters(self):
         return self.clusters_list
 
+    def get_paginator(self, operation_name):
+        return MockedEKSPaginator([dict({'clusters': []}, **self.clusters_list)])
+
     def describe_cluster(self, name=None):
         if name == 'empty':
             return {}
@@ -149,88 +133,89 @@ class MockedEKSClient():
             return None
 
 
-class MockedSMTP:
-    mimetext = ''
-
-    def ehlo(self):
-        pass
-
-    def sendmail(self, sender_email, receiver_email, mimetext):
-        MockedSMTP.mimetext = mimetext
-
-
-class MockedInstances:
-    is_empty = False
-
-    def all(self):
-        if MockedInstances.is_empty:
-            return []
-        else:
-            return ['subnet']
-
-
-class MockedInterface:
-    delete_called = False
-
-    def delete(self):
-        MockedInterface.delete_called = True
-
-
-class MockedNetworkInterfaces:
-    def all(self):
-        return [MockedInterface()]
+class MockedEKSPaginator:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = list()
 
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.pages
 
-# this mock is used to replace several totally different classes
-# but they all have common ground -> delete method
-class MockedCollectionItem:
-    delete_called = 0
 
-    def __init__(self):
-        # for mocking subnets while checking for running instances
-        self.instances = MockedInstances()
-        # for mocking subnets while deleting vpc_endpoints
-        self.network_interfaces = MockedNetworkInterfaces()
-        # for mocking internet gateways
-        self.id = 'id'
-        # for mocking routing tables
-        self.associations_attribute = []
-        # for mocking security_groups and also name should not be equal 'default'
-        self.group_name = 'NOT_default'
-        # for mocking network_acls should be False
-        self.is_default = False
+class VpcEC2Client:
+    # describe_* operation -> (VPC id, item) pairs, paginate returns the items of the VPCs in the filter
+    result_keys = dict({op: key for op, key, _, _ in EC2.vpc_dependencies.values()},
+                       describe_instances='Reservations')
 
-    def delete(self):
-        MockedCollectionItem.delete_called += 1
+    def __init__(self, vpcs, items=None, broken=()):
+        self.vpcs = vpcs
+        self.items = items or dict()
+        self.broken = broken
+        self.describe_calls = list()
+        self.page_sizes = dict()
+        self.calls = list()
 
+    def describe_vpcs(self, Filters):
+        return {'Vpcs': self.vpcs}
+
+    def get_paginator(self, operation_name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Filters, PaginationConfig):
+                client.describe_calls.append((operation_name, Filters))
+                client.page_sizes.setdefault(operation_name, set()).add(PaginationConfig['PageSize'])
+                vpc_ids = Filters[0]['Values']
+                return [{VpcEC2Client.result_keys[operation_name]: [
+                    item for vpc_id, item in client.items.get(operation_name, []) if vpc_id in vpc_ids]}]
+
+        return Paginator()
+
+    def __getattr__(self, name):
+        if not name.startswith(('delete_', 'detach_')):
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            resource_id = list(kwargs.values())[0]
+            resource_id = resource_id[0] if isinstance(resource_id, list) else resource_id
+            self.calls.append((name, resource_id))
+            if resource_id in self.broken:
+                raise ClientError({'Error': {'Code': 'DependencyViolation', 'Message': resource_id}}, name)
+
+        return call
+
+
+def uploader_vpc_items(vpc_ids, subnets=2):
+    ''' describe_* items of the VPCs with the given ids, including the ones which are never deleted '''
+    items = dict()
+    for v in vpc_ids:
+        for op, item in [
+                ('describe_internet_gateways', {'InternetGatewayId': 'igw-' + v, 'Attachments': [{'VpcId': v}]}),
+                ('describe_vpc_endpoints', {'VpcEndpointId': 'vpce-' + v, 'VpcId': v}),
+                ('describe_vpc_peering_connections', {'VpcPeeringConnectionId': 'pcx-' + v,
+                                                      'RequesterVpcInfo': {'VpcId': v}}),
+                ('describe_route_tables', {'RouteTableId': 'rtb-main-' + v, 'VpcId': v, 'Associations': [{}]}),
+                ('describe_route_tables', {'RouteTableId': 'rtb-' + v, 'VpcId': v, 'Associations': []}),
+                ('describe_security_groups', {'GroupId': 'sg-default-' + v, 'GroupName': 'default', 'VpcId': v}),
+                ('describe_security_groups', {'GroupId': 'sg-' + v, 'GroupName': 'uploader', 'VpcId': v}),
+                ('describe_network_acls', {'NetworkAclId': 'acl-default-' + v, 'IsDefault': True, 'VpcId': v}),
+                ('describe_network_acls', {'NetworkAclId': 'acl-' + v, 'IsDefault': False, 'VpcId': v})] + [
+                ('describe_subnets', {'SubnetId': 'subnet-{}-{}'.format(v, n), 'VpcId': v}) for n in range(subnets)] + [
+                ('describe_network_interfaces', {'NetworkInterfaceId': 'eni-{}-{}'.format(v, n), 'VpcId': v})
+                for n in range(subnets)]:
+            items.setdefault(op, []).append((v, item))
+    return items
 
-class MockedCollectionWithAllMethod:
-
-    def all(self):
-        return [MockedCollectionItem()]
-
-
-class MockedVpc:
-    cnt_calls = 0
-    detach_internet_gateway_called = 0
-
-    def __init__(self, vpcId):
-        MockedVpc.cnt_calls += 1
-        self.subnets = MockedCollectionWithAllMethod()
-        self.internet_gateways = MockedCollectionWithAllMethod()
-        self.route_tables = MockedCollectionWithAllMethod()
-        self.security_groups = MockedCollectionWithAllMethod()
-        self.network_acls = MockedCollectionWithAllMethod()
-
-    def detach_internet_gateway(self, InternetGatewayId):
-        MockedVpc.detach_internet_gateway_called = 1
 
+class MockedSMTP:
+    mimetext = ''
 
-class MockedVpcPeeringConnection:
-    delete_called = False
+    def ehlo(self):
+        pass
 
-    def delete(self):
-        MockedVpcPeeringConnection.delete_called = True
+    def sendmail(self, sender_email, receiver_email, mimetext):
+        MockedSMTP.mimetext = mimetext
 
 
 def test_parse_image_name(ec2_patch):
@@ -280,7 +265,7 @@ def test_cleanup_images_delete_due_time(ec2_patch):
         ]
     }
     ec2_patch.cleanup_images()
-    assert MockedEC2Client.deleted_images == [2, 3, 4]
+    assert sorted(MockedEC2Client.deleted_images) == [2, 3, 4]
 
 
 def test_cleanup_images_delete_due_quantity(ec2_patch):
@@ -330,6 +315,32 @@ def test_cleanup_snapshots_have_ami(ec2_patch):
     assert MockedEC2Client.snapshotid_i_have_ami in MockedEC2Client.ec2_snapshots
 
 
+def test_cleanup_snapshots_paginated(ec2_patch, monkeypatch):
+    old = datetime.now() - timedelta(days=ec2_max_snapshot_age_days + 1)
+    monkeypatch.setattr(EC2, 'needs_to_delete_snapshot', lambda snapshot, days: snapshot['Description'] == 'old')
+    monkeypatch.setattr(MockedPaginator, 'calls', list())
+    monkeypatch.setattr(MockedPaginator, 'pages', [
+        {'Snapshots': [{'SnapshotId': 'snap-2', 'StartTime': old, 'Description': 'old'},
+                       {'SnapshotId': 'snap-3', 'StartTime': old, 'Description': 'new'}]},
+        {'Snapshots': [{'SnapshotId': 'snap-1', 'StartTime': old - timedelta(days=1), 'Description': 'old'}]}])
+    snapshots = ec2_patch.snapshots_to_delete('region1', ec2_max_snapshot_age_days)
+    # all pages are read and the oldest snapshot comes first
+    assert [s['SnapshotId'] for s in snapshots] == ['snap-1', 'snap-2']
+    assert MockedPaginator.calls == [{'OwnerIds': ['self'], 'Filters': [
+        {'Name': 'description', 'Values': EC2.deletable_snapshot_descriptions}],
+        'PaginationConfig': {'PageSize': EC2.describe_page_size}}]
+
+
+def test_cleanup_volumes_paginated(ec2_patch, monkeypatch):
+    old = datetime.now(timezone.utc) - timedelta(days=ec2_max_volumes_age_days + 1)
+    monkeypatch.setattr(MockedPaginator, 'calls', list())
+    monkeypatch.setattr(MockedPaginator, 'pages', [{'Volumes': [{'VolumeId': 'vol-1', 'CreateTime': old}]},
+                                                   {'Volumes': [{'VolumeId': 'vol-2', 'CreateTime': old}]}])
+    volumes = ec2_patch.volumes_to_delete('region1', ec2_max_volumes_age_days)
+    assert [v['VolumeId'] for v in volumes] == ['vol-1', 'vol-2']
+    assert MockedPaginator.calls[0]['Filters'] == [{'Name': 'status', 'Values': EC2.deletable_volume_states}]
+
+
 def test_cleanup_volumes_cleanupcheck(ec2_patch):
     MockedEC2Client.response = {
         'Volumes': [{'VolumeId': MockedEC2Client.volumeid_to_delete,
@@ -357,140 +368,196 @@ def test_cleanup_uploader_vpc_no_mail_sent_due_dry_run(ec2_patch_for_vpc):
     assert MockedSMTP.mimetext == ''
 
 
-def test_delete_vpc_deleting_everything(ec2_patch, monkeypatch):
-    def mocked_delete_internet_gw(arg1, arg2):
-        delete_vpc_calls_stack.append('delete_internet_gw')
-
-    def mocked_delete_routing_tables(arg1, arg2):
-        delete_vpc_calls_stack.append('delete_routing_tables')
-
-    def mocked_delete_vpc_endpoints(arg1, arg2, arg3):
-        delete_vpc_calls_stack.append('delete_vpc_endpoints')
-
-    def mocked_delete_security_groups(arg1, arg2):
-        delete_vpc_calls_stack.append('delete_security_groups')
-
-    def mocked_delete_vpc_peering_connections(arg1, arg2, arg3):
-        delete_vpc_calls_stack.append('delete_vpc_peering_connections')
-
-    def mocked_delete_network_acls(arg1, arg2):
-        delete_vpc_calls_stack.append('delete_network_acls')
-
-    def mocked_delete_vpc_subnets(arg1, arg2):
-        delete_vpc_calls_stack.append('delete_vpc_subnets')
-
-        # emulated that there is no linked running instance to VPC which we trying to delete
-
-    MockedInstances.is_empty = True
-    monkeypatch.setattr(EC2, 'delete_internet_gw', mocked_delete_internet_gw)
-    monkeypatch.setattr(EC2, 'delete_routing_tables', mocked_delete_routing_tables)
-    monkeypatch.setattr(EC2, 'delete_vpc_endpoints', mocked_delete_vpc_endpoints)
-    monkeypatch.setattr(EC2, 'delete_security_groups', mocked_delete_security_groups)
-    monkeypatch.setattr(EC2, 'delete_vpc_peering_connections', mocked_delete_vpc_peering_connections)
-    monkeypatch.setattr(EC2, 'delete_network_acls', mocked_delete_network_acls)
-    monkeypatch.setattr(EC2, 'delete_vpc_subnets', mocked_delete_vpc_subnets)
-    ec2_patch.delete_vpc('region', MockedVpc('vpcId'), 'vpcId')
-
-    assert delete_vpc_calls_stack == ['delete_internet_gw', 'delete_routing_tables', 'delete_vpc_endpoints',
-                                      'delete_security_groups', 'delete_vpc_peering_connections',
-                                      'delete_network_acls',
-                                      'delete_vpc_subnets', 'boto3_delete_vpc']
-
-
-def test_delete_vpc_exception_swallow(ec2_patch_for_vpc, monkeypatch):
-    def mocked_dont_call_it(arg1, arg2):
-        raise Exception
-
-    monkeypatch.setattr(EC2, 'delete_internet_gw', mocked_dont_call_it)
-    ec2_patch_for_vpc.delete_vpc('region', MockedVpc('vpcId'), 'vpcId')
-    assert 'Exception on VPC deletion' in MockedSMTP.mimetext
-    assert 'self.delete_internet_gw(vpc)' in MockedSMTP.mimetext
-
-
 def test_delete_vpc_no_delete_due_notify_only_config(ec2_patch_for_vpc, monkeypatch):
-    def mocked_dont_call_it(arg1, arg2, arg3):
+    def mocked_dont_call_it(*args):
         raise Exception
 
     def mocked_get_boolean(config_path, field=None):
         return config_path != 'default/dry_run'
 
-    monkeypatch.setattr(EC2, 'delete_vpc', mocked_dont_call_it)
+    monkeypatch.setattr(EC2, 'plan_vpc_deletion', mocked_dont_call_it)
+    monkeypatch.setattr(EC2, 'delete_vpcs', mocked_dont_call_it)
     monkeypatch.setattr(PCWConfig, 'getBoolean', mocked_get_boolean)
     ec2_patch_for_vpc.cleanup_uploader_vpcs()
     assert 'VPC someId should be deleted, skipping due vpc-notify-only=True' in MockedSMTP.mimetext
 
 
-def test_delete_internet_gw(ec2_patch):
-    ec2_patch.delete_internet_gw(MockedVpc('vpcId'))
-    assert MockedVpc.detach_internet_gateway_called == 1
-    assert MockedCollectionItem.delete_called == 1
-
-
-def test_delete_routing_tables(ec2_patch):
-    ec2_patch.delete_routing_tables(MockedVpc('vpcId'))
-    assert MockedCollectionItem.delete_called == 2
-
-
-def test_delete_vpc_endpoints(ec2_patch):
-    MockedEC2Client.response = {'VpcEndpoints': [{'VpcEndpointId': 'id'}]}
-    ec2_patch.delete_vpc_endpoints('region', 'vpcId')
-    assert MockedEC2Client.delete_vpc_endpoints_called
-
-
-def test_delete_security_groups(ec2_patch):
-    ec2_patch.delete_security_groups(MockedVpc('vpcId'))
-    assert MockedCollectionItem.delete_called == 3
-
-
-def test_delete_vpc_peering_connections(ec2_patch):
-    MockedEC2Client.response = {'VpcPeeringConnections': [{'VpcPeeringConnectionId': 'id'}]}
-    ec2_patch.delete_vpc_peering_connections('region', 'vpcId')
-    assert MockedVpcPeeringConnection.delete_called
-
-
-def test_delete_network_acls(ec2_patch):
-    ec2_patch.delete_network_acls(MockedVpc('vpcId'))
-    assert MockedCollectionItem.delete_called == 4
-
-
-def test_delete_vpc_subnets(ec2_patch):
-    ec2_patch.delete_vpc_subnets(MockedVpc('vpcId'))
-    assert MockedCollectionItem.delete_called == 5
-    assert MockedInterface.delete_called
+def test_plan_vpc_deletion(ec2_patch, monkeypatch):
+    vpcs = [{'VpcId': 'vpc-{}'.format(n), 'OwnerId': 'owner'} for n in range(3)]
+    items = uploader_vpc_items(['vpc-0', 'vpc-1', 'vpc-2'])
+    items['describe_instances'] = [('vpc-1', {'Instances': [{'VpcId': 'vpc-1'}]})]
+    client = VpcEC2Client(vpcs, items)
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    monkeypatch.setattr(EC2, 'filter_values_limit', 2)
+    plan = ec2_patch.plan_vpc_deletion('region1', vpcs)
+    # one call per describe operation and 2 VPCs
+    assert plan.api_calls == len(client.describe_calls) == 2 * (len(EC2.vpc_dependencies) + 1)
+    assert [f[0]['Values'] for op, f in client.describe_calls if op == 'describe_subnets'] == [['vpc-0', 'vpc-1'],
+                                                                                              ['vpc-2']]
+    # 8 listings and 2 per subnet per VPC
+    assert plan.calls_saved == 3 * (8 + 2 * 2) - plan.api_calls
+    assert plan.locked == {'vpc-1'}
+    assert [item['RouteTableId'] for _, item in plan.resources['route tables']] == ['rtb-vpc-0', 'rtb-vpc-1',
+                                                                                    'rtb-vpc-2']
+    assert [vpc_id for vpc_id, _ in plan.resources['security groups']] == ['vpc-0', 'vpc-1', 'vpc-2']
+    assert [vpc_id for vpc_id, _ in plan.resources['network acls']] == ['vpc-0', 'vpc-1', 'vpc-2']
+    assert [vpc_id for vpc_id, _ in plan.resources['network interfaces']] == ['vpc-0', 'vpc-0', 'vpc-1', 'vpc-1',
+                                                                              'vpc-2', 'vpc-2']
+    assert [vpc_id for vpc_id, _ in plan.resources['vpcs']] == ['vpc-0', 'vpc-1', 'vpc-2']
+
+
+def test_plan_vpc_deletion_page_sizes(ec2_patch, monkeypatch):
+    # botocore knows the MaxResults range of every operation but does not check the upper bound
+    service_model = botocore.session.get_session().get_service_model('ec2')
+    vpcs = [{'VpcId': 'vpc-0', 'OwnerId': 'owner'}]
+    client = VpcEC2Client(vpcs, uploader_vpc_items(['vpc-0']))
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    ec2_patch.plan_vpc_deletion('region1', vpcs)
+    assert len(client.page_sizes) == len(EC2.vpc_dependencies) + 1
+    for operation, page_sizes in client.page_sizes.items():
+        operation_model = service_model.operation_model(''.join(w.capitalize() for w in operation.split('_')))
+        limits = operation_model.input_shape.members['MaxResults'].metadata
+        assert all(limits.get('min', 5) <= size <= limits.get('max', 1000) for size in page_sizes), operation
+
+
+def test_delete_vpcs_by_level(ec2_patch, monkeypatch):
+    mails = []
+    vpcs = [{'VpcId': 'vpc-{}'.format(n), 'OwnerId': 'owner'} for n in range(3)]
+    items = uploader_vpc_items(['vpc-0', 'vpc-1', 'vpc-2'])
+    items['describe_instances'] = [('vpc-1', {'Instances': [{'VpcId': 'vpc-1'}]})]
+    client = VpcEC2Client(vpcs, items, broken=('eni-vpc-2-0',))
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    monkeypatch.setattr('ocw.lib.EC2.send_mail', lambda subject, body: mails.append(subject))
+    ec2_patch.dry_run = False
+    ec2_patch.delete_vpcs('region1', ec2_patch.plan_vpc_deletion('region1', vpcs))
+    levels = {EC2.vpc_deletions[kind][0]: n for n, level in enumerate(EC2.vpc_deletion_levels) for kind in level}
+    levels['detach_internet_gateway'] = 0
+    called_levels = [levels[name] for name, _ in client.calls]
+    assert called_levels == sorted(called_levels)
+    assert ('detach_internet_gateway', 'igw-vpc-0') in client.calls
+    assert ('delete_vpc_endpoints', 'vpce-vpc-0') in client.calls
+    assert ('delete_vpc', 'vpc-0') in client.calls
+    # the VPC with an instance is not touched
+    assert not [resource for _, resource in client.calls if 'vpc-1' in resource]
+    # the dependents of the failed network interface are kept
+    assert ('delete_network_interface', 'eni-vpc-2-1') in client.calls
+    assert not [resource for _, resource in client.calls if 'vpc-2' in resource and resource.startswith(
+        ('subnet-', 'sg-', 'acl-', 'vpc-'))]
+    assert mails == ['ClientError on VPC deletion in [fake]']
+    # defaults are deleted with the VPC
+    assert not [resource for _, resource in client.calls if 'default' in resource or 'main' in resource]
+
+
+def test_delete_vpcs_dry_run(ec2_patch, monkeypatch):
+    vpcs = [{'VpcId': 'vpc-0', 'OwnerId': 'owner'}]
+    client = VpcEC2Client(vpcs, uploader_vpc_items(['vpc-0']))
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    ec2_patch.dry_run = True
+    # gateway, endpoint, peering, route table, 2 interfaces, 2 subnets, security group, ACL and VPC
+    assert ec2_patch.delete_vpcs('region1', ec2_patch.plan_vpc_deletion('region1', vpcs)) == 11
+    assert client.calls == []
 
 
 def test_cleanup_all_calling_all(ec2_patch, monkeypatch):
     called_stack = []
 
-    def mocked_cleanup_images(self):
-        called_stack.append('cleanup_images')
-
-    def mocked_cleanup_snapshots(self, arg1):
-        called_stack.append('cleanup_snapshots')
-
-    def mocked_cleanup_volumes(self, arg1):
-        called_stack.append('cleanup_volumes')
-
-    def mocked_cleanup_uploader_vpcs(self):
-        called_stack.append('cleanup_uploader_vpcs')
+    def mocked_run_cleanup(self, resources):
+        called_stack.extend(name for name, _, _ in resources)
 
     def mocked_get_boolean(config_path, field=None):
         return config_path != 'default/dry_run'
 
     monkeypatch.setattr(PCWConfig, 'getBoolean', mocked_get_boolean)
-    monkeypatch.setattr(EC2, 'cleanup_images', mocked_cleanup_images)
-    monkeypatch.setattr(EC2, 'cleanup_snapshots', mocked_cleanup_snapshots)
-    monkeypatch.setattr(EC2, 'cleanup_volumes', mocked_cleanup_volumes)
-    monkeypatch.setattr(EC2, 'cleanup_uploader_vpcs', mocked_cleanup_uploader_vpcs)
+    monkeypatch.setattr(EC2, 'run_cleanup', mocked_run_cleanup)
     monkeypatch.setattr(PCWConfig, 'get_feature_property', lambda *args, **kwargs: 5)
 
     ec2_patch.cleanup_all()
 
-    assert called_stack == ['cleanup_images', 'cleanup_snapshots', 'cleanup_volumes', 'cleanup_uploader_vpcs']
+    assert called_stack == ['images', 'snapshots', 'volumes', 'uploader vpcs']
+
+
+def test_run_cleanup_lists_region_before_deleting(ec2_patch, monkeypatch):
+    monkeypatch.setattr(ec2_patch, 'all_regions', ['region1', 'region2', 'region3'])
+    calls = []
+    lock = threading.Lock()
+
+    def list_resources(kind):
+        def wrapped(region):
+            with lock:
+                calls.append(('list', kind, region))
+            if region == 'region3':
+                return []
+            return ['{}-{}-{}'.format(kind, region, n) for n in range(3)]
+        return wrapped
+
+    def delete(region, item):
+        with lock:
+            calls.append(('delete', item, region))
+
+    timings = ec2_patch.run_cleanup([('a', list_resources('a'), delete), ('b', list_resources('b'), delete)])
+
+    assert set(timings) == {'list', 'delete', 'total'}
+    assert len(calls) == 6 + 12
+    for region in ('region1', 'region2'):
+        region_calls = [c for c in calls if c[2] == region]
+        # a region is cleaned up once all its resource types are listed
+        assert [c[0] for c in region_calls] == ['list'] * 2 + ['delete'] * 6
+        deleted = [c[1] for c in region_calls if c[0] == 'delete']
+        # resource types are deleted one after another within a region
+        assert sorted(deleted[:3]) == ['a-{}-{}'.format(region, n) for n in range(3)]
+        assert sorted(deleted[3:]) == ['b-{}-{}'.format(region, n) for n in range(3)]
+
+
+def test_run_cleanup_region_concurrency(ec2_patch, monkeypatch):
+    monkeypatch.setattr(ec2_patch, 'all_regions', ['region1', 'region2'])
+    running = dict.fromkeys(ec2_patch.all_regions, 0)
+    max_running = dict.fromkeys(ec2_patch.all_regions, 0)
+    lock = threading.Lock()
+
+    def delete(region, item):
+        with lock:
+            running[region] += 1
+            max_running[region] = max(max_running[region], running[region])
+        time.sleep(0.01)
+        with lock:
+            running[region] -= 1
+
+    ec2_patch.run_cleanup([('a', lambda region: list(range(20)), delete)])
+    # mock_get_feature_property allows 4 concurrent deletions per region
+    assert max(max_running.values()) == 4
+
+
+def test_run_cleanup_raises_first_error_after_all_regions(ec2_patch, monkeypatch):
+    monkeypatch.setattr(ec2_patch, 'all_regions', ['region1', 'region2'])
+    deleted = []
+
+    def list_resources(region):
+        if region == 'region1':
+            raise ValueError('broken region')
+        return ['item']
+
+    with pytest.raises(ValueError):
+        ec2_patch.run_cleanup([('a', list_resources, lambda region, item: deleted.append(region))])
+    assert deleted == ['region2']
+
+
+def test_run_cleanup_counts_deleted_resources(ec2_patch, monkeypatch):
+    messages = []
+    monkeypatch.setattr(EC2, 'log_info', lambda self, message, *args: messages.append(message.format(*args)))
+    resources = [('a', lambda region: ['deleted', 'in use'], lambda region, item: 0 if item == 'in use' else None),
+                 ('plans', lambda region: ['plan'], lambda region, item: 7)]
+    ec2_patch.dry_run = False
+    ec2_patch.run_cleanup(resources)
+    assert messages[-1].startswith('Deleted 8 resource(s) in ')
+    ec2_patch.dry_run = True
+    ec2_patch.run_cleanup(resources)
+    assert messages[-1] == 'Would delete 8 resource(s), skipped due to dry run mode, 0 failure(s)'
+
 
 def test_list_clusters(ec2_patch, monkeypatch):
     mocked_eks = MockedEKSClient()
     monkeypatch.setattr(EC2, 'eks_client', lambda self, region: mocked_eks)
+    monkeypatch.setattr(EC2, 'cluster_cache_seconds', 0)
     all_clusters = ec2_patch.all_clusters()
     assert all_clusters == {}
 
@@ -509,3 +576,259 @@ def test_list_clusters(ec2_patch, monkeypatch):
     mocked_eks.clusters_list = {'clusters' : ['hastags', 'ignored']}
     all_clusters = ec2_patch.all_clusters()
     assert all_clusters == {'region1': ['hastags']}
+
+
+class TeardownEKSClient:
+    # nodegroups of every cluster, a deleted nodegroup disappears after the given number of list_nodegroups calls
+    def __init__(self, nodegroups, lifetime=1, clusters=None):
+        self.nodegroups = {cluster: list(groups) for cluster, groups in nodegroups.items()}
+        self.clusters = list(nodegroups) if clusters is None else clusters
+        self.lifetime = lifetime
+        self.deleting = dict()
+        self.calls = list()
+
+    def get_paginator(self, operation_name):
+        return MockedEKSPaginator([{'clusters': self.clusters}])
+
+    def list_nodegroups(self, clusterName):
+        for group in [g for g in self.nodegroups[clusterName] if g in self.deleting]:
+            self.deleting[group] -= 1
+            if self.deleting[group] == 0:
+                self.nodegroups[clusterName].remove(group)
+        return {'nodegroups': list(self.nodegroups[clusterName])}
+
+    def delete_nodegroup(self, clusterName, nodegroupName):
+        self.calls.append(('delete_nodegroup', nodegroupName))
+        self.deleting[nodegroupName] = self.lifetime
+
+    def delete_cluster(self, name):
+        if self.nodegroups[name]:
+            raise ClientError({'Error': {'Code': 'ResourceInUseException', 'Message': name}}, 'DeleteCluster')
+        self.calls.append(('delete_cluster', name))
+
+
+@pytest.fixture
+def teardown_clock(monkeypatch):
+    clock = {'now': 0.0, 'sleeps': 0}
+
+    def sleep(seconds):
+        clock['now'] += seconds
+        clock['sleeps'] += 1
+
+    monkeypatch.setattr(time, 'sleep', sleep)
+    monkeypatch.setattr(time, 'monotonic', lambda: clock['now'])
+    return clock
+
+
+def test_delete_all_clusters_waits_together(ec2_patch, monkeypatch, teardown_clock):
+    clients = {'region1': TeardownEKSClient({'c1': ['ng1', 'ng2'], 'c2': []}),
+               'region2': TeardownEKSClient({'c3': ['ng3']}, lifetime=3)}
+    monkeypatch.setattr(EC2, 'eks_client', lambda self, region: clients[region])
+    ec2_patch.cluster_regions = ['region1', 'region2']
+    ec2_patch.dry_run = False
+    outcomes = ec2_patch.delete_all_clusters()
+    assert outcomes == dict.fromkeys([('region1', 'c1'), ('region1', 'c2'), ('region2', 'c3')], EC2.DELETED)
+    # c2 has no nodegroups, c1 is deleted after the first and c3 after the third check
+    assert clients['region1'].calls[-1] == ('delete_cluster', 'c1')
+    assert ('delete_cluster', 'c2') in clients['region1'].calls
+    assert clients['region2'].calls == [('delete_nodegroup', 'ng3'), ('delete_cluster', 'c3')]
+    # nodegroups of both regions were waited for at the same time
+    assert teardown_clock['sleeps'] == 3
+
+
+def test_delete_all_clusters_timeout(ec2_patch, monkeypatch, teardown_clock):
+    client = TeardownEKSClient({'stuck': ['ng1'], 'free': ['ng2']})
+    client.lifetime = 10 ** 6
+    monkeypatch.setattr(EC2, 'eks_client', lambda self, region: client)
+    ec2_patch.dry_run = False
+    outcomes = ec2_patch.delete_all_clusters()
+    assert outcomes == {('region1', 'stuck'): EC2.TIMED_OUT, ('region1', 'free'): EC2.TIMED_OUT}
+    # one global deadline of delete-timeout-minutes
+    assert teardown_clock['now'] <= 60
+    assert all(call[0] == 'delete_nodegroup' for call in client.calls)
+
+
+def test_delete_all_clusters_failure(ec2_patch, monkeypatch, teardown_clock):
+    client = TeardownEKSClient({'c1': [], 'c2': ['ng2']})
+
+    def broken_delete_cluster(name):
+        raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': name}}, 'DeleteCluster')
+
+    client.delete_cluster = broken_delete_cluster
+    monkeypatch.setattr(EC2, 'eks_client', lambda self, region: client)
+    ec2_patch.dry_run = False
+    with pytest.raises(ClientError):
+        ec2_patch.delete_all_clusters()
+    # the failure of c1 does not stop the teardown of c2
+    assert ('delete_nodegroup', 'ng2') in client.calls
+    assert teardown_clock['sleeps'] == 1
+
+
+def test_delete_all_clusters_dry_run(ec2_patch, monkeypatch, teardown_clock):
+    client = TeardownEKSClient({'c1': ['ng1']})
+    monkeypatch.setattr(EC2, 'eks_client', lambda self, region: client)
+    ec2_patch.dry_run = True
+    assert ec2_patch.delete_all_clusters() == {('region1', 'c1'): EC2.DRY_RUN}
+    assert client.calls == []
+    assert teardown_clock['sleeps'] == 0
+
+
+def test_all_clusters_paginated_and_cached(ec2_patch, monkeypatch):
+    class CountingEKSClient(MockedEKSClient):
+        def __init__(self, pages):
+            self.paginator = MockedEKSPaginator(pages)
+            self.described = list()
+
+        def get_paginator(self, operation_name):
+            return self.paginator
+
+        def describe_cluster(self, name=None):
+            self.described.append(name)
+            return {'cluster': {'tags': {'pcw_ignore': '1'} if name.startswith('ignored') else {}}}
+
+    clients = {'region1': CountingEKSClient([{'clusters': ['c1', 'ignored1']}, {'clusters': ['c2']}]),
+               'region2': CountingEKSClient([{'clusters': []}]),
+               'region3': CountingEKSClient([{'clusters': ['ignored2']}])}
+    monkeypatch.setattr(EC2, 'eks_client', lambda self, region: clients[region])
+    ec2_patch.cluster_regions = ['region1', 'region2', 'region3']
+    assert ec2_patch.all_clusters() == {'region1': ['c1', 'c2']}
+    assert clients['region1'].paginator.calls == [{'PaginationConfig': {'PageSize': EC2.list_clusters_page_size}}]
+    assert sorted(clients['region1'].described) == ['c1', 'c2', 'ignored1']
+    # a second run reuses the listings and descriptions
+    assert ec2_patch.all_clusters() == {'region1': ['c1', 'c2']}
+    assert len(clients['region1'].paginator.calls) == 1
+    assert len(clients['region1'].described) == 3
+    assert ec2_patch.list_cluster_names('region3') == ['ignored2']
+    assert len(clients['region3'].paginator.calls) == 1
+    # until they are too old
+    monkeypatch.setattr(EC2, 'cluster_cache_seconds', 0)
+    ec2_patch.all_clusters()
+    assert len(clients['region1'].paginator.calls) == 2
+    assert len(clients['region1'].described) == 6
+
+
+def test_get_image_names(ec2_patch, monkeypatch):
+    class CountingEC2Client:
+        calls = []
+
+        def describe_images(self, Filters, IncludeDeprecated):
+            ids = Filters[0]['Values']
+            CountingEC2Client.calls.append(ids)
+            # every second image was deleted meanwhile
+            return {'Images': [{'ImageId': i, 'Name': 'name-' + i} for i in ids if int(i[4:]) % 2 == 0]}
+
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: CountingEC2Client())
+    image_ids = ['ami-{}'.format(n) for n in range(450)]
+    image_names = ec2_patch.get_image_names('region1', image_ids + image_ids[:10])
+
+    assert len(CountingEC2Client.calls) == 3
+    assert len(image_names) == 450
+    assert image_names['ami-2'] == 'name-ami-2'
+    assert image_names['ami-3'] is None
+
+
+class TerminatingEC2Client:
+    def __init__(self, missing=(), broken=()):
+        self.calls = []
+        self.missing = missing
+        self.broken = broken
+
+    def terminate_instances(self, InstanceIds):
+        self.calls.append(InstanceIds)
+        missing = [i for i in InstanceIds if i in self.missing]
+        if missing:
+            raise ClientError({'Error': {'Code': 'InvalidInstanceID.NotFound', 'Message': "The instance IDs '{}' do "
+                               "not exist".format(', '.join(missing))}}, 'TerminateInstances')
+        if any(i in self.broken for i in InstanceIds):
+            raise ClientError({'Error': {'Code': 'UnauthorizedOperation', 'Message': 'nope'}}, 'TerminateInstances')
+        return {'TerminatingInstances': [{'InstanceId': i} for i in InstanceIds]}
+
+
+def test_delete_instances_chunks(ec2_patch, monkeypatch):
+    client = TerminatingEC2Client()
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    ec2_patch.dry_run = False
+    instance_ids = ['i-{:x}'.format(n) for n in range(1500)]
+    outcomes = ec2_patch.delete_instances('region1', instance_ids)
+    assert [len(c) for c in client.calls] == [1000, 500]
+    assert outcomes == dict.fromkeys(instance_ids, EC2.TERMINATED)
+
+
+def test_delete_instances_not_found(ec2_patch, monkeypatch):
+    client = TerminatingEC2Client(missing=('i-2', 'i-4'))
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    ec2_patch.dry_run = False
+    outcomes = ec2_patch.delete_instances('region1', ['i-1', 'i-2', 'i-3', 'i-4'])
+    assert client.calls == [['i-1', 'i-2', 'i-3', 'i-4'], ['i-1', 'i-3']]
+    assert outcomes == {'i-1': EC2.TERMINATED, 'i-2': EC2.NOT_FOUND, 'i-3': EC2.TERMINATED, 'i-4': EC2.NOT_FOUND}
+    # a missing instance is not an error for a single delete either
+    ec2_patch.delete_instance('region1', 'i-2')
+
+
+def test_delete_instances_failed(ec2_patch, monkeypatch):
+    client = TerminatingEC2Client(broken=('i-1',))
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    monkeypatch.setattr(EC2, 'terminate_instances_limit', 2)
+    ec2_patch.dry_run = False
+    outcomes = ec2_patch.delete_instances('region1', ['i-1', 'i-2', 'i-3'])
+    assert isinstance(outcomes['i-1'], ClientError)
+    assert isinstance(outcomes['i-2'], ClientError)
+    assert outcomes['i-3'] == EC2.TERMINATED
+    with pytest.raises(ClientError):
+        ec2_patch.delete_instance('region1', 'i-1')
+
+
+def test_delete_instances_dry_run(ec2_patch, monkeypatch):
+    client = TerminatingEC2Client()
+    monkeypatch.setattr(EC2, 'ec2_client', lambda self, region: client)
+    ec2_patch.dry_run = True
+    assert ec2_patch.delete_instances('region1', ['i-1']) == {'i-1': EC2.DRY_RUN}
+    assert client.calls == []
+
+
+def test_list_instances_filters_terminated(ec2_patch, monkeypatch):
+    calls = []
+
+    class FakeCollection:
+        def filter(self, Filters):
+            calls.append(Filters)
+            return self
+
+        def page_size(self, count):
+            calls.append(count)
+            return iter(['i-1', 'i-2'])
+
+    class FakeResource:
+        instances = FakeCollection()
+
+    monkeypatch.setattr(EC2, 'ec2_resource', lambda self, region: FakeResource())
+    assert ec2_patch.list_instances('region1') == ['i-1', 'i-2']
+    assert calls == [[{'Name': 'instance-state-name', 'Values': EC2.listed_instance_states}], 1000]
+    assert 'terminated' not in EC2.listed_instance_states
+
+
+def test_new_publishes_complete_instance(ec2_patch, monkeypatch):
+    monkeypatch.setattr(EC2, '_EC2__instances', dict())
+    builders = []
+
+    class CheckingThreading:
+        @staticmethod
+        def Lock():
+            # other threads must neither see the instance nor build a second one while it is built
+            assert EC2._EC2__instances_lock.locked()
+            assert 'ns' not in EC2._EC2__instances
+            builders.append(threading.current_thread())
+            return threading.Lock()
+
+    monkeypatch.setattr('ocw.lib.EC2.threading', CheckingThreading)
+    barrier = threading.Barrier(4)
+
+    def new():
+        barrier.wait()
+        return EC2('ns')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        instances = [f.result() for f in [executor.submit(new) for _ in range(4)]]
+    assert EC2._EC2__instances == {'ns': instances[0]}
+    assert all(ec2 is instances[0] for ec2 in instances)
+    assert len(set(builders)) == 1
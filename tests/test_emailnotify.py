@@ -10,12 +10,12 @@ def test_draw_instance_table():
                 {
                     'openqa_var_JOB_ID': 123,
                     'openqa_created_by': 'openqa-suse-de'
-                }), 'ns', 'moon-west'),
+                }), 'ns', 'moon-west', {}),
                 ec2_to_local_instance(ec2_instance_mock(tags=
                 {
                     'openqa_var_JOB_ID': 666,
                     'openqa_created_by': 'i-dont-have-a-link'
-                }), 'ns', 'moon-west')
+                }), 'ns', 'moon-west', {})
             ]
     s = draw_instance_table(objects)
 
@@ -4,6 +4,11 @@ from tests.generators import min_image_age_hours, max_image_age_hours
 from tests.generators import mock_get_feature_property
 from tests import generators
 from datetime import datetime, timezone, timedelta
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 
 
 def test_parse_image_name(monkeypatch):
@@ -59,6 +64,41 @@ class FakeMockImages:
         return self.responses.pop(0)
 
 
+class FakeBatch:
+    """ Executes the added requests one after another and counts the batches """
+    executed = 0
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = list()
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        FakeBatch.executed += 1
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.execute(), None)
+            except HttpError as err:
+                self.callback(request_id, None, err)
+
+
+class FakeGlobalOperations:
+    """ Operations are done after the given number of polls """
+
+    def __init__(self, polls):
+        self.polls = polls
+        self.calls = 0
+
+    def get(self, project, operation):
+        self.calls += 1
+        self.polls[operation] -= 1
+        if self.polls[operation] > 0:
+            return FakeRequest({'name': operation, 'status': 'RUNNING'})
+        return FakeRequest({'name': operation, 'status': 'DONE'})
+
+
 def test_cleanup_all(monkeypatch):
     newer_then_min_age = datetime.now(timezone.utc).isoformat()
     older_then_min_age = (datetime.now(timezone.utc) - timedelta(hours=min_image_age_hours+1)).isoformat()
@@ -79,15 +119,18 @@ def test_cleanup_all(monkeypatch):
             ]
         }),
         None,   # on images().list_next()
-        FakeRequest({'error': {'errors': [{'message': 'err message'}]},
+        FakeRequest({'name': 'op-1', 'status': 'DONE', 'error': {'errors': [{'message': 'err message'}]},
                      'warnings': [{'message': 'warning message'}]}),
-        FakeRequest(),    # on images().delete()
+        FakeRequest({'name': 'op-2', 'status': 'PENDING'}),    # on images().delete()
     ])
 
     def mocked_compute_client():
         pass
     mocked_compute_client.images = lambda *args, **kwargs: fmi
+    mocked_compute_client.new_batch_http_request = FakeBatch
+    mocked_compute_client.globalOperations = lambda: FakeGlobalOperations({'op-2': 1})
     monkeypatch.setattr(GCE, 'compute_client', lambda self: mocked_compute_client)
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
 
     monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_get_feature_property)
     monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
@@ -100,3 +143,181 @@ def test_cleanup_all(monkeypatch):
     fmi = FakeMockImages([FakeRequest({})])
     gce.cleanup_all()
     assert fmi.deleted == []
+
+
+def test_delete_images_batched(monkeypatch):
+    names = ['image-{}'.format(n) for n in range(700)]
+    polls = {'op-{}'.format(n): n % 3 for n in range(700)}
+    operations = FakeGlobalOperations(polls)
+
+    class FakeImages:
+        def delete(self, project, image):
+            n = int(image.split('-')[1])
+            if n == 1:
+                return FakeErrorRequest(HttpError(Response({'status': 404}), b'not found'))
+            return FakeRequest({'name': 'op-{}'.format(n), 'status': 'DONE' if polls['op-{}'.format(n)] == 0
+                                else 'PENDING'})
+
+    def mocked_compute_client():
+        pass
+    mocked_compute_client.images = FakeImages
+    mocked_compute_client.new_batch_http_request = FakeBatch
+    mocked_compute_client.globalOperations = lambda: operations
+    monkeypatch.setattr(GCE, 'compute_client', lambda self: mocked_compute_client)
+    monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_get_feature_property)
+    monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    FakeBatch.executed = 0
+
+    outcomes = GCE('fake').delete_images(names)
+    assert '404' in outcomes.pop('image-1')
+    assert set(outcomes.values()) == {GCE.DELETED}
+    # 2 batches to delete the 700 images, 1 to poll the 465 running operations and 1 to poll them a second time
+    assert FakeBatch.executed == 2 + 1 + 1
+
+
+def test_delete_images_timeout(monkeypatch):
+    clock = [0]
+
+    class FakeImages:
+        def delete(self, project, image):
+            return FakeRequest({'name': 'op-' + image, 'status': 'PENDING'})
+
+    def mocked_compute_client():
+        pass
+    mocked_compute_client.images = FakeImages
+    mocked_compute_client.new_batch_http_request = FakeBatch
+    mocked_compute_client.globalOperations = lambda: FakeGlobalOperations({'op-a': 100})
+    monkeypatch.setattr(GCE, 'compute_client', lambda self: mocked_compute_client)
+    monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_get_feature_property)
+    monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(time, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+
+    assert GCE('fake').delete_images(['a']) == {'a': GCE.PENDING}
+
+
+class FakeErrorRequest:
+    def __init__(self, error):
+        self.error = error
+
+    def execute(self):
+        raise self.error
+
+
+class FakeComputeClient:
+    """ Fake of the compute discovery client which counts the executed requests """
+
+    def __init__(self, aggregated_pages, zones=None, forbid_aggregated=False):
+        self.aggregated_pages = aggregated_pages
+        self.zones = zones or {}
+        self.forbid_aggregated = forbid_aggregated
+        self.calls = 0
+
+    def request(self, response):
+        client = self
+
+        class CountingRequest:
+            def execute(self):
+                client.calls += 1
+                if isinstance(response, Exception):
+                    raise response
+                return response
+        return CountingRequest()
+
+    def instances(self):
+        return self
+
+    def regions(self):
+        return self
+
+    def aggregatedList(self, project):
+        if self.forbid_aggregated:
+            return self.request(HttpError(Response({'status': 403}), b'forbidden'))
+        self.page = 0
+        return self.request(self.aggregated_pages[0])
+
+    def aggregatedList_next(self, previous_request, previous_response):
+        self.page += 1
+        if self.page < len(self.aggregated_pages):
+            return self.request(self.aggregated_pages[self.page])
+        return None
+
+    def list(self, project, zone=None):
+        if zone is None:
+            return self.request({'items': [{'name': r} for r in sorted({z.split('-')[0] for z in self.zones})]})
+        return self.request({'items': self.zones[zone]} if self.zones[zone] else {})
+
+    def list_next(self, previous_request, previous_response):
+        return None
+
+    def get(self, project, region):
+        return self.request({'zones': ['zones/' + z for z in sorted(self.zones) if z.startswith(region)]})
+
+
+def test_list_all_instances_aggregated(monkeypatch):
+    fcc = FakeComputeClient([
+        {'items': {'zones/eu-a': {'instances': [{'name': 'vm1'}, {'name': 'vm2'}]},
+                   'zones/eu-b': {'warning': {'code': 'NO_RESULTS_ON_PAGE'}}}},
+        {'items': {'zones/us-a': {'instances': [{'name': 'vm3'}]}}},
+        {},
+    ])
+    monkeypatch.setattr(GCE, 'compute_client', lambda self: fcc)
+    monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
+    monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_get_feature_property)
+
+    assert [i['name'] for i in GCE('fake').list_all_instances()] == ['vm1', 'vm2', 'vm3']
+    assert fcc.calls == 3
+
+
+def test_list_all_instances_fallback_to_zones(monkeypatch):
+    fcc = FakeComputeClient([], zones={'eu-a': [{'name': 'vm1'}], 'eu-b': [], 'us-a': [{'name': 'vm2'}]},
+                            forbid_aggregated=True)
+    monkeypatch.setattr(GCE, 'compute_client', lambda self: fcc)
+    monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: '{}')
+    monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_get_feature_property)
+
+    assert [i['name'] for i in GCE('fake').list_all_instances()] == ['vm1', 'vm2']
+    # aggregatedList + regions().list + 2 * regions().get + 3 * instances().list
+    assert fcc.calls == 7
+
+
+def test_delete_instance_client_per_thread(monkeypatch):
+    class FakeInstances:
+        def __init__(self, client):
+            self.client = client
+
+        def delete(self, project, zone, instance):
+            # the client of another thread must not be used
+            assert self.client.thread == threading.current_thread()
+            deleted.append((self.client, zone, instance))
+            return FakeRequest()
+
+    class FakeClient:
+        def __init__(self):
+            self.thread = threading.current_thread()
+
+        def instances(self):
+            return FakeInstances(self)
+
+    deleted = []
+    monkeypatch.setattr(GCE, '_GCE__instances', dict())
+    monkeypatch.setattr(Provider, 'read_auth_json', lambda *args, **kwargs: {'project_id': 'project'})
+    monkeypatch.setattr(PCWConfig, 'get_feature_property', mock_get_feature_property)
+    monkeypatch.setattr('ocw.lib.gce.service_account.Credentials.from_service_account_info', lambda info: None)
+    monkeypatch.setattr('ocw.lib.gce.googleapiclient.discovery.build', lambda *args, **kwargs: FakeClient())
+    gce = GCE('fake')
+    gce.dry_run = False
+    barrier = threading.Barrier(4)
+
+    def delete(n):
+        barrier.wait()
+        gce.delete_instance('vm{}'.format(n), 'zone1')
+        gce.delete_instance('vm{}-2'.format(n), 'zone1')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for future in [executor.submit(delete, n) for n in range(4)]:
+            future.result()
+    assert len(deleted) == 8
+    # one client per thread, reused by its further calls
+    assert len({client for client, _, _ in deleted}) == 4
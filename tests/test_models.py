@@ -0,0 +1,33 @@
+from ocw.models import Instance
+from ocw.models import ProviderChoice
+
+
+def test_tags_memoized():
+    i = Instance(csp_info={'tags': {'a': '1'}})
+    tags = i.tags()
+    assert tags == {'a': '1'}
+    assert i.tags() is tags
+
+    i.csp_info = {'tags': {'b': '2'}}
+    assert i.tags() == {'b': '2'}
+
+
+def test_tags_invalid_csp_info():
+    assert Instance(csp_info={}).tags() == {}
+    assert Instance(csp_info={'tags': None}).tags() == {}
+    assert Instance(csp_info='{"tags": {"a": "1"}}').tags() == {'a': '1'}
+    assert Instance(csp_info='no json').tags() == {}
+
+
+def test_set_csp_info():
+    i = Instance(provider=ProviderChoice.EC2)
+    i.set_csp_info({'tags': {'openqa_created_by': 'openqa-suse-de', 'openqa_var_JOB_ID': 42,
+                             'openqa_var_NAME': 'x' * 300}})
+    assert i.openqa_created_by == 'openqa-suse-de'
+    assert i.openqa_var_job_id == '42'
+    assert i.openqa_var_name == 'x' * 256
+    assert i.get_openqa_job_link() == {'url': 'https://openqa.suse.de/t42', 'title': 'x' * 256}
+
+    i.set_csp_info({'tags': {'openqa_created_by': 'someone'}})
+    assert i.openqa_var_job_id == ''
+    assert i.get_openqa_job_link() is None
@@ -1,4 +1,4 @@
-from webui.settings import PCWConfig
+from webui.settings import PCWConfig, ConfigFile
 from .conftest import set_pcw_ini
 import pytest
 
@@ -130,3 +130,46 @@ def test_getBoolean_namespace_but_not_defined(pcw_file):
     providers = azure
     """)
     assert PCWConfig.getBoolean('feature/bool_property','random_namespace')
+
+
+def test_config_file_reloaded_on_change(pcw_file, monkeypatch):
+    monkeypatch.setattr(ConfigFile, 'recheck_interval', 0)
+    set_pcw_ini(pcw_file, """
+[cleanup]
+max-images-per-flavor = 1
+""")
+    assert PCWConfig.get_feature_property('cleanup', 'max-images-per-flavor') == 1
+    set_pcw_ini(pcw_file, """
+[cleanup]
+max-images-per-flavor = 22
+""")
+    assert PCWConfig.get_feature_property('cleanup', 'max-images-per-flavor') == 22
+
+
+def test_config_file_not_rechecked_within_interval(pcw_file, monkeypatch):
+    monkeypatch.setattr(ConfigFile, 'recheck_interval', 3600)
+    PCWConfig.get_providers_for('feature', 'fake')
+    monkeypatch.setattr(ConfigFile, 'get_stat', lambda self: pytest.fail('file should not be checked'))
+    assert PCWConfig.get_providers_for('feature', 'fake') == ['ec2', 'azure', 'gce']
+
+
+def test_lookups_memoized_per_snapshot(pcw_file, monkeypatch):
+    monkeypatch.setattr(ConfigFile, 'recheck_interval', 0)
+    set_pcw_ini(pcw_file, """
+[default]
+namespaces = test1, test2
+""")
+    calls = 0
+    get = ConfigFile.get
+
+    def counting_get(self, *args, **kwargs):
+        nonlocal calls
+        calls += 1
+        return get(self, *args, **kwargs)
+
+    monkeypatch.setattr(ConfigFile, 'get', counting_get)
+    namespaces = PCWConfig.get_namespaces_for('default')
+    first_calls = calls
+    namespaces.append('mutated')
+    assert PCWConfig.get_namespaces_for('default') == ['test1', 'test2']
+    assert calls == first_calls
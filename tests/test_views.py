@@ -0,0 +1,165 @@
+from ocw.views import instance_json
+from ocw.views import FilteredInstanceTableView
+from ocw.models import Instance, ProviderChoice, StateChoice, DataVersion, SyncGeneration
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.serializers import serialize
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.duration import duration_string
+from datetime import timedelta
+from urllib.parse import urlencode
+import json
+import pytest
+
+
+@pytest.fixture
+def instances(db):
+    now = timezone.now()
+    for provider in (ProviderChoice.EC2, ProviderChoice.GCE):
+        SyncGeneration.objects.create(provider=provider, vault_namespace='ns', generation=1, time=now)
+    for n in range(5):
+        Instance.objects.create(provider=ProviderChoice.EC2 if n % 2 else ProviderChoice.GCE, vault_namespace='ns',
+                                instance_id='i-{}'.format(n), first_seen=now - timedelta(hours=n), active=n != 4,
+                                state=StateChoice.ACTIVE, csp_info={'tags': {'n': n}})
+    return list(Instance.objects.order_by('pk'))
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+def get_json(rf, url):
+    response = instance_json(rf.get(url))
+    assert response.status_code == 200
+    return json.loads(response.content if hasattr(response, 'content') else b''.join(response.streaming_content))
+
+
+def get_table(rf, url='/instances', **headers):
+    request = rf.get(url, **headers)
+    request.user = AnonymousUser()
+    response = FilteredInstanceTableView.as_view()(request)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def test_instance_json_compatible(rf, instances):
+    active = Instance.objects.filter(active=True).order_by('pk')
+    expected = serialize("json", active, fields=("provider", "state", "first_seen", "ttl", "instance_id", "region",
+                                                 "vault_namespace", "csp_info"))
+    expected = json.loads(expected)
+    # last_seen and age are derived from the last sync and appended to the stored fields
+    for i, instance in zip(expected, active):
+        i['fields']['csp_info'] = json.dumps(i['fields']['csp_info'])
+        i['fields']['last_seen'] = json.loads(json.dumps(instance.last_seen, cls=DjangoJSONEncoder))
+        i['fields']['age'] = duration_string(instance.age)
+    assert get_json(rf, '/instances.json') == expected
+
+
+def test_instance_json_pagination(rf, instances):
+    page = get_json(rf, '/instances.json?limit=3')
+    assert [i['fields']['instance_id'] for i in page] == ['i-0', 'i-1', 'i-2']
+    page = get_json(rf, '/instances.json?limit=3&after={}'.format(page[-1]['pk']))
+    assert [i['fields']['instance_id'] for i in page] == ['i-3']
+
+
+def test_instance_json_fields_and_filter(rf, instances):
+    page = get_json(rf, '/instances.json?fields=instance_id,provider&provider=EC2')
+    assert [i['fields'] for i in page] == [{'provider': 'EC2', 'instance_id': 'i-1'},
+                                           {'provider': 'EC2', 'instance_id': 'i-3'}]
+
+
+def test_instance_json_csp_info_non_ascii(rf, instances):
+    instance = Instance.objects.get(instance_id='i-1')
+    instance.csp_info = {'tags': {'owner': 'bär'}}
+    instance.save()
+    url = '/instances.json?' + urlencode({'csp_info': 'bär'})
+    assert [i['fields']['instance_id'] for i in get_json(rf, url)] == ['i-1']
+    content = get_table(rf, '/instances?' + urlencode({'csp_info': 'bär'})).content
+    assert b'>i-1<' in content and b'>i-3<' not in content
+
+
+def test_instance_json_bad_request(rf, instances):
+    assert instance_json(rf.get('/instances.json?fields=secret')).status_code == 400
+    assert instance_json(rf.get('/instances.json?after=abc')).status_code == 400
+    assert instance_json(rf.get('/instances.json?after=-1')).status_code == 400
+    assert instance_json(rf.get('/instances.json?limit=-1')).status_code == 400
+    assert instance_json(rf.get('/instances.json?limit=-100000')).status_code == 400
+    assert instance_json(rf.get('/instances.json?provider=nope')).status_code == 400
+
+
+def test_instance_json_not_modified(rf, instances):
+    response = instance_json(rf.get('/instances.json'))
+    assert response.status_code == 200
+    etag = response['ETag']
+    with CaptureQueriesContext(connection) as ctx:
+        response = instance_json(rf.get('/instances.json', HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 304
+    # only DataVersion is read
+    assert len(ctx.captured_queries) == 1
+
+    DataVersion.bump()
+    response = instance_json(rf.get('/instances.json', HTTP_IF_NONE_MATCH=etag))
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+
+def test_instance_json_cached(rf, instances):
+    assert len(get_json(rf, '/instances.json?limit=10')) == 4
+    Instance.objects.filter(instance_id='i-0').update(active=False)
+    with CaptureQueriesContext(connection) as ctx:
+        assert len(get_json(rf, '/instances.json?limit=10')) == 4
+    assert len(ctx.captured_queries) == 1
+    assert len(get_json(rf, '/instances.json?limit=10&provider=EC2')) == 2
+
+    DataVersion.bump()
+    assert len(get_json(rf, '/instances.json?limit=10')) == 3
+
+
+def test_instance_json_cached_unlimited(rf, instances, monkeypatch):
+    assert len(get_json(rf, '/instances.json')) == 4
+    Instance.objects.filter(instance_id='i-0').update(active=False)
+    with CaptureQueriesContext(connection) as ctx:
+        assert len(get_json(rf, '/instances.json')) == 4
+    assert len(ctx.captured_queries) == 1
+
+    DataVersion.bump()
+    assert len(get_json(rf, '/instances.json')) == 3
+    # the entry of the outdated DataVersion was replaced
+    assert len([key for key in cache._cache if 'instance_json' in key]) == 1
+
+    monkeypatch.setattr('ocw.views.INSTANCE_JSON_CACHE_MAX_SIZE', 100)
+    cache.clear()
+    assert len(get_json(rf, '/instances.json')) == 3
+    # too big to be cached
+    with CaptureQueriesContext(connection) as ctx:
+        assert len(get_json(rf, '/instances.json')) == 3
+    assert len(ctx.captured_queries) > 1
+
+
+def test_instance_table_not_modified(rf, instances):
+    response = get_table(rf)
+    assert response.status_code == 200
+    assert response['Last-Modified']
+    with CaptureQueriesContext(connection) as ctx:
+        response = get_table(rf, HTTP_IF_NONE_MATCH=response['ETag'])
+    assert response.status_code == 304
+    assert len(ctx.captured_queries) == 1
+
+
+def test_instance_table_cached(rf, instances):
+    assert b'>i-3<' in get_table(rf).content
+    Instance.objects.filter(instance_id='i-3').update(instance_id='i-33')
+    with CaptureQueriesContext(connection) as ctx:
+        content = get_table(rf).content
+    assert b'>i-3<' in content and b'>i-33<' not in content
+    assert len(ctx.captured_queries) == 1
+    # other filter parameters are cached separately
+    assert b'>i-33<' in get_table(rf, '/instances?sort=instance_id').content
+
+    DataVersion.bump()
+    assert b'>i-33<' in get_table(rf).content
@@ -1,7 +1,7 @@
 import configparser
 import re
 import os
-import hashlib
+import time
 import logging.config
 
 
@@ -93,6 +93,18 @@ DATABASES = {
     }
 }
 
+# Cache for rendered instance views, entries store their DataVersion so they don't need explicit invalidation
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pcw',
+        # every worker process has its own cache of one entry per distinct query, see ocw.views.get_cached
+        'OPTIONS': {'MAX_ENTRIES': 64},
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -165,9 +177,13 @@ logging.config.dictConfig({
 
 class ConfigFile:
     __instance = None
-    __file_hash = None
+    __file_stat = None
+    __last_check = None
+    __cache = dict()
     filename = None
     config = None
+    # seconds in which the file is not checked for changes again
+    recheck_interval = 1
 
     def __new__(cls, filename=None):
         if ConfigFile.__instance is None:
@@ -175,18 +191,31 @@ class ConfigFile:
         ConfigFile.__instance.filename = filename or CONFIG_FILE
         return ConfigFile.__instance
 
-    def get_hash(self):
-        with open(self.filename, 'r') as f:
-            h = hashlib.sha256()
-            h.update(f.read().encode('utf-8'))
-            return h.hexdigest()
+    def get_stat(self):
+        st = os.stat(self.filename)
+        return (self.filename, st.st_ino, st.st_size, st.st_mtime_ns)
 
     def check_file(self):
-        file_hash = self.get_hash()
-        if self.__file_hash is None or self.__file_hash != file_hash:
-            self.__file_hash = file_hash
-            self.config = configparser.ConfigParser()
-            self.config.read(self.filename)
+        now = time.monotonic()
+        if self.__file_stat is not None and self.__file_stat[0] == self.filename and \
+                now - self.__last_check < self.recheck_interval:
+            return
+        self.__last_check = now
+        file_stat = self.get_stat()
+        if self.__file_stat != file_stat:
+            config = configparser.ConfigParser()
+            config.read(self.filename)
+            self.config = config
+            self.__cache = dict()
+            self.__file_stat = file_stat
+
+    def cached(self, key, compute):
+        ''' Return the memoized result of compute() for key. The memo is dropped whenever the file changes. '''
+        self.check_file()
+        cache = self.__cache
+        if key not in cache:
+            cache[key] = compute()
+        return cache[key]
 
     def get(self, config_path: str, default=None):
         self.check_file()
@@ -209,6 +238,11 @@ class PCWConfig():
 
     @staticmethod
     def get_feature_property(feature: str, property: str, namespace: str = None):
+        return ConfigFile().cached(('get_feature_property', feature, property, namespace),
+                                   lambda: PCWConfig.__get_feature_property(feature, property, namespace))
+
+    @staticmethod
+    def __get_feature_property(feature: str, property: str, namespace: str = None):
         default_values = {
             'cleanup/max-images-per-flavor': {'default': 1, 'return_type': int},
             'cleanup/max-image-age-hours': {'default': 24 * 31, 'return_type': int},
@@ -217,14 +251,38 @@ class PCWConfig():
             'cleanup/azure-storage-account-name': {'default': 'openqa', 'return_type': str},
             'cleanup/ec2-max-snapshot-age-days': {'default': -1, 'return_type': int},
             'cleanup/ec2-max-volumes-age-days': {'default': -1, 'return_type': int},
+            'cleanup/ec2-parallel-tasks': {'default': 8, 'return_type': int},
+            'cleanup/ec2-region-deletions': {'default': 4, 'return_type': int},
+            'cleanup/azure-parallel-containers': {'default': 8, 'return_type': int},
+            'cleanup/azure-parallel-deletions': {'default': 8, 'return_type': int},
+            'cleanup/azure-delete-timeout': {'default': 600, 'return_type': int},
+            'cleanup/gce-operation-timeout': {'default': 300, 'return_type': int},
+            'clusters/parallel-tasks': {'default': 8, 'return_type': int},
+            'clusters/delete-timeout-minutes': {'default': 30, 'return_type': int},
+            'default/ec2_parallel_regions': {'default': 8, 'return_type': int},
             'updaterun/default_ttl': {'default': 44400, 'return_type': int},
+            'updaterun/sync_batch_size': {'default': 500, 'return_type': int},
+            'updaterun/parallel_updates': {'default': 8, 'return_type': int},
+            'updaterun/retry_backoff_seconds': {'default': 5, 'return_type': int},
+            'scheduler/update-workers': {'default': 1, 'return_type': int},
+            'scheduler/cleanup-workers': {'default': 1, 'return_type': int},
+            'scheduler/clusters-workers': {'default': 1, 'return_type': int},
+            'scheduler/delete-workers': {'default': 1, 'return_type': int},
+            'autodelete/ec2-workers': {'default': 4, 'return_type': int},
+            'autodelete/azure-workers': {'default': 4, 'return_type': int},
+            'autodelete/gce-workers': {'default': 4, 'return_type': int},
+            'autodelete/ec2-rate': {'default': 5.0, 'return_type': float},
+            'autodelete/azure-rate': {'default': 5.0, 'return_type': float},
+            'autodelete/gce-rate': {'default': 5.0, 'return_type': float},
+            'autodelete/poll-seconds': {'default': 30, 'return_type': int},
             'notify/to': {'default': None, 'return_type': str},
             'notify/age-hours': {'default': 12, 'return_type': int},
             'cluster.notify/to': {'default': None, 'return_type': str},
             'notify/smtp': {'default': None, 'return_type': str},
             'notify/smtp-port': {'default': 25, 'return_type': int},
             'notify/from': {'default': 'pcw@publiccloud.qa.suse.de', 'return_type': str},
-            'webui/openqa_url': {'default': 'https://openqa.suse.de', 'return_type': str}
+            'webui/openqa_url': {'default': 'https://openqa.suse.de', 'return_type': str},
+            'webui/cache_timeout': {'default': 300, 'return_type': int}
         }
         key = '/'.join([feature, property])
         if key not in default_values:
@@ -238,12 +296,22 @@ class PCWConfig():
 
     @staticmethod
     def get_namespaces_for(feature: str) -> list:
+        return list(ConfigFile().cached(('get_namespaces_for', feature),
+                                        lambda: tuple(PCWConfig.__get_namespaces_for(feature))))
+
+    @staticmethod
+    def __get_namespaces_for(feature: str) -> list:
         if PCWConfig.has(feature):
             return ConfigFile().getList('{}/namespaces'.format(feature), ConfigFile().getList('default/namespaces'))
         return list()
 
     @staticmethod
     def get_providers_for(feature: str, namespace: str):
+        return list(ConfigFile().cached(('get_providers_for', feature, namespace),
+                                        lambda: tuple(PCWConfig.__get_providers_for(feature, namespace))))
+
+    @staticmethod
+    def __get_providers_for(feature: str, namespace: str):
         return ConfigFile().getList('{}.namespace.{}/providers'.format(feature, namespace),
                                     ConfigFile().getList('{}/providers'.format(feature), ['ec2', 'azure', 'gce']))
 